@@ -0,0 +1,264 @@
+"""
+Streaming database backup and restore
+
+Archives are gzip-compressed NDJSON: a header line identifying the format
+and version, one line per row tagged with its table, and a trailer with the
+row counts so truncated archives are detected. Rows are read from
+server-side cursors and written in chunks, and loaded back in batches
+(COPY on PostgreSQL, executemany elsewhere), so memory stays constant
+regardless of the number of users.
+"""
+
+import base64
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import time
+
+from auth import credential_keys, user_credentials
+from models import User, WebAuthnCredential, db
+from sqlalchemy import DateTime, LargeBinary, delete, insert, select, text
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FORMAT = "flask-webauthn-backup"
+ARCHIVE_VERSION = 1
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_BATCH_SIZE = int(os.getenv("BACKUP_BATCH_SIZE", "5000"))
+
+# Parents before children, so restores satisfy foreign keys
+BACKUP_TABLES = (User.__table__, WebAuthnCredential.__table__)
+
+
+def _encode_value(column, value):
+    if value is None:
+        return None
+    if isinstance(column.type, LargeBinary):
+        return base64.b64encode(value).decode("ascii")
+    if isinstance(column.type, DateTime):
+        return value.isoformat()
+    return value
+
+
+def _decode_value(column, value):
+    if value is None:
+        return None
+    if isinstance(column.type, LargeBinary):
+        return base64.b64decode(value)
+    if isinstance(column.type, DateTime):
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+
+class BackupStats:
+    """Row and byte counts with throughput for a backup or restore"""
+
+    def __init__(self):
+        self.rows = {}
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+        return self
+
+    def summary(self):
+        total = sum(self.rows.values())
+        rate = total / self.elapsed if self.elapsed else 0.0
+        tables = ", ".join(f"{name}: {count}" for name, count in self.rows.items())
+        return (f"{total} rows ({tables}), {self.bytes / 1e6:.1f} MB compressed "
+                f"in {self.elapsed:.2f}s ({rate:,.0f} rows/s)")
+
+
+def iter_backup(stats=None, batch_size=BACKUP_BATCH_SIZE):
+    """Yield a compressed archive of every backed-up table in chunks"""
+    stats = stats or BackupStats()
+    buffer = io.BytesIO()
+    archive = gzip.GzipFile(fileobj=buffer, mode="wb")
+
+    def drain():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        stats.bytes += len(data)
+        return data
+
+    def write(entry):
+        archive.write(json.dumps(entry, separators=(",", ":")).encode("utf-8") + b"\n")
+
+    write({
+        "format": ARCHIVE_FORMAT,
+        "version": ARCHIVE_VERSION,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "tables": [table.name for table in BACKUP_TABLES],
+    })
+
+    for table in BACKUP_TABLES:
+        columns = list(table.columns)
+        count = 0
+        result = db.session.execute(
+            select(table).order_by(table.primary_key.columns.values()[0])
+            .execution_options(yield_per=batch_size)
+        )
+        for partition in result.partitions():
+            for row in partition:
+                write({"t": table.name, "r": {
+                    column.name: _encode_value(column, value) for column, value in zip(columns, row)
+                }})
+            count += len(partition)
+            yield drain()
+        stats.rows[table.name] = count
+
+    write({"end": True, "rows": stats.rows})
+    archive.close()
+    yield drain()
+    stats.finish()
+
+
+def backup_to_file(path, batch_size=BACKUP_BATCH_SIZE):
+    """Write an archive to path; returns the BackupStats"""
+    stats = BackupStats()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "wb") as f:
+        for chunk in iter_backup(stats, batch_size):
+            f.write(chunk)
+    logger.info("Backup written to %s: %s", path, stats.summary())
+    return stats
+
+
+def _copy_field(value):
+    """A value as a field of COPY's CSV format"""
+    if value is None:
+        # Only an unquoted empty field reads as NULL
+        return ""
+    if isinstance(value, str):
+        # Quoted, so an empty string stays an empty string
+        return '"' + value.replace('"', '""') + '"'
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, bytes):
+        return "\\x" + value.hex()
+    return str(value)
+
+
+def _copy_columns(table, rows):
+    """The columns of table present in rows, which all have the same keys"""
+    return [column.name for column in table.columns if column.name in rows[0]] if rows else []
+
+
+def _copy_csv(table, rows):
+    """rows of table as the CSV text COPY ... FROM STDIN reads, NULLs included"""
+    columns = _copy_columns(table, rows)
+    return "".join(
+        ",".join(_copy_field(row.get(column)) for column in columns) + "\n"
+        for row in rows
+    )
+
+
+def _copy_rows(connection, table, rows):
+    """Load rows with COPY ... FROM STDIN on PostgreSQL"""
+    buffer = io.StringIO(_copy_csv(table, rows))
+    column_list = ", ".join(f'"{name}"' for name in _copy_columns(table, rows))
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        cursor.copy_expert(f'COPY "{table.name}" ({column_list}) FROM STDIN WITH (FORMAT csv)', buffer)
+    finally:
+        cursor.close()
+
+
+def _reset_sequences(connection):
+    """Move PostgreSQL id sequences past the restored ids"""
+    for table in BACKUP_TABLES:
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('\"{table.name}\"', 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM \"{table.name}\"), 0) + 1, false)"
+        ))
+
+
+def restore_from_file(path, replace=True, batch_size=BACKUP_BATCH_SIZE):
+    """
+    Load an archive written by backup_to_file in a single transaction,
+    replacing the current rows unless replace is False. Returns the
+    BackupStats.
+    """
+    stats = BackupStats()
+    stats.bytes = os.path.getsize(path)
+    tables = {table.name: table for table in BACKUP_TABLES}
+    connection = db.session.connection()
+    use_copy = connection.dialect.name == "postgresql"
+
+    def flush(table, rows):
+        if not rows:
+            return
+        if use_copy:
+            _copy_rows(connection, table, rows)
+        else:
+            connection.execute(insert(table), rows)
+        stats.rows[table.name] = stats.rows.get(table.name, 0) + len(rows)
+        rows.clear()
+
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as archive:
+            header = json.loads(archive.readline() or "{}")
+            if header.get("format") != ARCHIVE_FORMAT:
+                raise ValueError(f"{path} is not a {ARCHIVE_FORMAT} archive")
+            if header.get("version", 0) > ARCHIVE_VERSION:
+                raise ValueError(f"Unsupported archive version {header.get('version')}")
+
+            if replace:
+                for table in reversed(BACKUP_TABLES):
+                    connection.execute(delete(table))
+
+            current, batch, trailer = None, [], None
+            for line in archive:
+                entry = json.loads(line)
+                if entry.get("end"):
+                    trailer = entry
+                    break
+                table = tables.get(entry["t"])
+                if table is None:
+                    continue
+                if table is not current:
+                    flush(current, batch)
+                    current = table
+                # Columns added after the archive was written take their defaults
+                batch.append({
+                    column.name: _decode_value(column, entry["r"][column.name])
+                    for column in table.columns if column.name in entry["r"]
+                })
+                if len(batch) >= batch_size:
+                    flush(current, batch)
+            flush(current, batch)
+
+        if trailer is None:
+            raise ValueError(f"{path} is truncated: no end-of-archive marker")
+        if use_copy:
+            _reset_sequences(connection)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if replace:
+        credential_keys.clear()
+    # Merged or replaced, users may have gained credentials
+    user_credentials.clear()
+
+    stats.finish()
+    logger.info("Restored %s: %s", path, stats.summary())
+    return stats
+
+
+def resolve_backup_path(name):
+    """Path of a named archive inside BACKUP_DIR"""
+    return os.path.join(BACKUP_DIR, os.path.basename(name))
+
+
+def new_backup_path():
+    """Timestamped path for a new archive in BACKUP_DIR"""
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    return resolve_backup_path(f"webauthn-{stamp}.ndjson.gz")
@@ -1,9 +1,26 @@
+import datetime
+import io
+import json
+import logging
+import os
 
-from flask import Blueprint, render_template, request
-from models import User, db
+import click
+import metrics
+from admin import backup, provisioning, reaper
+from auth import audit, credential_keys, user_credentials
+from flask import Blueprint, Response, make_response, render_template, request, stream_with_context
+from models import User, WebAuthnCredential, db
+from sqlalchemy import select
+
+logger = logging.getLogger(__name__)
 
 dbm = Blueprint("dbm", __name__, url_prefix="/dbm", template_folder="templates")
 
+# Page sizes for /dbm/users
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "100"))
+USERS_MAX_PAGE_SIZE = int(os.getenv("USERS_MAX_PAGE_SIZE", "1000"))
+USERS_STREAM_BATCH_SIZE = int(os.getenv("USERS_STREAM_BATCH_SIZE", "1000"))
+
 
 # DB Management Portal Route
 @dbm.route("/", methods=["GET", "POST"])
@@ -23,21 +40,43 @@ def dbm_portal():
             user = User(username=username)
             db.session.add(user)
             db.session.commit()
+            audit.record("admin.user_added", user.uid, username)
             result = f"User '{username}' added."
         elif action == "delete_user" and username:
             user = User.query.filter_by(username=username).first()
             if user:
+                credential_ids = db.session.execute(
+                    select(WebAuthnCredential.credential_id).where(WebAuthnCredential.user_id == user.id)
+                ).scalars().all()
                 db.session.delete(user)
                 db.session.commit()
+                credential_keys.invalidate(credential_ids)
+                user_credentials.invalidate([user.id])
+                audit.record("admin.user_deleted", user.uid, username, credentials=len(credential_ids))
                 result = f"User '{username}' deleted."
             else:
                 result = f"User '{username}' not found."
         elif action == "backup_db":
-            # Placeholder for backup logic
-            result = "Database backup completed (not implemented)."
+            path = backup.new_backup_path()
+            try:
+                stats = backup.backup_to_file(path)
+                audit.record("admin.backup", file=os.path.basename(path), rows=stats.rows)
+                result = f"Database backed up to '{os.path.basename(path)}': {stats.summary()}"
+            except Exception as e:
+                logger.error("Backup failed: %s", e, exc_info=True)
+                result = f"Backup failed: {e}"
         elif action == "restore_db" and file:
-            # Placeholder for restore logic
-            result = f"Database restored from '{file}' (not implemented)."
+            path = backup.resolve_backup_path(file)
+            if not os.path.exists(path):
+                result = f"Backup file '{file}' not found."
+            else:
+                try:
+                    stats = backup.restore_from_file(path)
+                    audit.record("admin.restore", file=file, rows=stats.rows)
+                    result = f"Database restored from '{file}': {stats.summary()}"
+                except Exception as e:
+                    logger.error("Restore failed: %s", e, exc_info=True)
+                    result = f"Restore failed: {e}"
         else:
             result = "Invalid action or missing parameters."
     return render_template("dbm_portal.html", result=result)
@@ -52,6 +91,18 @@ def health_check():
     return {"status": "ok"}
 
 
+@dbm.route("/metrics")
+def metrics_endpoint():
+    """
+    Prometheus scrape endpoint with per-phase ceremony timings, request
+    latencies, database pool and Redis counters for this process.
+    """
+    res = make_response(metrics.REGISTRY.render())
+    res.mimetype = "text/plain"
+    res.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return res
+
+
 @dbm.route("/reset-database")
 def reset_database():
     """
@@ -60,24 +111,163 @@ def reset_database():
     """
     User.query.delete()
     db.session.commit()
+    credential_keys.clear()
+    user_credentials.clear()
+    audit.record("admin.database_reset")
     return {"status": "database reset successfully"}
 
 
 @dbm.route("/users")
 def list_users():
     """
-    Endpoint to list all users in the database.
-    Returns a JSON response with user details.
+    Endpoint to list users in the database, ordered by id.
+
+    Pages are keyset-paginated: pass the returned ``next_after_id`` as
+    ``after_id`` to fetch the next page of at most ``limit`` users. Results
+    can be filtered with ``username_prefix`` and ``email_prefix``. With
+    ``format=ndjson`` every matching user after ``after_id`` is streamed as
+    one JSON object per line, read from a server-side cursor in batches.
+    """
+    after_id = request.args.get("after_id", default=0, type=int)
+    username_prefix = request.args.get("username_prefix")
+    email_prefix = request.args.get("email_prefix")
+
+    query = select(User.id, User.uid, User.username, User.name, User.email).where(User.id > after_id)
+    if username_prefix:
+        query = query.where(User.username.startswith(username_prefix, autoescape=True))
+    if email_prefix:
+        query = query.where(User.email.startswith(email_prefix, autoescape=True))
+    query = query.order_by(User.id)
+
+    if request.args.get("format") == "ndjson":
+        limit = request.args.get("limit", type=int)
+        if limit:
+            query = query.limit(limit)
+        return Response(
+            stream_with_context(_stream_users(query)), mimetype="application/x-ndjson"
+        )
+
+    limit = max(1, min(request.args.get("limit", default=USERS_PAGE_SIZE, type=int), USERS_MAX_PAGE_SIZE))
+    # Fetch one extra row to know whether another page follows
+    rows = db.session.execute(query.limit(limit + 1)).all()
+    user_list = [dict(row._mapping) for row in rows[:limit]]
+    next_after_id = user_list[-1]["id"] if len(rows) > limit else None
+    return {"users": user_list, "next_after_id": next_after_id}
+
+
+@dbm.route("/audit")
+def list_audit_events():
+    """
+    Endpoint to list audit events, newest first, of one user (``user_uid``
+    or ``username``) or of everyone, back to ``since`` (an ISO timestamp,
+    by default AUDIT_QUERY_DAYS ago).
+
+    Pages are keyset-paginated: pass the returned ``next_before`` as
+    ``before`` and ``before_id`` to fetch the next page of at most
+    ``limit`` events. Events still queued in the writers aren't listed.
+    """
+    user_uid = request.args.get("user_uid")
+    username = request.args.get("username")
+    if username and not user_uid:
+        # Events of deleted users are still found by user_uid
+        user_uid = db.session.execute(select(User.uid).where(User.username == username)).scalar()
+        if user_uid is None:
+            return {"error": f"User '{username}' not found"}, 404
+
+    since = request.args.get("since", type=datetime.datetime.fromisoformat)
+    before = request.args.get("before", type=datetime.datetime.fromisoformat)
+    before_id = request.args.get("before_id", type=int)
+    if "since" in request.args and since is None or "before" in request.args and before is None:
+        return {"error": "since and before must be ISO 8601 timestamps"}, 400
+
+    events, next_before = audit.recent_events(
+        user_uid=user_uid,
+        since=since,
+        before=before,
+        before_id=before_id,
+        limit=request.args.get("limit", default=100, type=int),
+    )
+    return {
+        "events": events,
+        "next_before": {"before": next_before[0].isoformat(), "before_id": next_before[1]} if next_before else None,
+    }
+
+
+@dbm.route("/users/bulk", methods=["POST"])
+def bulk_provision_users():
+    """
+    Endpoint to create users in bulk from a CSV or NDJSON request body, or
+    an uploaded ``file``. The format follows ``?format=`` or the content
+    type. Returns a summary and a result entry for every input row.
     """
-    users = User.query.all()
-    user_list = [
-        {
-            "id": user.id,
-            "uid": user.uid,
-            "username": user.username,
-            "name": user.name,
-            "email": user.email,
-        }
-        for user in users
-    ]
-    return {"users": user_list}
\ No newline at end of file
+    upload = request.files.get("file")
+    if upload is not None:
+        raw, mimetype, filename = upload.stream, upload.mimetype, upload.filename or ""
+    else:
+        raw, mimetype, filename = request.stream, request.mimetype, ""
+
+    fmt = request.args.get("format")
+    if fmt is None:
+        fmt = "ndjson" if "json" in mimetype or filename.endswith((".ndjson", ".jsonl")) else "csv"
+    if fmt not in ("csv", "ndjson"):
+        return {"error": f"Unsupported format: {fmt}"}, 400
+
+    stream = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    report = provisioning.provision_users(provisioning.read_rows(stream, fmt))
+    return {"summary": report.summary(), "results": report.results}
+
+
+def _stream_users(query):
+    """Yield users as NDJSON, one batch of rows at a time"""
+    result = db.session.execute(query.execution_options(yield_per=USERS_STREAM_BATCH_SIZE))
+    for partition in result.partitions():
+        yield "".join(json.dumps(dict(row._mapping)) + "\n" for row in partition)
+
+
+@dbm.cli.command("backup")
+@click.argument("path", required=False)
+def backup_command(path):
+    """Write a compressed backup archive (default: a new file in BACKUP_DIR)"""
+    path = path or backup.new_backup_path()
+    stats = backup.backup_to_file(path)
+    audit.record("admin.backup", file=os.path.basename(path), rows=stats.rows)
+    click.echo(f"Backed up to {path}: {stats.summary()}")
+
+
+@dbm.cli.command("restore")
+@click.argument("path")
+@click.option("--append", is_flag=True, help="Keep existing rows instead of replacing them.")
+def restore_command(path, append):
+    """Load a backup archive written by 'flask dbm backup'"""
+    stats = backup.restore_from_file(path, replace=not append)
+    audit.record("admin.restore", file=os.path.basename(path), rows=stats.rows, append=append)
+    click.echo(f"Restored {path}: {stats.summary()}")
+
+
+@dbm.cli.command("provision")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]),
+              help="Input format (default: from the file extension).")
+@click.option("--report", "report_path", type=click.Path(dir_okay=False),
+              help="Write the per-row results to this NDJSON file.")
+def provision_command(path, fmt, report_path):
+    """Create users in bulk from a CSV or NDJSON file"""
+    fmt = fmt or ("ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv")
+    with open(path, encoding="utf-8", newline="") as f:
+        report = provisioning.provision_users(provisioning.read_rows(f, fmt))
+    if report_path:
+        with open(report_path, "w", encoding="utf-8") as f:
+            for result in report.results:
+                f.write(json.dumps(result) + "\n")
+    click.echo(json.dumps(report.summary()))
+
+
+@dbm.cli.command("reap")
+@click.option("--max-age", type=int, default=reaper.REAPER_MAX_AGE, show_default=True,
+              help="Only delete users older than this many seconds.")
+@click.option("--batch-size", type=int, default=reaper.REAPER_BATCH_SIZE, show_default=True)
+def reap_command(max_age, batch_size):
+    """Delete users who never registered a credential"""
+    total = reaper.reap(max_age=max_age, batch_size=batch_size,
+                        progress=lambda deleted: click.echo(f"Deleted {deleted} users so far"))
+    click.echo(f"Reaped {total} abandoned users")
@@ -0,0 +1,170 @@
+"""
+Bulk user provisioning
+
+Creates users from CSV (header with username, email and optionally name) or
+NDJSON input in batches. Each batch is checked against existing usernames
+and emails with two set-based queries and written with one multi-row
+INSERT, and every input row gets an entry in the result report.
+"""
+
+import csv
+import json
+import logging
+import os
+import time
+
+from auth import audit
+from models import User, db
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+PROVISION_BATCH_SIZE = int(os.getenv("PROVISION_BATCH_SIZE", "1000"))
+
+MAX_FIELD_LENGTH = 255
+
+
+def read_rows(stream, fmt):
+    """Yield dicts from a text stream of CSV or NDJSON"""
+    if fmt == "csv":
+        yield from csv.DictReader(stream)
+    elif fmt == "ndjson":
+        for line in stream:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    yield {"_invalid": "Malformed JSON line"}
+    else:
+        raise ValueError(f"Unsupported format: {fmt}")
+
+
+def _validate(row):
+    """Normalized (username, email, name), or an error message"""
+    if not isinstance(row, dict):
+        return None, "Row is not an object"
+    if "_invalid" in row:
+        return None, row["_invalid"]
+    username = str(row.get("username") or "").strip()
+    email = str(row.get("email") or "").strip()
+    name = str(row.get("name") or "").strip() or username
+    if not username:
+        return None, "Username is required."
+    if not email:
+        return None, "Email is required."
+    if max(len(username), len(email), len(name)) > MAX_FIELD_LENGTH:
+        return None, f"Fields are limited to {MAX_FIELD_LENGTH} characters."
+    return (username, email, name), None
+
+
+class ProvisioningReport:
+    """Per-row results and totals for one provisioning run"""
+
+    def __init__(self):
+        self.results = []
+        self.counts = {"created": 0, "conflict": 0, "duplicate": 0, "invalid": 0}
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def add(self, row_number, status, username=None, **fields):
+        self.counts[status] += 1
+        self.results.append({"row": row_number, "status": status, "username": username, **fields})
+
+    def summary(self):
+        total = sum(self.counts.values())
+        return {
+            **self.counts,
+            "rows": total,
+            "seconds": round(self.elapsed, 3),
+            "rows_per_second": round(total / self.elapsed, 1) if self.elapsed else None,
+        }
+
+
+def _insert_batch(pending, report):
+    """Insert validated rows; returns False if a concurrent writer got in first"""
+    try:
+        created = db.session.execute(
+            insert(User).returning(User.id, User.uid, sort_by_parameter_order=True),
+            [{"username": u, "email": e, "name": n} for _, (u, e, n) in pending],
+        ).all()
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+
+    for (row_number, (username, _, _)), (user_id, uid) in zip(pending, created):
+        report.add(row_number, "created", username, id=user_id, uid=uid)
+    return True
+
+
+def _insert_rows_individually(pending, report):
+    """Fallback after a batch lost a race: one savepoint per row"""
+    for row_number, (username, email, name) in pending:
+        try:
+            with db.session.begin_nested():
+                user = User(username=username, email=email, name=name)
+                db.session.add(user)
+            report.add(row_number, "created", username, id=user.id, uid=user.uid)
+        except IntegrityError:
+            report.add(row_number, "conflict", username, error="Username or email already in use.")
+    db.session.commit()
+
+
+def _provision_batch(batch, report):
+    pending = []
+    usernames, emails = set(), set()
+    for row_number, row in batch:
+        fields, error = _validate(row)
+        if error:
+            report.add(row_number, "invalid", row.get("username") if isinstance(row, dict) else None,
+                       error=error)
+            continue
+        username, email, _ = fields
+        if username in usernames or email in emails:
+            report.add(row_number, "duplicate", username, error="Username or email repeated in this upload.")
+            continue
+        usernames.add(username)
+        emails.add(email)
+        pending.append((row_number, fields))
+
+    if not pending:
+        return
+
+    taken_usernames = set(db.session.execute(
+        select(User.username).where(User.username.in_(usernames))
+    ).scalars())
+    taken_emails = set(db.session.execute(
+        select(User.email).where(User.email.in_(emails))
+    ).scalars())
+
+    insertable = []
+    for row_number, fields in pending:
+        username, email, _ = fields
+        if username in taken_usernames or email in taken_emails:
+            report.add(row_number, "conflict", username, error="Username or email already in use.")
+        else:
+            insertable.append((row_number, fields))
+
+    if insertable and not _insert_batch(insertable, report):
+        _insert_rows_individually(insertable, report)
+
+
+def provision_users(rows, batch_size=PROVISION_BATCH_SIZE):
+    """Create users from an iterable of dicts; returns a ProvisioningReport"""
+    report = ProvisioningReport()
+    batch = []
+    for row_number, row in enumerate(rows, start=1):
+        batch.append((row_number, row))
+        if len(batch) >= batch_size:
+            _provision_batch(batch, report)
+            batch = []
+    if batch:
+        _provision_batch(batch, report)
+
+    report.results.sort(key=lambda result: result["row"])
+    report.elapsed = time.perf_counter() - report.started
+    logger.info("Provisioned users: %s", report.summary())
+    audit.record("users.provisioned", **report.summary())
+    return report
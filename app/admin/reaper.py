@@ -0,0 +1,127 @@
+"""
+Reaper for abandoned registrations
+
+Users who start a signup and never finish it are left without any
+credential. The reaper deletes users whose signup is still pending, who
+have no credential and are older than REAPER_MAX_AGE seconds, in batches of
+REAPER_BATCH_SIZE. Users created any other way, by provisioning, the admin
+portal or a restore, are never reaped, nor are users of unknown age. Each batch is
+one short transaction: a set-based DELETE whose subquery finds candidates
+with an anti-join, so no rows are loaded into the ORM. On PostgreSQL
+candidates are locked with SKIP LOCKED, so concurrent reapers and signups
+never wait on each other.
+
+Run it once with ``flask dbm reap``, or every REAPER_INTERVAL seconds in a
+background thread of the app.
+"""
+
+import datetime
+import logging
+import os
+import threading
+import time
+
+import metrics
+from auth import audit
+from models import User, WebAuthnCredential, db
+from sqlalchemy import delete, exists, select
+
+logger = logging.getLogger(__name__)
+
+# Much longer than a ceremony, so signups in progress are never reaped
+REAPER_MAX_AGE = int(os.getenv("REAPER_MAX_AGE", "86400"))
+REAPER_BATCH_SIZE = int(os.getenv("REAPER_BATCH_SIZE", "500"))
+# Pause between batches, leaving room for other writers
+REAPER_BATCH_PAUSE = float(os.getenv("REAPER_BATCH_PAUSE", "0.05"))
+# Seconds between runs of the in-process worker; 0 disables it
+REAPER_INTERVAL = int(os.getenv("REAPER_INTERVAL", "0"))
+
+REAPED_USERS = metrics.Counter(
+    "webauthn_reaper_users_deleted_total", "Credential-less users deleted by the reaper"
+)
+REAPER_BATCH_SECONDS = metrics.Histogram(
+    "webauthn_reaper_batch_seconds", "Duration of one reaper delete batch"
+)
+REAPER_LAST_RUN = metrics.Gauge(
+    "webauthn_reaper_last_run_timestamp_seconds", "Unix time the last reaper run finished"
+)
+
+_worker = None
+
+
+def _reap_batch(cutoff, batch_size):
+    """Delete one batch of abandoned users; returns the number deleted"""
+    candidates = (
+        select(User.id)
+        .where(
+            User.signup_pending.is_(True),
+            User.created_at < cutoff,
+            ~exists().where(WebAuthnCredential.user_id == User.id),
+        )
+        .order_by(User.id)
+        .limit(batch_size)
+    )
+    if db.session.get_bind().dialect.name == "postgresql":
+        candidates = candidates.with_for_update(skip_locked=True)
+
+    try:
+        with REAPER_BATCH_SECONDS.time():
+            result = db.session.execute(
+                delete(User).where(User.id.in_(candidates.scalar_subquery())),
+                execution_options={"synchronize_session": False},
+            )
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result.rowcount
+
+
+def reap(max_age=REAPER_MAX_AGE, batch_size=REAPER_BATCH_SIZE, pause=REAPER_BATCH_PAUSE,
+         max_batches=None, progress=None):
+    """
+    Delete every credential-less user older than max_age seconds. progress,
+    if given, is called with the running total after each batch. Returns the
+    number of users deleted.
+    """
+    cutoff = (datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+              - datetime.timedelta(seconds=max_age))
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        deleted = _reap_batch(cutoff, batch_size)
+        batches += 1
+        total += deleted
+        REAPED_USERS.inc(deleted)
+        if progress is not None:
+            progress(total)
+        if deleted < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+
+    REAPER_LAST_RUN.set(time.time())
+    logger.info("Reaper deleted %s abandoned users in %s batches", total, batches)
+    if total:
+        audit.record("users.reaped", count=total, max_age=max_age)
+    return total
+
+
+def _run_forever(app, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            with app.app_context():
+                reap()
+        except Exception as e:
+            logger.error("Reaper run failed: %s", e, exc_info=True)
+
+
+def start_worker(app, interval=REAPER_INTERVAL):
+    """Run the reaper every interval seconds in a daemon thread"""
+    global _worker
+    if not interval or _worker is not None:
+        return
+    _worker = threading.Thread(target=_run_forever, args=(app, interval), name="reaper", daemon=True)
+    _worker.start()
+    logger.info("Reaper worker started, running every %ss", interval)
@@ -10,14 +10,24 @@ Based on the tutorial at:
 https://rickhenry.dev/blog/posts/2022-06-19-flask-webauthn-demo-1/
 """
 
+import logging
 import os
+import signal
+import sys
+import threading
+import time
 
 from dotenv import load_dotenv
-from flask import Flask, render_template
+from flask import Flask, g, render_template, request
 from flask_migrate import Migrate  # type: ignore
 
 load_dotenv()  # Load environment variables from .env file
 
+# Logging reads its settings from the environment, so set it up after .env
+import logs
+logs.configure_logging()
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 
 # Database configuration - Use environment variable or default to SQLite
@@ -29,21 +39,111 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "dev-secret-key-change-in-production")
 
 if not os.getenv("SECRET_KEY"):
-    print("WARNING: Using default SECRET_KEY. Set SECRET_KEY environment variable for production!")
+    logger.warning("Using default SECRET_KEY. Set SECRET_KEY environment variable for production!")
 
 # Import models after app configuration but before db.init_app
-from models import db, User, WebAuthnCredential
+from models import db, enable_foreign_keys, User, WebAuthnCredential
 from auth.views import auth
 from admin.dbm import dbm
+from admin import reaper
+from auth import audit, security, usage, verification
+import assets
+import metrics
 
 # Initialize database
 db.init_app(app)
 migrate = Migrate(app, db)
+metrics.instrument_pool_events()
+with app.app_context():
+    for engine in db.engines.values():
+        enable_foreign_keys(engine)
 
 # Register blueprints - Remove conflicting URL prefixes
 app.register_blueprint(auth)  # auth blueprint has no prefix
 app.register_blueprint(dbm)   # dbm blueprint already has /dbm prefix
 
+# Fingerprint and precompress static files; with a preloading server this
+# runs once, before the workers fork
+assets.init_app(app)
+
+audit.init_app(app)
+
+
+def start_workers():
+    """
+    Start the background threads of a process that serves requests; called
+    by the server entry points, so CLI commands and scripts that import the
+    app start none
+    """
+    # Periodically delete abandoned signups, if REAPER_INTERVAL is set
+    reaper.start_worker(app)
+
+    # Write credential usage behind logins, unless USAGE_FLUSH_INTERVAL is 0
+    usage.start_worker(app)
+
+    # Write audit events in batches, unless AUDIT_FLUSH_INTERVAL is 0
+    audit.start_worker(app)
+
+    # The usage and audit writers flush at exit, which SIGTERM skips unless
+    # it exits through sys.exit
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, _chain_sigterm(signal.getsignal(signal.SIGTERM)))
+
+
+def _chain_sigterm(previous):
+    """
+    A SIGTERM handler that leaves shutting down to the handler the server
+    installed, if any, and otherwise exits so atexit handlers run
+    """
+    def handler(signum, frame):
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            sys.exit(0)
+    return handler
+
+
+def serve():
+    """
+    The app, with this process's background threads started, for servers
+    that take a factory:
+
+        waitress-serve --call app:serve
+    """
+    start_workers()
+    return app
+
+
+def after_fork():
+    """
+    Prepare a server worker forked from a process that imported the app:
+    drop the database and Redis connections it inherited, so no socket is
+    shared between processes, and start its own background threads
+    """
+    logs.after_fork()
+    with app.app_context():
+        for engine in db.engines.values():
+            # close=False leaves the parent's connections open for the parent
+            engine.dispose(close=False)
+    security.after_fork()
+    verification.after_fork()
+    start_workers()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_latency(response):
+    start = g.pop("request_start", None)
+    if start is not None:
+        metrics.REQUEST_SECONDS.labels(
+            request.endpoint or "unmatched", request.method, str(response.status_code)
+        ).observe(time.perf_counter() - start)
+    return response
+
 
 @app.route("/")
 def index():
@@ -63,15 +163,16 @@ def create_tables_if_needed():
         if "sqlite" in database_url.lower():
             with app.app_context():
                 db.create_all()
-                print("✅ SQLite database tables created successfully")
+                logger.info("SQLite database tables created successfully")
         else:
-            print("ℹ️  Using PostgreSQL - tables managed by migrations")
+            logger.info("Using PostgreSQL - tables managed by migrations")
 
     except Exception as e:
-        print(f"❌ Error in table creation: {e}")
+        logger.error("Error in table creation: %s", e)
 
 
 # Initialize database tables for development only
 if __name__ == "__main__":
     create_tables_if_needed()
+    start_workers()
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,466 @@
+"""
+ASGI entry point
+
+Serves the WebAuthn ceremony endpoints of the auth blueprint as coroutines
+on an event loop (see auth.async_security), so one process can hold many
+more ceremonies in flight than a WSGI thread pool allows. Every other
+request, including the pages, static files and the DB portal, is passed to
+the unchanged Flask app, which keeps running in a thread pool.
+
+The ASGI-native routes are:
+
+    POST /start-login
+    POST /discoverable-login-options
+    POST /verify-login
+
+and, with REGISTRATION_MODE=deferred,
+
+    POST /create-user
+    POST /add-credential
+    POST /cleanup-failed-registration
+
+They parse requests with Flask's Request, read and write the session
+through app.session_interface and render templates in a Flask request
+context, so responses, the session cookie and the user_uid cookie match the
+Flask views and either server can handle any step of a ceremony. With
+REGISTRATION_MODE=immediate, registration is left to the Flask views.
+
+Run with:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import datetime
+import functools
+import io
+import json
+import logging
+import secrets
+import time
+import uuid
+
+import flask
+import metrics
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask import render_template
+from flask.ctx import RequestContext
+from sqlalchemy.exc import IntegrityError
+from webauthn.helpers.exceptions import InvalidAuthenticationResponse, InvalidRegistrationResponse
+
+from app import app, start_workers
+from auth import async_security, audit, limits, payloads, resilience, security, usage, verification
+from auth.resilience import StoreUnavailable
+
+logger = logging.getLogger(__name__)
+
+USER_COOKIE_MAX_AGE = int(datetime.timedelta(days=30).total_seconds())
+
+
+class Request(flask.Request):
+    """A Flask request built from the ASGI scope, with its session opened
+    through the app's session interface"""
+
+    def __init__(self, scope, body):
+        # asgiref's own scope-to-environ mapping, the one the Flask app sees
+        # through WsgiToAsgi
+        builder = WsgiToAsgiInstance(app.wsgi_app)
+        builder.scope = scope
+        super().__init__(builder.build_environ(scope, io.BytesIO(body)))
+        self.session = app.session_interface.open_session(app, self)
+        if self.session is None:
+            self.session = app.session_interface.make_null_session(app)
+
+    def payload(self):
+        """The JSON body, or None if there is none"""
+        return self.get_json(force=True, silent=True)
+
+    def set_session(self, key, value):
+        self.session[key] = value
+
+    def pop_session(self, key):
+        return self.session.pop(key, None)
+
+
+class Response(flask.Response):
+    default_mimetype = "application/json"
+
+
+def _save_session(request, response):
+    """Write the session cookie through the app's session interface"""
+    if not app.session_interface.is_null_session(request.session):
+        app.session_interface.save_session(app, request.session, response)
+
+
+def _render(request, template, **context):
+    # Templates call url_for, which needs a request context
+    with RequestContext(app, request.environ, request=request, session=request.session):
+        return Response(render_template(template, **context), mimetype="text/html")
+
+
+def _user_cookie(request, response, user_uid):
+    response.set_cookie(
+        "user_uid",
+        str(user_uid),
+        httponly=True,
+        secure=request.is_secure,
+        samesite="strict",
+        max_age=USER_COOKIE_MAX_AGE,
+    )
+
+
+def _admitted(endpoint, form=None, identities=None):
+    """Async ``auth.views._admitted``; shares its limits and buckets"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            refusal = await limits.admit_async(
+                async_security.limiter, endpoint, request.remote_addr, identities(request) if identities else ()
+            )
+            if refusal is not None:
+                return _refused_response(request, *refusal, form=form)
+            try:
+                return await handler(request)
+            finally:
+                limits.done()
+        return wrapper
+    return decorator
+
+
+def _refused_response(request, status, retry_after, form=None):
+    if status == 429:
+        error = "Too many attempts. Please wait a moment and try again."
+    else:
+        error = "Server busy. Please try again."
+    if form:
+        response = _render(request, form, error=error)
+        response.status = status
+    else:
+        response = Response(json.dumps({"verified": False, "error": error}), status)
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+def _form_identities(request):
+    form = request.form
+    return form.get("username", ""), form.get("email", "")
+
+
+@_admitted("auth.create_user", form="auth/_partials/user_creation_form.html", identities=_form_identities)
+async def create_user(request):
+    """Start a deferred registration"""
+    form = request.form
+    name = form.get("name", "").strip()
+    username = form.get("username", "").strip()
+    email = form.get("email", "").strip()
+
+    if not username:
+        return _render(request, "auth/_partials/user_creation_form.html", error="Username is required.")
+    if not email:
+        return _render(request, "auth/_partials/user_creation_form.html", error="Email is required.")
+
+    user_uid = str(uuid.uuid4())
+    try:
+        taken = (await async_security.username_or_email_taken(username, email)
+                 or not await async_security.reserve_registration(user_uid, username, email))
+    except StoreUnavailable as e:
+        return _store_unavailable_form(request, "auth/_partials/user_creation_form.html", e)
+    if taken:
+        return _render(
+            request,
+            "auth/_partials/user_creation_form.html",
+            error="That username or email address is already in use. "
+            "Please enter a different one.",
+        )
+
+    try:
+        pcco_json = await async_security.prepare_pending_registration(
+            request.base_url, user_uid, name or username, username, email
+        )
+    except Exception as e:
+        logger.warning("Error generating WebAuthn options: %s", e, exc_info=True)
+        await async_security.release_registration(user_uid, username, email)
+        if isinstance(e, StoreUnavailable):
+            return _store_unavailable_form(request, "auth/_partials/user_creation_form.html", e)
+        return _render(
+            request,
+            "auth/_partials/user_creation_form.html",
+            error="Failed to set up authentication. Please try again.",
+        )
+
+    request.set_session("registration_user_uid", user_uid)
+    request.set_session("registration_pending", True)
+    return _render(
+        request,
+        "auth/_partials/register_credential.html",
+        public_credential_creation_options=pcco_json,
+    )
+
+
+async def _audit(request, event, user_uid=None, username=None, **detail):
+    """Record an audit event without blocking the event loop"""
+    if audit.QUEUE is None:
+        await asyncio.to_thread(audit.record, event, user_uid, username, request.remote_addr, **detail)
+    else:
+        audit.record(event, user_uid, username, request.remote_addr, timeout=0, **detail)
+
+
+def _verifier_busy_response(error):
+    logger.warning("Credential verification unavailable: %s", error)
+    response = Response('{"verified": false, "error": "Server busy. Please try again."}', 503)
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+def _store_unavailable_response(error):
+    logger.warning("Challenge store unavailable: %s", error)
+    response = Response('{"verified": false, "error": "Service temporarily unavailable. Please try again."}', 503)
+    response.headers["Retry-After"] = str(resilience.retry_after(error))
+    return response
+
+
+def _store_unavailable_form(request, template, error):
+    logger.warning("Challenge store unavailable: %s", error)
+    response = _render(request, template, error="Sign-in is temporarily unavailable. Please try again in a moment.")
+    response.status = 503
+    response.headers["Retry-After"] = str(resilience.retry_after(error))
+    return response
+
+
+@_admitted("auth.add_credential")
+async def add_credential(request):
+    """Verify the first credential of a deferred registration"""
+    user_uid = request.session.get("registration_user_uid")
+    if not user_uid or not request.session.get("registration_pending"):
+        return Response('{"verified": false, "error": "User not found in session"}', 400)
+
+    try:
+        verification.check_capacity()
+    except verification.VerificationRejected as e:
+        return _verifier_busy_response(e)
+
+    try:
+        with metrics.timed("credential_parse"):
+            credential_data = request.payload()
+            if not credential_data:
+                return Response('{"verified": false, "error": "No credential data received"}', 400)
+            registration_credential = payloads.decode_registration(credential_data)
+    except Exception as e:
+        logger.warning("Error parsing credential data: %s", e)
+        await _audit(request, "registration.failed", user_uid, reason="credential parsing failure")
+        await async_security.cancel_pending_registration(user_uid)
+        request.pop_session("registration_user_uid")
+        request.pop_session("registration_pending")
+        return Response(json.dumps({"verified": False, "error": f"Invalid credential data: {e}"}), 400)
+
+    request.pop_session("registration_user_uid")
+    request.pop_session("registration_pending")
+
+    try:
+        user_uid, username = await async_security.verify_pending_registration(
+            request.base_url, user_uid, registration_credential
+        )
+    except InvalidRegistrationResponse as e:
+        logger.warning("Registration verification failed: %s", e)
+        await _audit(request, "registration.failed", user_uid, reason="verification failure")
+        return Response('{"verified": false, "error": "Registration verification failed"}', 400)
+    except ValueError as e:
+        logger.info("Pending registration not found: %s", e)
+        return Response('{"verified": false, "error": "Registration expired. Please start again."}', 400)
+    except IntegrityError as e:
+        logger.warning("IntegrityError creating user: %s", e)
+        await _audit(request, "registration.failed", user_uid, reason="username or email in use")
+        return Response('{"verified": false, "error": "Username or email already in use"}', 409)
+    except (verification.VerificationRejected, verification.VerificationTimeout) as e:
+        return _verifier_busy_response(e)
+    except StoreUnavailable as e:
+        return _store_unavailable_response(e)
+    except Exception as e:
+        logger.error("Unexpected error during verification: %s", e, exc_info=True)
+        return Response('{"verified": false, "error": "Verification failed"}', 500)
+
+    response = Response('{"verified": true}', 201)
+    _user_cookie(request, response, user_uid)
+    logger.info("WebAuthn credential successfully registered for user: %s", username)
+    await _audit(request, "registration.succeeded", user_uid, username)
+    return response
+
+
+@_admitted("auth.cleanup_failed_registration")
+async def cleanup_failed_registration(request):
+    """Cancel a deferred registration"""
+    user_uid = request.session.get("registration_user_uid")
+    if user_uid and request.pop_session("registration_pending"):
+        await async_security.cancel_pending_registration(user_uid)
+        request.pop_session("registration_user_uid")
+        logger.info("Cancelled pending registration %s", user_uid)
+        await _audit(request, "registration.cancelled", user_uid)
+    return Response('{"cleaned": true}')
+
+
+async def start_login(request):
+    """Generate authentication options for the user logging in"""
+    username = request.form.get("username", "").strip()
+    if not username:
+        return _render(request, "auth/_partials/login_form.html", error="Username is required.")
+
+    login_id = secrets.token_urlsafe(16)
+    try:
+        pcro_json = await async_security.prepare_login(request.base_url, username, login_id)
+    except StoreUnavailable as e:
+        return _store_unavailable_form(request, "auth/_partials/login_form.html", e)
+    except Exception as e:
+        logger.warning("Error generating WebAuthn login options: %s", e)
+        return _render(
+            request,
+            "auth/_partials/login_form.html",
+            error="Unable to start login for that account. Please try again.",
+        )
+    if pcro_json is None:
+        return _render(request, "auth/_partials/login_form.html", error="No account found with that username.")
+
+    request.set_session("login_id", login_id)
+    return _render(
+        request,
+        "auth/_partials/login_credential.html",
+        public_credential_request_options=pcro_json,
+    )
+
+
+async def discoverable_login_options(request):
+    """Generate options for a username-less login with a discoverable credential"""
+    login_id = secrets.token_urlsafe(16)
+    try:
+        pcro_json = await async_security.prepare_discoverable_login(request.base_url, login_id)
+    except StoreUnavailable as e:
+        return _store_unavailable_response(e)
+    except Exception as e:
+        logger.warning("Error generating discoverable login options: %s", e)
+        return Response('{"error": "Unable to start login"}', 500)
+
+    request.set_session("login_id", login_id)
+    return Response(pcro_json)
+
+
+async def verify_login(request):
+    """Verify an assertion from the browser and log the user in"""
+    login_id = request.pop_session("login_id")
+    if not login_id:
+        return Response('{"verified": false, "error": "No login in progress"}', 400)
+
+    try:
+        with metrics.timed("credential_parse"):
+            credential_data = request.payload()
+            if not credential_data:
+                return Response('{"verified": false, "error": "No credential data received"}', 400)
+            authentication_credential = payloads.decode_authentication(credential_data)
+    except Exception as e:
+        logger.warning("Error parsing authentication credential: %s", e)
+        return Response('{"verified": false, "error": "Invalid credential data"}', 400)
+
+    try:
+        user_uid, username = await async_security.verify_login(
+            request.base_url, login_id, authentication_credential
+        )
+    except (InvalidAuthenticationResponse, ValueError) as e:
+        logger.warning("Authentication verification failed: %s", e)
+        await _audit(request, "login.failed", credential_id=authentication_credential.id, reason=str(e))
+        return Response('{"verified": false, "error": "Authentication failed"}', 400)
+    except StoreUnavailable as e:
+        return _store_unavailable_response(e)
+    except Exception as e:
+        logger.error("Unexpected error during authentication: %s", e, exc_info=True)
+        return Response('{"verified": false, "error": "Verification failed"}', 500)
+
+    request.set_session("user_uid", user_uid)
+    response = Response('{"verified": true}')
+    _user_cookie(request, response, user_uid)
+    logger.info("User logged in: %s", username)
+    await _audit(request, "login.succeeded", user_uid, username, credential_id=authentication_credential.id)
+    return response
+
+
+# (method, path) -> (endpoint name, handler)
+ROUTES = {
+    ("POST", "/start-login"): ("auth.start_login", start_login),
+    ("POST", "/discoverable-login-options"): ("auth.discoverable_login_options", discoverable_login_options),
+    ("POST", "/verify-login"): ("auth.verify_login", verify_login),
+}
+if security.REGISTRATION_MODE == "deferred":
+    ROUTES.update({
+        ("POST", "/create-user"): ("auth.create_user", create_user),
+        ("POST", "/add-credential"): ("auth.add_credential", add_credential),
+        ("POST", "/cleanup-failed-registration"): ("auth.cleanup_failed_registration", cleanup_failed_registration),
+    })
+
+flask_application = WsgiToAsgi(app)
+
+
+async def _read_body(scope, receive, limit):
+    """The request body, or None for one over limit bytes, without reading it if it says so"""
+    for name, value in scope["headers"]:
+        if name == b"content-length" and value.isdigit() and int(value) > limit:
+            return None
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            start_workers()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await asyncio.to_thread(usage.flush)
+            await asyncio.to_thread(audit.flush)
+            await async_security.dispose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+
+    route = ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if route is None:
+        return await flask_application(scope, receive, send)
+
+    endpoint, handler = route
+    start = time.perf_counter()
+    # Every route handled here takes a form or a credential payload, so the
+    # credential payload cap bounds them all
+    body = await _read_body(scope, receive, payloads.CREDENTIAL_MAX_PAYLOAD_BYTES)
+    if body is None:
+        response = Response(json.dumps({"verified": False, "error": str(payloads.PayloadTooLarge())}), 413)
+    else:
+        request = Request(scope, body)
+        session_token = async_security.session_var.set(request.session)
+        try:
+            response = await handler(request)
+        except Exception as e:
+            logger.error("Unhandled error in %s: %s", endpoint, e, exc_info=True)
+            response = Response('{"error": "Internal server error"}', 500)
+        finally:
+            async_security.session_var.reset(session_token)
+        _save_session(request, response)
+
+    headers = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in response.headers.items()]
+    await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+    await send({"type": "http.response.body", "body": response.get_data()})
+    metrics.REQUEST_SECONDS.labels(endpoint, scope["method"], str(response.status_code)).observe(
+        time.perf_counter() - start
+    )
+
+
+async_security.init(app)
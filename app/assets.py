@@ -0,0 +1,219 @@
+"""
+Fingerprinted, precompressed static assets
+
+At startup (or ahead of time with ``flask assets build``) every file in the
+static folder is copied to ASSETS_BUILD_DIR under a name carrying a hash of
+its content, e.g. ``app.3f9c2b1d0e4a.js``, next to gzip and, when the brotli
+package is installed, brotli variants of the text types. Files already built
+from the same content are left alone, so a restart only rehashes.
+
+``url_for("static", filename=...)`` then resolves to the hashed name, and
+those URLs are served from the prebuilt variant the client accepts, with a
+strong ETag and a year-long immutable Cache-Control: a browser fetches each
+version of an asset once and never revalidates it. A changed file gets a new
+name, so pages pick it up straight away. Unhashed names are still served,
+by Flask's own handler.
+
+Fingerprinting is off with FLASK_ENV=development, where static files change
+under a running server, unless ASSETS_FINGERPRINT says otherwise.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+
+import click
+import metrics
+from flask import request, send_file
+
+try:
+    import brotli
+except ImportError:  # optional; gzip only without it
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+ASSETS_FINGERPRINT = os.getenv(
+    "ASSETS_FINGERPRINT", "0" if os.getenv("FLASK_ENV") == "development" else "1"
+) == "1"
+# Defaults to assets/ in the instance folder
+ASSETS_BUILD_DIR = os.getenv("ASSETS_BUILD_DIR")
+# Variants are kept only when they save at least this fraction of the bytes
+ASSETS_MIN_SAVING = 0.1
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+STATIC_RESPONSES = metrics.Counter(
+    "webauthn_static_responses_total", "Fingerprinted static responses by content encoding and status",
+    ("encoding", "status"),
+)
+
+# Content-Encoding -> built file suffix, in order of preference
+_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+class Asset:
+    """One built static file and its compressed variants"""
+
+    __slots__ = ("source", "hashed", "digest", "mimetype", "encodings")
+
+    def __init__(self, source, hashed, digest, mimetype, encodings):
+        self.source = source
+        self.hashed = hashed
+        self.digest = digest
+        self.mimetype = mimetype
+        # Content-Encodings built for it, e.g. ("br", "gzip")
+        self.encodings = encodings
+
+
+class Manifest:
+    """Built assets by source name and by hashed name"""
+
+    def __init__(self, build_dir, assets=()):
+        self.build_dir = build_dir
+        self.by_source = {asset.source: asset for asset in assets}
+        self.by_hashed = {asset.hashed: asset for asset in assets}
+
+    def to_json(self):
+        return json.dumps({
+            asset.source: {"file": asset.hashed, "digest": asset.digest, "encodings": list(asset.encodings)}
+            for asset in self.by_source.values()
+        }, indent=2, sort_keys=True)
+
+
+def hashed_name(source, digest):
+    root, ext = os.path.splitext(source)
+    return f"{root}.{digest}{ext}"
+
+
+def _write(path, data):
+    """Write a file atomically, so a concurrent build or reader never sees it partial"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _write_once(path, data):
+    # Content addressed, so an existing file already holds these bytes
+    if not os.path.exists(path):
+        _write(path, data)
+
+
+def _compress(data, encoding):
+    if encoding == "gzip":
+        # mtime=0 keeps the bytes, and so the ETag, the same across builds
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return brotli.compress(data, quality=11)
+
+
+def build(static_dir, build_dir):
+    """Hash, copy and compress every file under static_dir; returns the Manifest"""
+    assets = []
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            if name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            source = os.path.relpath(path, static_dir).replace(os.sep, "/")
+            with open(path, "rb") as f:
+                data = f.read()
+
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            hashed = hashed_name(source, digest)
+            target = os.path.join(build_dir, hashed)
+            _write_once(target, data)
+
+            mimetype = mimetypes.guess_type(source)[0] or "application/octet-stream"
+            encodings = []
+            if mimetype.startswith(COMPRESSIBLE_TYPES):
+                for encoding, suffix in _ENCODINGS:
+                    if encoding == "br" and brotli is None:
+                        continue
+                    if os.path.exists(target + suffix):
+                        encodings.append(encoding)
+                        continue
+                    compressed = _compress(data, encoding)
+                    if len(compressed) <= len(data) * (1 - ASSETS_MIN_SAVING):
+                        _write_once(target + suffix, compressed)
+                        encodings.append(encoding)
+            assets.append(Asset(source, hashed, digest, mimetype, tuple(encodings)))
+
+    manifest = Manifest(build_dir, assets)
+    _write(os.path.join(build_dir, "manifest.json"), manifest.to_json().encode())
+    return manifest
+
+
+def _accepted(header, encoding):
+    """Whether an Accept-Encoding header accepts encoding (q=0 refuses it)"""
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() == encoding:
+            return params.replace(" ", "").lower() not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def send_static(manifest, fallback, filename):
+    """The static view: hashed names from the build, anything else from fallback"""
+    asset = manifest.by_hashed.get(filename)
+    if asset is None:
+        return fallback(filename=filename)
+
+    path = os.path.join(manifest.build_dir, asset.hashed)
+    encoding = None
+    accept = request.headers.get("Accept-Encoding", "")
+    for candidate, suffix in _ENCODINGS:
+        if candidate in asset.encodings and _accepted(accept, candidate):
+            encoding = candidate
+            path += suffix
+            break
+
+    response = send_file(path, mimetype=asset.mimetype, etag=False, conditional=False, max_age=None)
+    response.set_etag(f"{asset.digest}-{encoding}" if encoding else asset.digest)
+    response.headers["Cache-Control"] = IMMUTABLE
+    if asset.encodings:
+        response.vary.add("Accept-Encoding")
+    if encoding:
+        response.content_encoding = encoding
+    response.make_conditional(request)
+    STATIC_RESPONSES.labels(encoding or "identity", str(response.status_code)).inc()
+    return response
+
+
+def init_app(app):
+    """Build the static assets and serve them under their hashed names"""
+    build_dir = ASSETS_BUILD_DIR or os.path.join(app.instance_path, "assets")
+
+    @app.cli.group("assets")
+    def assets_cli():
+        """Static asset pipeline"""
+
+    @assets_cli.command("build")
+    def build_command():
+        """Fingerprint and precompress the static folder"""
+        manifest = build(app.static_folder, build_dir)
+        click.echo(f"Built {len(manifest.by_source)} assets into {build_dir}")
+
+    if not ASSETS_FINGERPRINT or not app.static_folder or not os.path.isdir(app.static_folder):
+        return None
+
+    manifest = build(app.static_folder, build_dir)
+    logger.info("Built %s static assets into %s%s", len(manifest.by_source), build_dir,
+                "" if brotli is not None else " (gzip only, brotli isn't installed)")
+
+    @app.url_defaults
+    def fingerprinted_static(endpoint, values):
+        if endpoint == "static" and "filename" in values:
+            asset = manifest.by_source.get(values["filename"])
+            if asset is not None:
+                values["filename"] = asset.hashed
+
+    fallback = app.view_functions["static"]
+    app.view_functions["static"] = lambda filename: send_static(manifest, fallback, filename)
+    return manifest
@@ -0,0 +1,300 @@
+"""
+Async ceremony operations for the ASGI entry point
+
+These mirror the functions in auth.security and share their challenge keys,
+record formats, queries and verification code, so a ceremony may start on
+one server and finish on the other. I/O goes through ``redis.asyncio`` and
+an async SQLAlchemy engine, so a ceremony waiting on Redis or the database
+doesn't hold a thread.
+
+Call ``init(app)`` once before serving.
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+
+import metrics
+import webauthn
+from models import User, WebAuthnCredential, db, enable_foreign_keys
+from sqlalchemy import insert, or_, select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from webauthn.helpers import base64url_to_bytes
+from webauthn.helpers.exceptions import InvalidAuthenticationResponse
+from webauthn.helpers.structs import PublicKeyCredentialDescriptor, UserVerificationRequirement
+
+from auth import credential_keys, limits, metadata, resilience, security, usage, user_credentials, verification
+from auth.challenges import AsyncMemoryChallengeStore, AsyncRedisChallengeStore, AsyncSignedChallengeStore
+from auth.resilience import AsyncResilientChallengeStore, StoreUnavailable
+
+logger = logging.getLogger(__name__)
+
+# Defaults to DATABASE_URL with its driver swapped for an async one
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", "20"))
+
+_ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+engine = None
+store = None
+ceremonies = None
+limiter = None
+
+# The session of the request being handled, for signed challenges
+session_var = contextvars.ContextVar("session")
+
+
+def async_database_url(url):
+    """The async driver equivalent of a SQLAlchemy URL"""
+    backend = url.get_backend_name()
+    if backend not in _ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend}")
+    return url.set(drivername=_ASYNC_DRIVERS[backend])
+
+
+def init(app):
+    """Create the async engine and challenge store for app's configuration"""
+    global engine, store, ceremonies, limiter
+    if ASYNC_DATABASE_URL:
+        url = ASYNC_DATABASE_URL
+    else:
+        # Resolved through Flask-SQLAlchemy so relative SQLite paths point
+        # at the same file as the sync app
+        with app.app_context():
+            url = async_database_url(db.engine.url)
+
+    if str(url).startswith("sqlite"):
+        # aiosqlite runs each connection on its own thread; don't keep them
+        # around, so nothing outlives the event loop
+        options = {"poolclass": NullPool}
+    else:
+        options = {"pool_size": ASYNC_DB_POOL_SIZE, "max_overflow": ASYNC_DB_POOL_SIZE, "pool_pre_ping": True}
+    engine = create_async_engine(url, **options)
+    enable_foreign_keys(engine.sync_engine)
+
+    if security.redis_client is not None:
+        from redis.asyncio import BlockingConnectionPool, Redis
+        client = Redis(connection_pool=BlockingConnectionPool(
+            **resilience.pool_options(security.REDIS_HOST, security.REDIS_PORT, security.REDIS_PASSWORD)
+        ))
+        # Shares the sync store's breaker and fallback, so both entry points
+        # agree on whether Redis is up and see the same fallback challenges
+        store = AsyncResilientChallengeStore(
+            AsyncRedisChallengeStore(client),
+            AsyncMemoryChallengeStore(security.FALLBACK_STORE),
+            security.CHALLENGE_STORE.breaker,
+        )
+        limiter = limits.AsyncRateLimiter(
+            limits.AsyncRedisTokenBuckets(client), limits.FALLBACK, security.CHALLENGE_STORE.breaker
+        )
+    else:
+        # Share the sync app's in-process store, so requests it serves see
+        # the same challenges
+        store = AsyncMemoryChallengeStore(security.CHALLENGE_STORE)
+        limiter = limits.AsyncRateLimiter(None, limits.FALLBACK)
+
+    if security.CHALLENGE_MODE == "signed":
+        ceremonies = AsyncSignedChallengeStore(store, session_var.get, lambda: app.secret_key)
+    else:
+        ceremonies = store
+
+
+async def dispose():
+    """Close pooled database and Redis connections"""
+    if engine is not None:
+        await engine.dispose()
+    if isinstance(store, AsyncResilientChallengeStore):
+        await store.primary.client.aclose()
+
+
+async def _consume(key):
+    try:
+        return await ceremonies.consume(key)
+    except StoreUnavailable:
+        raise
+    except Exception as e:
+        logger.warning("Error retrieving challenge: %s", e)
+        return None
+
+
+async def username_or_email_taken(username, email):
+    """Whether a user already has this username or email"""
+    with metrics.timed("uniqueness_query"):
+        async with engine.connect() as conn:
+            result = await conn.execute(
+                select(User.id).where(or_(User.username == username, User.email == email)).limit(1)
+            )
+            return result.first() is not None
+
+
+async def reserve_registration(user_uid, username, email):
+    """Async ``security.reserve_registration``"""
+    owner = user_uid.encode()
+    held = []
+    for key in security.reservation_keys(username, email):
+        if not await store.reserve(key, owner, security.REGISTRATION_RESERVATION_TTL):
+            for held_key in held:
+                await store.release(held_key, owner)
+            return False
+        held.append(key)
+    return True
+
+
+async def release_registration(user_uid, username, email):
+    """Async ``security.release_registration``"""
+    owner = user_uid.encode()
+    for key in security.reservation_keys(username, email):
+        try:
+            await store.release(key, owner)
+        except Exception as e:
+            logger.warning("Error releasing reservation %s: %s", key, e)
+
+
+async def prepare_pending_registration(base_url, user_uid, name, username, email):
+    """Async ``security.prepare_pending_registration``"""
+    options = security.registration_options(security.rp_id_for(base_url), user_uid, username, name)
+    record = security.pending_registration_record(name, username, email, options.challenge)
+    with metrics.timed("challenge_store"):
+        await ceremonies.put(security.registration_key(user_uid), record)
+    return webauthn.options_to_json(options)
+
+
+async def verify_pending_registration(base_url, user_uid, registration_credential):
+    """
+    Async ``security.verify_pending_registration``; returns the new user's
+    (uid, username).
+    """
+    with metrics.timed("challenge_consume"):
+        record = await _consume(security.registration_key(user_uid))
+    if not record:
+        raise ValueError("No pending registration found. Please try registration again.")
+
+    pending = json.loads(record)
+    try:
+        with metrics.timed("registration_verify"):
+            auth_verification = await verification.verify_registration_response_async(
+                credential=registration_credential,
+                expected_challenge=base64url_to_bytes(pending["challenge"]),
+                expected_origin=security.origin_for(base_url),
+                expected_rp_id=security.rp_id_for(base_url),
+                pem_root_certs_bytes_by_fmt=metadata.trust_anchors_for(registration_credential),
+            )
+
+        with metrics.timed("user_insert"):
+            async with engine.begin() as conn:
+                result = await conn.execute(insert(User).values(
+                    uid=user_uid, name=pending["name"], username=pending["username"], email=pending["email"],
+                ))
+                await conn.execute(insert(WebAuthnCredential).values(
+                    user_id=result.inserted_primary_key[0],
+                    credential_public_key=auth_verification.credential_public_key,
+                    credential_id=auth_verification.credential_id,
+                    transports=user_credentials.encode_transports(registration_credential.response.transports),
+                ))
+            user_credentials.invalidate([result.inserted_primary_key[0]])
+        return user_uid, pending["username"]
+    finally:
+        await release_registration(user_uid, pending["username"], pending["email"])
+
+
+async def cancel_pending_registration(user_uid):
+    """Async ``security.cancel_pending_registration``"""
+    record = await _consume(security.registration_key(user_uid))
+    if record:
+        pending = json.loads(record)
+        await release_registration(user_uid, pending["username"], pending["email"])
+
+
+async def prepare_login(base_url, username, login_id):
+    """
+    Async ``security.prepare_login`` taking a username. Returns None if there
+    is no such user, and raises ValueError if they have no credentials.
+    """
+    with metrics.timed("credential_list"):
+        async with engine.connect() as conn:
+            rows = (await conn.execute(
+                select(User.id, WebAuthnCredential.credential_id)
+                .outerjoin(WebAuthnCredential, WebAuthnCredential.user_id == User.id)
+                .where(User.username == username)
+            )).all()
+
+    if not rows:
+        return None
+    credential_ids = [row.credential_id for row in rows if row.credential_id is not None]
+    if not credential_ids:
+        raise ValueError("No credentials registered for user")
+
+    with metrics.timed("authentication_options"):
+        options = webauthn.generate_authentication_options(
+            rp_id=security.rp_id_for(base_url),
+            allow_credentials=[PublicKeyCredentialDescriptor(id=cid) for cid in credential_ids],
+            user_verification=UserVerificationRequirement.PREFERRED,
+        )
+
+    with metrics.timed("challenge_store"):
+        await ceremonies.put(security.login_key(login_id), options.challenge)
+    return webauthn.options_to_json(options)
+
+
+async def prepare_discoverable_login(base_url, login_id):
+    """Async ``security.prepare_discoverable_login``"""
+    with metrics.timed("authentication_options"):
+        options = webauthn.generate_authentication_options(
+            rp_id=security.rp_id_for(base_url),
+            user_verification=UserVerificationRequirement.PREFERRED,
+        )
+
+    with metrics.timed("challenge_store"):
+        await ceremonies.put(security.login_key(login_id), options.challenge)
+    return webauthn.options_to_json(options)
+
+
+async def verify_login(base_url, login_id, authentication_credential):
+    """Async ``security.verify_login``; returns the user's (uid, username)"""
+    with metrics.timed("challenge_consume"):
+        expected_challenge = await ceremonies.consume(security.login_key(login_id))
+    if not expected_challenge:
+        raise ValueError("No challenge found for login. Please try again.")
+
+    with metrics.timed("credential_lookup"):
+        async with engine.connect() as conn:
+            stored = (await conn.execute(security.credential_lookup_query(authentication_credential))).first()
+
+    if stored is None:
+        raise InvalidAuthenticationResponse("Unknown credential")
+
+    current_sign_count = stored.current_sign_count or 0
+    with metrics.timed("authentication_verify"):
+        # The signature check is CPU bound; keep it off the event loop
+        auth_verification = await asyncio.to_thread(
+            credential_keys.verify_authentication_response,
+            credential=authentication_credential,
+            expected_challenge=expected_challenge,
+            expected_origin=security.origin_for(base_url),
+            expected_rp_id=security.rp_id_for(base_url),
+            credential_public_key=stored.credential_public_key,
+            credential_current_sign_count=current_sign_count,
+        )
+
+    # Authenticators without a counter always report zero
+    new_sign_count = auth_verification.new_sign_count
+    if new_sign_count:
+        with metrics.timed("sign_count_check"):
+            advanced = await store.advance(
+                usage.sign_count_key(authentication_credential.raw_id),
+                new_sign_count, current_sign_count, usage.SIGN_COUNT_TTL,
+            )
+        if not advanced:
+            raise InvalidAuthenticationResponse("Sign count was not greater than the stored count")
+
+    row = usage.usage_row(stored.id, new_sign_count)
+    if not usage.buffered(row):
+        with metrics.timed("usage_write"):
+            async with engine.begin() as conn:
+                statement, parameters = usage.update_statement(conn.dialect.name, [row])
+                await conn.execute(statement, parameters)
+
+    return stored.uid, stored.username
@@ -0,0 +1,268 @@
+"""
+Audit events
+
+Registrations, logins, device changes and admin actions are recorded as
+rows of the append-only audit_event table. Recording an event only puts it
+on a bounded in-memory queue; a background thread writes the queue every
+AUDIT_FLUSH_INTERVAL seconds, or as soon as AUDIT_BATCH_SIZE events are
+waiting, as multi-row INSERTs of at most AUDIT_BATCH_SIZE rows. Whatever is
+queued is written when the process exits.
+
+When the queue holds AUDIT_QUEUE_SIZE events, because the database is slow
+or down, recording waits up to AUDIT_ENQUEUE_TIMEOUT seconds for room,
+which slows the requests producing events down to what the writer manages.
+An event that still doesn't fit is dropped, logged and counted in
+webauthn_audit_events_dropped_total. A batch that fails to write is kept and
+retried, ahead of the queue.
+
+On PostgreSQL the table is partitioned by month. The writer creates the
+partitions for the months it writes to, and the next, on first use, and a
+default partition catches anything else; old months can be detached or
+dropped whole.
+
+With AUDIT_FLUSH_INTERVAL=0, and in processes that don't run the writer,
+such as CLI commands, every event is written when it is recorded.
+"""
+
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import nullcontext
+
+import metrics
+from flask import has_app_context, has_request_context, request
+from models import AuditEvent, db
+from sqlalchemy import insert, select, text, tuple_
+
+logger = logging.getLogger(__name__)
+
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_ENQUEUE_TIMEOUT = float(os.getenv("AUDIT_ENQUEUE_TIMEOUT", "0.05"))
+# How far back /dbm/audit looks unless asked otherwise
+AUDIT_QUERY_DAYS = int(os.getenv("AUDIT_QUERY_DAYS", "30"))
+AUDIT_QUERY_MAX_LIMIT = 1000
+
+AUDIT_QUEUE_DEPTH = metrics.Gauge(
+    "webauthn_audit_queue_depth", "Audit events waiting to be written"
+)
+AUDIT_EVENTS_WRITTEN = metrics.Counter(
+    "webauthn_audit_events_written_total", "Audit events written to the database"
+)
+AUDIT_EVENTS_DROPPED = metrics.Counter(
+    "webauthn_audit_events_dropped_total", "Audit events dropped because the queue stayed full"
+)
+AUDIT_FLUSHES = metrics.Counter(
+    "webauthn_audit_flushes_total", "Audit batch writes by outcome", ("outcome",)
+)
+AUDIT_FLUSH_SECONDS = metrics.Histogram(
+    "webauthn_audit_flush_seconds", "Duration of one audit batch write"
+)
+
+QUEUE = queue.Queue(maxsize=AUDIT_QUEUE_SIZE) if AUDIT_FLUSH_INTERVAL > 0 else None
+# Set when a batch is waiting, to flush before the interval is up
+_batch_ready = threading.Event()
+_flush_lock = threading.Lock()
+# A batch that failed to write, retried before the queue
+_retry = []
+# First day of each month known to have a partition
+_partitions = set()
+
+_worker = None
+_app = None
+
+if QUEUE is not None:
+    AUDIT_QUEUE_DEPTH.set_function(lambda: QUEUE.qsize())
+
+
+def event_row(event, user_uid=None, username=None, remote_addr=None, detail=None):
+    """An audit_event row, stamped now"""
+    return {
+        # Naive UTC, like the other timestamps
+        "occurred_at": datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None),
+        "event": event,
+        "user_uid": user_uid,
+        "username": username,
+        "remote_addr": remote_addr,
+        "detail": json.dumps(detail, default=str) if detail else None,
+    }
+
+
+def _month(timestamp):
+    return datetime.date(timestamp.year, timestamp.month, 1)
+
+
+def _next_month(month):
+    return datetime.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def ensure_partitions(months):
+    """Create the PostgreSQL partitions of these months, if they don't exist yet"""
+    for month in sorted(set(months) - _partitions):
+        name = f"audit_event_{month:%Y_%m}"
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF audit_event "
+                    f"FOR VALUES FROM ('{month}') TO ('{_next_month(month)}')"
+                ))
+        except Exception as e:
+            # Another process created it first, or the default partition
+            # already holds rows of that month; they land there either way
+            logger.warning("Couldn't create audit partition %s: %s", name, e)
+        _partitions.add(month)
+
+
+def write(rows):
+    """Insert audit rows now, in batches; needs an app context"""
+    if db.engine.dialect.name == "postgresql":
+        months = {_month(row["occurred_at"]) for row in rows}
+        ensure_partitions(months | {_next_month(month) for month in months})
+    with db.engine.begin() as connection:
+        for start in range(0, len(rows), AUDIT_BATCH_SIZE):
+            connection.execute(insert(AuditEvent.__table__), rows[start:start + AUDIT_BATCH_SIZE])
+    AUDIT_EVENTS_WRITTEN.inc(len(rows))
+
+
+def record(event, user_uid=None, username=None, remote_addr=None, timeout=AUDIT_ENQUEUE_TIMEOUT, **detail):
+    """
+    Record an audit event. remote_addr defaults to the client of the current
+    request; detail must be JSON serializable. Waits at most timeout seconds
+    for room on the queue, so async callers pass 0. Never raises.
+    """
+    if remote_addr is None and has_request_context():
+        remote_addr = request.remote_addr
+    row = event_row(event, user_uid, username, remote_addr, detail)
+
+    # Processes without the writer thread, like CLI commands, write straight away
+    if QUEUE is None or _worker is None:
+        try:
+            with metrics.timed("audit_write"), nullcontext() if has_app_context() else _app.app_context():
+                write([row])
+        except Exception as e:
+            logger.error("Audit write of %s failed: %s", event, e)
+        return
+
+    try:
+        if timeout:
+            QUEUE.put(row, timeout=timeout)
+        else:
+            QUEUE.put_nowait(row)
+    except queue.Full:
+        AUDIT_EVENTS_DROPPED.inc()
+        logger.error("Audit queue full, dropped %s event for %s", event, user_uid or username)
+        return
+    if QUEUE.qsize() >= AUDIT_BATCH_SIZE:
+        _batch_ready.set()
+
+
+def _take(limit):
+    rows = []
+    try:
+        while len(rows) < limit:
+            rows.append(QUEUE.get_nowait())
+    except queue.Empty:
+        pass
+    return rows
+
+
+def flush():
+    """Write every queued event; returns the number written"""
+    global _retry
+    if QUEUE is None:
+        return 0
+    written = 0
+    with _flush_lock:
+        _batch_ready.clear()
+        while True:
+            rows, _retry = _retry or _take(AUDIT_BATCH_SIZE), []
+            if not rows:
+                return written
+
+            start = time.perf_counter()
+            try:
+                with _app.app_context():
+                    write(rows)
+            except Exception:
+                _retry = rows
+                AUDIT_FLUSHES.labels("error").inc()
+                raise
+            finally:
+                AUDIT_FLUSH_SECONDS.observe(time.perf_counter() - start)
+            AUDIT_FLUSHES.labels("ok").inc()
+            written += len(rows)
+
+
+def _flush_forever(interval):
+    while True:
+        _batch_ready.wait(interval)
+        try:
+            flush()
+        except Exception as e:
+            logger.error("Audit flush failed, retrying next interval: %s", e)
+
+
+def _flush_at_exit():
+    try:
+        written = flush()
+        if written:
+            logger.info("Flushed %s audit events at exit", written)
+    except Exception as e:
+        logger.error("Audit flush at exit failed, %s events lost: %s", len(_retry) + QUEUE.qsize(), e)
+
+
+def init_app(app):
+    """Write events recorded outside an app context, such as by the ASGI routes, with app's database"""
+    global _app
+    _app = app
+
+
+def start_worker(app, interval=AUDIT_FLUSH_INTERVAL):
+    """Write queued events every interval seconds in a daemon thread, and at exit"""
+    global _worker
+    init_app(app)
+    if QUEUE is None or _worker is not None:
+        return
+    _worker = threading.Thread(target=_flush_forever, args=(interval,), name="audit-writer", daemon=True)
+    _worker.start()
+    atexit.register(_flush_at_exit)
+    logger.info("Audit writer started, flushing every %ss", interval)
+
+
+def recent_events(user_uid=None, since=None, before=None, before_id=None, limit=100):
+    """
+    Audit events newest first, of one user or everyone, back to since and
+    older than before; before and before_id of the last event of a page
+    continue after it. Returns the events as dicts and the (before,
+    before_id) of the next page, or None.
+    """
+    if since is None:
+        since = (datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+                 - datetime.timedelta(days=AUDIT_QUERY_DAYS))
+    table = AuditEvent.__table__
+    query = select(table).where(table.c.occurred_at >= since)
+    if user_uid:
+        query = query.where(table.c.user_uid == user_uid)
+    if before and before_id is not None:
+        query = query.where(tuple_(table.c.occurred_at, table.c.id) < tuple_(before, before_id))
+    elif before:
+        query = query.where(table.c.occurred_at < before)
+    query = query.order_by(table.c.occurred_at.desc(), table.c.id.desc())
+
+    limit = max(1, min(limit, AUDIT_QUERY_MAX_LIMIT))
+    # One extra row tells whether another page follows
+    rows = db.session.execute(query.limit(limit + 1)).all()
+    events = []
+    for row in rows[:limit]:
+        event = dict(row._mapping)
+        event["occurred_at"] = event["occurred_at"].isoformat()
+        event["detail"] = json.loads(event["detail"]) if event["detail"] else None
+        events.append(event)
+    next_before = (rows[limit - 1].occurred_at, rows[limit - 1].id) if len(rows) > limit else None
+    return events, next_before
@@ -0,0 +1,525 @@
+"""
+WebAuthn challenge storage
+
+A challenge is issued when a ceremony starts and must come back exactly once
+when the browser answers. Stores keep the raw challenge bytes under a key for
+a limited time and hand them back through ``consume``, which reads and
+removes the value in a single step so a challenge can never be replayed.
+"""
+
+import base64
+import hashlib
+import heapq
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from itsdangerous import BadSignature, URLSafeSerializer
+from redis.exceptions import ResponseError
+
+logger = logging.getLogger(__name__)
+
+# Challenges are only valid for the length of a ceremony
+CHALLENGE_TTL = int(os.getenv("CHALLENGE_TTL", "600"))
+
+# Bounds for the in-process fallback cache
+CHALLENGE_CACHE_MAX_ENTRIES = int(os.getenv("CHALLENGE_CACHE_MAX_ENTRIES", "100000"))
+CHALLENGE_CACHE_STRIPES = int(os.getenv("CHALLENGE_CACHE_STRIPES", "16"))
+CHALLENGE_CACHE_SWEEP_INTERVAL = float(os.getenv("CHALLENGE_CACHE_SWEEP_INTERVAL", "30"))
+
+
+class ChallengeStore:
+    """Interface shared by all challenge backends"""
+
+    def put(self, key, challenge, ttl=CHALLENGE_TTL):
+        """Store a challenge under key, replacing any previous value"""
+        raise NotImplementedError
+
+    def consume(self, key):
+        """Return the challenge stored under key and remove it, or None"""
+        raise NotImplementedError
+
+    def discard(self, key):
+        """Remove the challenge stored under key, if any"""
+        raise NotImplementedError
+
+    def reserve(self, key, owner, ttl=CHALLENGE_TTL):
+        """Store owner under key only if the key is free; True if it was"""
+        raise NotImplementedError
+
+    def release(self, key, owner):
+        """Remove the reservation under key if it is still held by owner"""
+        raise NotImplementedError
+
+    def advance(self, key, value, floor, ttl):
+        """
+        Raise the counter under key to value if value is greater than both
+        the counter and floor, which stands in for a missing counter; True if
+        it was raised
+        """
+        raise NotImplementedError
+
+
+class RedisChallengeStore(ChallengeStore):
+    """
+    Challenge store backed by Redis.
+
+    Values are stored as the raw challenge bytes and expire through the Redis
+    TTL, so no envelope or timestamp needs to be encoded. The client must be
+    created with ``decode_responses=False``.
+    """
+
+    # Used on servers older than Redis 6.2, which have no GETDEL
+    CONSUME_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if value then
+    redis.call('DEL', KEYS[1])
+end
+return value
+"""
+
+    # Deletes a reservation only if it wasn't taken over after expiring
+    RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+    # Compares and sets a counter in one step, so two logins racing with the
+    # same count can't both advance it
+    ADVANCE_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or ARGV[2])
+if tonumber(ARGV[1]) > math.max(current, tonumber(ARGV[2])) then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+    return 1
+end
+return 0
+"""
+
+    def __init__(self, client, prefix="webauthn_challenge:"):
+        self.client = client
+        self.prefix = prefix
+        self._use_getdel = True
+        self._consume_script = None
+        self._release_script = None
+        self._advance_script = None
+
+    def _key(self, key):
+        return f"{self.prefix}{key}"
+
+    def put(self, key, challenge, ttl=CHALLENGE_TTL):
+        with metrics.redis_command("set"):
+            self.client.set(self._key(key), challenge, ex=ttl)
+
+    def consume(self, key):
+        if self._use_getdel:
+            try:
+                with metrics.redis_command("getdel"):
+                    return self.client.getdel(self._key(key))
+            except ResponseError as e:
+                if "unknown command" not in str(e).lower():
+                    raise
+                logger.info("Redis server has no GETDEL, consuming challenges with a Lua script")
+                self._use_getdel = False
+
+        if self._consume_script is None:
+            self._consume_script = self.client.register_script(self.CONSUME_SCRIPT)
+        with metrics.redis_command("evalsha"):
+            return self._consume_script(keys=[self._key(key)])
+
+    def discard(self, key):
+        with metrics.redis_command("del"):
+            self.client.delete(self._key(key))
+
+    def reserve(self, key, owner, ttl=CHALLENGE_TTL):
+        with metrics.redis_command("set"):
+            return bool(self.client.set(self._key(key), owner, ex=ttl, nx=True))
+
+    def release(self, key, owner):
+        if self._release_script is None:
+            self._release_script = self.client.register_script(self.RELEASE_SCRIPT)
+        with metrics.redis_command("evalsha"):
+            self._release_script(keys=[self._key(key)], args=[owner])
+
+    def advance(self, key, value, floor, ttl):
+        if self._advance_script is None:
+            self._advance_script = self.client.register_script(self.ADVANCE_SCRIPT)
+        with metrics.redis_command("evalsha"):
+            return bool(self._advance_script(keys=[self._key(key)], args=[value, floor, ttl]))
+
+
+class _Shard:
+    """One lock-protected slice of the in-process challenge cache"""
+
+    __slots__ = ("lock", "entries", "expiries", "hits", "misses", "evictions", "expirations")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> (expires_at, challenge), oldest insertion first
+        self.entries = OrderedDict()
+        # heap of (expires_at, key); may hold stale records for keys that
+        # were consumed or overwritten, which are skipped when popped
+        self.expiries = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def sweep(self, now):
+        """Drop expired entries, oldest deadline first"""
+        expiries = self.expiries
+        entries = self.entries
+        while expiries and expiries[0][0] <= now:
+            expires_at, key = heapq.heappop(expiries)
+            entry = entries.get(key)
+            if entry is not None and entry[0] == expires_at:
+                del entries[key]
+                self.expirations += 1
+
+        # Stale heap records pile up when challenges are consumed before they
+        # expire; rebuild the heap once they outnumber the live entries
+        if len(expiries) > 2 * len(entries) + 64:
+            self.expiries = [(expires_at, key) for key, (expires_at, _) in entries.items()]
+            heapq.heapify(self.expiries)
+
+
+class MemoryChallengeStore(ChallengeStore):
+    """
+    Bounded, thread-safe in-process challenge cache.
+
+    Keys are spread over independently locked shards so concurrent ceremonies
+    don't serialize on one lock. Each shard holds at most its share of
+    ``max_entries`` and evicts its oldest challenge when full, and expired
+    challenges are swept from a deadline heap on every write and periodically
+    by a background thread, so abandoned ceremonies don't accumulate.
+
+    Only suitable for a single process, e.g. local development without Redis.
+    """
+
+    def __init__(self, max_entries=CHALLENGE_CACHE_MAX_ENTRIES, stripes=CHALLENGE_CACHE_STRIPES,
+                 sweep_interval=CHALLENGE_CACHE_SWEEP_INTERVAL):
+        self._shards = [_Shard() for _ in range(stripes)]
+        self._shard_capacity = max(1, max_entries // stripes)
+        self._sweep_interval = sweep_interval
+        self._sweeper = None
+        self._sweeper_lock = threading.Lock()
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _ensure_sweeper(self):
+        if self._sweeper is not None or not self._sweep_interval:
+            return
+        with self._sweeper_lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(
+                    target=self._sweep_forever, name="challenge-cache-sweeper", daemon=True
+                )
+                self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self._sweep_interval)
+            self.sweep()
+
+    def after_fork(self):
+        """Start a new sweeper in a forked child; the parent's isn't running there"""
+        self._sweeper = None
+        self._sweeper_lock = threading.Lock()
+
+    def sweep(self):
+        """Remove every expired challenge"""
+        now = time.monotonic()
+        for shard in self._shards:
+            with shard.lock:
+                shard.sweep(now)
+
+    def _insert(self, shard, key, value, expires_at):
+        """Add an entry to a locked shard, evicting the oldest if it is full"""
+        entries = shard.entries
+        entries.pop(key, None)
+        while len(entries) >= self._shard_capacity:
+            entries.popitem(last=False)
+            shard.evictions += 1
+        entries[key] = (expires_at, value)
+        heapq.heappush(shard.expiries, (expires_at, key))
+
+    def put(self, key, challenge, ttl=CHALLENGE_TTL):
+        self._ensure_sweeper()
+        now = time.monotonic()
+        shard = self._shard(key)
+        with shard.lock:
+            shard.sweep(now)
+            self._insert(shard, key, challenge, now + ttl)
+
+    def consume(self, key):
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.pop(key, None)
+            if entry is None:
+                shard.misses += 1
+                return None
+            if entry[0] <= time.monotonic():
+                shard.expirations += 1
+                shard.misses += 1
+                return None
+            shard.hits += 1
+        return entry[1]
+
+    def discard(self, key):
+        shard = self._shard(key)
+        with shard.lock:
+            shard.entries.pop(key, None)
+
+    def reserve(self, key, owner, ttl=CHALLENGE_TTL):
+        self._ensure_sweeper()
+        now = time.monotonic()
+        shard = self._shard(key)
+        with shard.lock:
+            shard.sweep(now)
+            if key in shard.entries:
+                return False
+            self._insert(shard, key, owner, now + ttl)
+        return True
+
+    def release(self, key, owner):
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is not None and entry[1] == owner:
+                del shard.entries[key]
+
+    def advance(self, key, value, floor, ttl):
+        self._ensure_sweeper()
+        now = time.monotonic()
+        shard = self._shard(key)
+        with shard.lock:
+            shard.sweep(now)
+            entry = shard.entries.get(key)
+            current = entry[1] if entry is not None else floor
+            if value <= max(current, floor):
+                return False
+            self._insert(shard, key, value, now + ttl)
+        return True
+
+    def stats(self):
+        """Hit, miss, eviction, expiration and size counters"""
+        totals = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "size": 0}
+        for shard in self._shards:
+            with shard.lock:
+                totals["hits"] += shard.hits
+                totals["misses"] += shard.misses
+                totals["evictions"] += shard.evictions
+                totals["expirations"] += shard.expirations
+                totals["size"] += len(shard.entries)
+        totals["max_size"] = self._shard_capacity * len(self._shards)
+        return totals
+
+
+class AsyncRedisChallengeStore:
+    """
+    ``RedisChallengeStore`` for asyncio code, on a ``redis.asyncio`` client
+    created with ``decode_responses=False``. Keys and values are the same,
+    so both stores can serve one ceremony.
+    """
+
+    def __init__(self, client, prefix="webauthn_challenge:"):
+        self.client = client
+        self.prefix = prefix
+        self._use_getdel = True
+        self._consume_script = None
+        self._release_script = None
+        self._advance_script = None
+
+    def _key(self, key):
+        return f"{self.prefix}{key}"
+
+    async def put(self, key, challenge, ttl=CHALLENGE_TTL):
+        with metrics.redis_command("set"):
+            await self.client.set(self._key(key), challenge, ex=ttl)
+
+    async def consume(self, key):
+        if self._use_getdel:
+            try:
+                with metrics.redis_command("getdel"):
+                    return await self.client.getdel(self._key(key))
+            except ResponseError as e:
+                if "unknown command" not in str(e).lower():
+                    raise
+                logger.info("Redis server has no GETDEL, consuming challenges with a Lua script")
+                self._use_getdel = False
+
+        if self._consume_script is None:
+            self._consume_script = self.client.register_script(RedisChallengeStore.CONSUME_SCRIPT)
+        with metrics.redis_command("evalsha"):
+            return await self._consume_script(keys=[self._key(key)])
+
+    async def discard(self, key):
+        with metrics.redis_command("del"):
+            await self.client.delete(self._key(key))
+
+    async def reserve(self, key, owner, ttl=CHALLENGE_TTL):
+        with metrics.redis_command("set"):
+            return bool(await self.client.set(self._key(key), owner, ex=ttl, nx=True))
+
+    async def release(self, key, owner):
+        if self._release_script is None:
+            self._release_script = self.client.register_script(RedisChallengeStore.RELEASE_SCRIPT)
+        with metrics.redis_command("evalsha"):
+            await self._release_script(keys=[self._key(key)], args=[owner])
+
+    async def advance(self, key, value, floor, ttl):
+        if self._advance_script is None:
+            self._advance_script = self.client.register_script(RedisChallengeStore.ADVANCE_SCRIPT)
+        with metrics.redis_command("evalsha"):
+            return bool(await self._advance_script(keys=[self._key(key)], args=[value, floor, ttl]))
+
+
+class AsyncMemoryChallengeStore:
+    """
+    Awaitable view of a ``MemoryChallengeStore``. Its operations never block
+    on I/O, so they run directly on the event loop.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    async def put(self, key, challenge, ttl=CHALLENGE_TTL):
+        self.store.put(key, challenge, ttl)
+
+    async def consume(self, key):
+        return self.store.consume(key)
+
+    async def discard(self, key):
+        self.store.discard(key)
+
+    async def reserve(self, key, owner, ttl=CHALLENGE_TTL):
+        return self.store.reserve(key, owner, ttl)
+
+    async def release(self, key, owner):
+        self.store.release(key, owner)
+
+    async def advance(self, key, value, floor, ttl):
+        return self.store.advance(key, value, floor, ttl)
+
+
+class _SignedTokens:
+    """
+    Challenges carried by the client in a signed, time-limited token.
+
+    Only one ceremony per session is carried at a time; starting another
+    replaces it. Consuming a challenge records a short hash of it in the
+    backing store for the rest of the token's life, so a token resent from
+    an old session cookie is refused.
+    """
+
+    SESSION_KEY = "challenge_token"
+    SALT = "webauthn-challenge"
+
+    def __init__(self, backing, get_session, get_secret_key):
+        self.backing = backing
+        self._get_session = get_session
+        self._get_secret_key = get_secret_key
+        self._serializer = None
+
+    def _signer(self):
+        if self._serializer is None:
+            self._serializer = URLSafeSerializer(self._get_secret_key(), salt=self.SALT)
+        return self._serializer
+
+    def _issue(self, key, challenge, ttl):
+        value = base64.urlsafe_b64encode(challenge).decode("ascii")
+        self._get_session()[self.SESSION_KEY] = self._signer().dumps([key, value, int(time.time()) + ttl])
+
+    def _open(self, key):
+        """Take the session's token for key; its challenge and seconds left, or None"""
+        session = self._get_session()
+        token = session.pop(self.SESSION_KEY, None)
+        if not token:
+            return None
+        try:
+            token_key, value, expires_at = self._signer().loads(token)
+        except (BadSignature, ValueError):
+            logger.warning("Rejected a challenge token with a bad signature")
+            return None
+        if token_key != key:
+            # Belongs to another ceremony of this session
+            session[self.SESSION_KEY] = token
+            return None
+        remaining = expires_at - int(time.time())
+        if remaining <= 0:
+            return None
+        return base64.urlsafe_b64decode(value), remaining
+
+    @staticmethod
+    def replay_key(challenge):
+        """Store key marking a challenge as used"""
+        return "used:" + base64.urlsafe_b64encode(hashlib.sha256(challenge).digest()[:16]).decode("ascii")
+
+
+class SignedChallengeStore(_SignedTokens, ChallengeStore):
+    """
+    Challenge store keeping each ceremony's challenge in the session rather
+    than in the backing store, so starting a ceremony costs no round trip
+    and finishing one costs a single SET NX. get_session returns the current
+    session mapping and get_secret_key the key tokens are signed with.
+    Reservations and counters go to the backing store.
+    """
+
+    def put(self, key, challenge, ttl=CHALLENGE_TTL):
+        self._issue(key, challenge, ttl)
+
+    def consume(self, key):
+        opened = self._open(key)
+        if opened is None:
+            return None
+        challenge, remaining = opened
+        if not self.backing.reserve(self.replay_key(challenge), b"1", remaining):
+            logger.warning("Rejected a replayed challenge token")
+            return None
+        return challenge
+
+    def discard(self, key):
+        self._open(key)
+
+    def reserve(self, key, owner, ttl=CHALLENGE_TTL):
+        return self.backing.reserve(key, owner, ttl)
+
+    def release(self, key, owner):
+        self.backing.release(key, owner)
+
+    def advance(self, key, value, floor, ttl):
+        return self.backing.advance(key, value, floor, ttl)
+
+
+class AsyncSignedChallengeStore(_SignedTokens):
+    """``SignedChallengeStore`` over an async backing store"""
+
+    async def put(self, key, challenge, ttl=CHALLENGE_TTL):
+        self._issue(key, challenge, ttl)
+
+    async def consume(self, key):
+        opened = self._open(key)
+        if opened is None:
+            return None
+        challenge, remaining = opened
+        if not await self.backing.reserve(self.replay_key(challenge), b"1", remaining):
+            logger.warning("Rejected a replayed challenge token")
+            return None
+        return challenge
+
+    async def discard(self, key):
+        self._open(key)
+
+    async def reserve(self, key, owner, ttl=CHALLENGE_TTL):
+        return await self.backing.reserve(key, owner, ttl)
+
+    async def release(self, key, owner):
+        await self.backing.release(key, owner)
+
+    async def advance(self, key, value, floor, ttl):
+        return await self.backing.advance(key, value, floor, ttl)
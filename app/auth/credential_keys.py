@@ -0,0 +1,252 @@
+"""
+Decoded credential public key cache
+
+``webauthn.verify_authentication_response`` decodes the stored COSE public
+key and builds a cryptography key object on every login. This module keeps
+the decoded keys of recently used credentials in a per-process LRU cache,
+keyed by credential ID, and verifies assertions with the cached key.
+
+An entry also holds the COSE bytes it was decoded from and is only used
+while they match the stored key, so a credential that was replaced, or
+changed by another process, is decoded afresh instead of verified with a
+stale key. Deleting credentials invalidates their entries, which only frees
+the memory: a deleted credential is never looked up.
+
+PUBLIC_KEY_CACHE_SIZE bounds the number of keys held; 0 disables the cache.
+
+The verification copies webauthn 2.7's, which requirements.txt pins to that
+release; tests/test_credential_keys.py checks that both agree.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import metrics
+import webauthn
+from cryptography.exceptions import InvalidSignature
+from webauthn.authentication.verify_authentication_response import (
+    VerifiedAuthentication,
+    expected_token_binding_statuses,
+)
+from webauthn.helpers import (
+    bytes_to_base64url,
+    byteslike_to_bytes,
+    decode_credential_public_key,
+    decoded_public_key_to_cryptography,
+    parse_authentication_credential_json,
+    parse_authenticator_data,
+    parse_backup_flags,
+    parse_client_data_json,
+    verify_signature,
+)
+from webauthn.helpers.exceptions import InvalidAuthenticationResponse
+from webauthn.helpers.structs import ClientDataType, PublicKeyCredentialType
+
+PUBLIC_KEY_CACHE_SIZE = int(os.getenv("PUBLIC_KEY_CACHE_SIZE", "10000"))
+
+PUBLIC_KEY_CACHE = metrics.Gauge(
+    "webauthn_public_key_cache", "Decoded public key cache counters and size", ("stat",)
+)
+
+
+class PublicKeyCache:
+    """Bounded LRU cache of decoded credential public keys"""
+
+    def __init__(self, max_entries=PUBLIC_KEY_CACHE_SIZE):
+        self.max_entries = max_entries
+        # credential ID -> (COSE bytes, COSE algorithm, cryptography key)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, credential_id, credential_public_key):
+        """
+        The COSE algorithm and cryptography key of a credential, decoding and
+        caching credential_public_key unless it is already cached
+        """
+        with self._lock:
+            entry = self._entries.get(credential_id)
+            if entry is not None and entry[0] == credential_public_key:
+                self._entries.move_to_end(credential_id)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+
+        # Decoded outside the lock; two threads missing on the same key at
+        # once both decode it, which is harmless
+        decoded = decode_credential_public_key(credential_public_key)
+        key = decoded_public_key_to_cryptography(decoded)
+
+        with self._lock:
+            self._entries[credential_id] = (credential_public_key, decoded.alg, key)
+            self._entries.move_to_end(credential_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return decoded.alg, key
+
+    def invalidate(self, credential_ids):
+        """Drop the cached keys of these credentials"""
+        with self._lock:
+            for credential_id in credential_ids:
+                if self._entries.pop(credential_id, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        """Drop every cached key"""
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        """Hit, miss, eviction, invalidation and size counters"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "size": len(self._entries),
+                "max_size": self.max_entries,
+            }
+
+
+CACHE = PublicKeyCache() if PUBLIC_KEY_CACHE_SIZE > 0 else None
+
+if CACHE is not None:
+    for _stat in ("hits", "misses", "evictions", "invalidations", "size", "max_size"):
+        PUBLIC_KEY_CACHE.labels(_stat).set_function(lambda stat=_stat: CACHE.stats()[stat])
+
+
+def invalidate(credential_ids):
+    """Drop cached keys of credentials that were deleted or replaced"""
+    if CACHE is not None:
+        CACHE.invalidate(credential_ids)
+
+
+def clear():
+    """Drop every cached key, e.g. after the credential table was replaced"""
+    if CACHE is not None:
+        CACHE.clear()
+
+
+def verify_authentication_response(
+    *,
+    credential,
+    expected_challenge,
+    expected_rp_id,
+    expected_origin,
+    credential_public_key,
+    credential_current_sign_count,
+    require_user_verification=False,
+):
+    """
+    ``webauthn.verify_authentication_response`` with the credential's public
+    key taken from the cache. The checks are those of webauthn 2.7, in the
+    same order and raising the same errors.
+    """
+    if CACHE is None:
+        return webauthn.verify_authentication_response(
+            credential=credential,
+            expected_challenge=expected_challenge,
+            expected_rp_id=expected_rp_id,
+            expected_origin=expected_origin,
+            credential_public_key=credential_public_key,
+            credential_current_sign_count=credential_current_sign_count,
+            require_user_verification=require_user_verification,
+        )
+
+    if isinstance(credential, (str, dict)):
+        credential = parse_authentication_credential_json(credential)
+
+    if bytes_to_base64url(credential.raw_id) != credential.id:
+        raise InvalidAuthenticationResponse("id and raw_id were not equivalent")
+
+    if credential.type != PublicKeyCredentialType.PUBLIC_KEY:
+        raise InvalidAuthenticationResponse(
+            f'Unexpected credential type "{credential.type}", expected "public-key"'
+        )
+
+    response = credential.response
+    client_data_bytes = byteslike_to_bytes(response.client_data_json)
+    authenticator_data_bytes = byteslike_to_bytes(response.authenticator_data)
+    signature_bytes = byteslike_to_bytes(response.signature)
+
+    client_data = parse_client_data_json(client_data_bytes)
+
+    if client_data.type != ClientDataType.WEBAUTHN_GET:
+        raise InvalidAuthenticationResponse(
+            f'Unexpected client data type "{client_data.type}", expected "{ClientDataType.WEBAUTHN_GET}"'
+        )
+
+    if expected_challenge != client_data.challenge:
+        raise InvalidAuthenticationResponse("Client data challenge was not expected challenge")
+
+    if isinstance(expected_origin, str):
+        if expected_origin != client_data.origin:
+            raise InvalidAuthenticationResponse(
+                f'Unexpected client data origin "{client_data.origin}", expected "{expected_origin}"'
+            )
+    elif client_data.origin not in expected_origin:
+        raise InvalidAuthenticationResponse(
+            f'Unexpected client data origin "{client_data.origin}", expected one of {expected_origin}'
+        )
+
+    if client_data.token_binding:
+        status = client_data.token_binding.status
+        if status not in expected_token_binding_statuses:
+            raise InvalidAuthenticationResponse(
+                f'Unexpected token_binding status of "{status}", expected one of '
+                f'"{",".join(expected_token_binding_statuses)}"'
+            )
+
+    auth_data = parse_authenticator_data(authenticator_data_bytes)
+
+    if auth_data.rp_id_hash != hashlib.sha256(expected_rp_id.encode("utf-8")).digest():
+        raise InvalidAuthenticationResponse("Unexpected RP ID hash")
+
+    if not auth_data.flags.up:
+        raise InvalidAuthenticationResponse("User was not present during authentication")
+
+    if require_user_verification and not auth_data.flags.uv:
+        raise InvalidAuthenticationResponse(
+            "User verification is required but user was not verified during authentication"
+        )
+
+    if (
+        auth_data.sign_count > 0 or credential_current_sign_count > 0
+    ) and auth_data.sign_count <= credential_current_sign_count:
+        # A counter that didn't move forward may be a cloned authenticator
+        # or a replay
+        raise InvalidAuthenticationResponse(
+            f"Response sign count of {auth_data.sign_count} was not greater than current count of "
+            f"{credential_current_sign_count}"
+        )
+
+    signature_base = authenticator_data_bytes + hashlib.sha256(client_data_bytes).digest()
+
+    try:
+        alg, public_key = CACHE.get(credential.raw_id, credential_public_key)
+        verify_signature(
+            public_key=public_key,
+            signature_alg=alg,
+            signature=signature_bytes,
+            data=signature_base,
+        )
+    except InvalidSignature:
+        raise InvalidAuthenticationResponse("Could not verify authentication signature") from None
+
+    parsed_backup_flags = parse_backup_flags(auth_data.flags)
+
+    return VerifiedAuthentication(
+        credential_id=credential.raw_id,
+        new_sign_count=auth_data.sign_count,
+        credential_device_type=parsed_backup_flags.credential_device_type,
+        credential_backed_up=parsed_backup_flags.credential_backed_up,
+        user_verified=auth_data.flags.uv,
+    )
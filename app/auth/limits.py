@@ -0,0 +1,318 @@
+"""
+Admission control for the registration endpoints
+
+Requests to the limited endpoints are admitted in two steps, both before any
+database or verification work:
+
+1. A per-process cap on requests in progress (CEREMONY_MAX_CONCURRENCY).
+   When it's reached the request is turned away at once with 503, rather
+   than queued behind verifications it would only slow down further.
+2. Token buckets per client IP and, where the endpoint has them, per
+   username and email. Each bucket holds up to its burst of tokens and
+   refills at its rate per minute; a request takes one token from every
+   bucket that applies, or from none if any is empty, and is then answered
+   with 429 and the seconds until it would be admitted.
+
+Buckets live in Redis, checked and updated for all of a request's keys in
+one Lua script, so every process enforces the same limits. Usernames and
+emails are hashed into the keys. While Redis is unavailable (see
+auth.resilience) each process enforces the limits on its own, with buckets
+in memory, so the limits are only loosened by the number of processes.
+A request that finds every pooled Redis connection busy is turned away
+with 503 instead, and doesn't count against the breaker.
+
+A burst or rate of 0 turns that limit off, as does CEREMONY_MAX_CONCURRENCY=0.
+Clients are identified by the address the server sees; behind a proxy that
+is the proxy's.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+from auth import resilience, security
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_IP_BURST = int(os.getenv("RATE_LIMIT_IP_BURST", "20"))
+RATE_LIMIT_IP_PER_MINUTE = float(os.getenv("RATE_LIMIT_IP_PER_MINUTE", "30"))
+RATE_LIMIT_IDENTITY_BURST = int(os.getenv("RATE_LIMIT_IDENTITY_BURST", "5"))
+RATE_LIMIT_IDENTITY_PER_MINUTE = float(os.getenv("RATE_LIMIT_IDENTITY_PER_MINUTE", "5"))
+# Bound on the buckets the in-process fallback keeps
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+CEREMONY_MAX_CONCURRENCY = int(os.getenv("CEREMONY_MAX_CONCURRENCY", "32"))
+
+ADMISSION_REJECTIONS = metrics.Counter(
+    "webauthn_admission_rejections_total", "Requests turned away by admission control", ("endpoint", "reason")
+)
+CEREMONIES_IN_PROGRESS = metrics.Gauge(
+    "webauthn_ceremonies_in_progress", "Limited requests currently admitted in this process"
+)
+
+# Takes a token from every bucket in KEYS, or from none if any is empty.
+# ARGV holds a refill rate per second and a burst for each key. Returns 1,
+# or 0 and the seconds until the emptiest bucket has a token, as a string.
+TOKEN_BUCKET_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local burst = tonumber(ARGV[2 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = burst
+    if state[1] then
+        available = math.min(burst, tonumber(state[1]) + math.max(0, now - tonumber(state[2])) * rate)
+    end
+    tokens[i] = available
+    if available < 1 then
+        wait = math.max(wait, (1 - available) / rate)
+    end
+end
+if wait > 0 then
+    return {0, tostring(wait)}
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local burst = tonumber(ARGV[2 * i])
+    redis.call('HSET', key, 'tokens', tokens[i] - 1, 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000))
+end
+return {1, '0'}
+"""
+
+
+def identity_key(identity):
+    """Bucket key part for a username or email, which isn't stored as such"""
+    return hashlib.sha256(identity.strip().lower().encode()).hexdigest()[:32]
+
+
+def buckets_for(endpoint, ip, identities=()):
+    """(key, rate per second, burst) of each bucket a request takes a token from"""
+    buckets = []
+    if RATE_LIMIT_IP_BURST > 0 and RATE_LIMIT_IP_PER_MINUTE > 0 and ip:
+        buckets.append((f"{endpoint}:ip:{ip}", RATE_LIMIT_IP_PER_MINUTE / 60, RATE_LIMIT_IP_BURST))
+    if RATE_LIMIT_IDENTITY_BURST > 0 and RATE_LIMIT_IDENTITY_PER_MINUTE > 0:
+        for identity in identities:
+            if identity:
+                buckets.append((
+                    f"{endpoint}:identity:{identity_key(identity)}",
+                    RATE_LIMIT_IDENTITY_PER_MINUTE / 60,
+                    RATE_LIMIT_IDENTITY_BURST,
+                ))
+    return buckets
+
+
+class MemoryTokenBuckets:
+    """Token buckets for one process, in a bounded LRU"""
+
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        # key -> (tokens, updated at)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, buckets):
+        """
+        Take a token from every bucket, or none; returns 0, or the seconds
+        to wait if any bucket is empty
+        """
+        with self._lock:
+            now = self.clock()
+            available = []
+            wait = 0.0
+            for key, rate, burst in buckets:
+                state = self._buckets.get(key)
+                tokens = burst if state is None else min(burst, state[0] + (now - state[1]) * rate)
+                available.append(tokens)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+            if wait:
+                return wait
+
+            for (key, _rate, _burst), tokens in zip(buckets, available):
+                self._buckets[key] = (tokens - 1, now)
+                self._buckets.move_to_end(key)
+            # Evicting the least recently used bucket only forgives a
+            # client that has been quiet the longest
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return 0.0
+
+
+class RedisTokenBuckets:
+    """Token buckets shared by every process, in Redis"""
+
+    def __init__(self, client, prefix="webauthn_rate:"):
+        self.client = client
+        self.prefix = prefix
+        self._script = None
+
+    def _arguments(self, buckets):
+        keys = [f"{self.prefix}{key}" for key, _rate, _burst in buckets]
+        args = [value for _key, rate, burst in buckets for value in (rate, burst)]
+        return keys, args
+
+    def take(self, buckets):
+        if self._script is None:
+            self._script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+        keys, args = self._arguments(buckets)
+        with metrics.redis_command("evalsha"):
+            allowed, wait = self._script(keys=keys, args=args)
+        return 0.0 if allowed else float(wait)
+
+
+class AsyncRedisTokenBuckets(RedisTokenBuckets):
+    """``RedisTokenBuckets`` on a ``redis.asyncio`` client"""
+
+    async def take(self, buckets):
+        if self._script is None:
+            self._script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+        keys, args = self._arguments(buckets)
+        with metrics.redis_command("evalsha"):
+            allowed, wait = await self._script(keys=keys, args=args)
+        return 0.0 if allowed else float(wait)
+
+
+class RateLimiter:
+    """Redis token buckets behind the store's breaker, with local ones to fall back on"""
+
+    def __init__(self, primary, fallback, breaker=resilience.BREAKER):
+        self.primary = primary
+        self.fallback = fallback
+        self.breaker = breaker
+
+    def take(self, buckets):
+        if not buckets:
+            return 0.0
+        if self.primary is not None and self.breaker.allow():
+            try:
+                wait = self.primary.take(buckets)
+            except resilience.UNAVAILABLE_ERRORS as e:
+                if resilience.pool_exhausted(e):
+                    resilience.shed("rate_limit", e, self.breaker)
+                logger.warning("Redis rate limit check failed: %s", e)
+                self.breaker.failure()
+            except Exception:
+                self.breaker.success()
+                raise
+            else:
+                self.breaker.success()
+                return wait
+        if self.primary is not None:
+            resilience.REDIS_UNAVAILABLE.labels("rate_limit", "fail_open").inc()
+        return self.fallback.take(buckets)
+
+
+class AsyncRateLimiter(RateLimiter):
+    """``RateLimiter`` on async Redis token buckets"""
+
+    async def take(self, buckets):
+        if not buckets:
+            return 0.0
+        if self.primary is not None and self.breaker.allow():
+            try:
+                wait = await self.primary.take(buckets)
+            except resilience.UNAVAILABLE_ERRORS as e:
+                if resilience.pool_exhausted(e):
+                    resilience.shed("rate_limit", e, self.breaker)
+                logger.warning("Redis rate limit check failed: %s", e)
+                self.breaker.failure()
+            except Exception:
+                self.breaker.success()
+                raise
+            else:
+                self.breaker.success()
+                return wait
+        if self.primary is not None:
+            resilience.REDIS_UNAVAILABLE.labels("rate_limit", "fail_open").inc()
+        return self.fallback.take(buckets)
+
+
+class ConcurrencyLimit:
+    """Non-blocking cap on requests in progress; a limit of 0 never refuses"""
+
+    def __init__(self, limit=CEREMONY_MAX_CONCURRENCY):
+        self.limit = limit
+        self.in_progress = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Admit a request if there's room; True if it was admitted"""
+        with self._lock:
+            if self.limit and self.in_progress >= self.limit:
+                return False
+            self.in_progress += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_progress -= 1
+
+
+FALLBACK = MemoryTokenBuckets()
+CONCURRENCY = ConcurrencyLimit()
+LIMITER = RateLimiter(
+    RedisTokenBuckets(security.redis_client) if security.redis_client is not None else None, FALLBACK
+)
+
+CEREMONIES_IN_PROGRESS.set_function(lambda: CONCURRENCY.in_progress)
+
+
+def admit(endpoint, ip, identities=()):
+    """
+    Admission for a request: None if it was admitted, in which case
+    ``done()`` must be called when it finishes, or the (status, seconds to
+    retry after) to refuse it with
+    """
+    if not CONCURRENCY.acquire():
+        ADMISSION_REJECTIONS.labels(endpoint, "concurrency").inc()
+        return 503, 1
+    try:
+        wait = LIMITER.take(buckets_for(endpoint, ip, identities))
+    except resilience.StoreBusy:
+        CONCURRENCY.release()
+        ADMISSION_REJECTIONS.labels(endpoint, "busy").inc()
+        return 503, 1
+    except BaseException:
+        CONCURRENCY.release()
+        raise
+    if wait:
+        CONCURRENCY.release()
+        ADMISSION_REJECTIONS.labels(endpoint, "rate").inc()
+        return 429, math.ceil(wait)
+    return None
+
+
+async def admit_async(limiter, endpoint, ip, identities=()):
+    """``admit`` with an ``AsyncRateLimiter``"""
+    if not CONCURRENCY.acquire():
+        ADMISSION_REJECTIONS.labels(endpoint, "concurrency").inc()
+        return 503, 1
+    try:
+        wait = await limiter.take(buckets_for(endpoint, ip, identities))
+    except resilience.StoreBusy:
+        CONCURRENCY.release()
+        ADMISSION_REJECTIONS.labels(endpoint, "busy").inc()
+        return 503, 1
+    except BaseException:
+        CONCURRENCY.release()
+        raise
+    if wait:
+        CONCURRENCY.release()
+        ADMISSION_REJECTIONS.labels(endpoint, "rate").inc()
+        return 429, math.ceil(wait)
+    return None
+
+
+def done():
+    """A request admitted by ``admit`` finished"""
+    CONCURRENCY.release()
@@ -0,0 +1,304 @@
+"""
+Authenticator metadata and attestation trust store
+
+Loads a FIDO Metadata Service (MDS3) blob from METADATA_PATH once and keeps
+it as an immutable snapshot: entries indexed by their 16-byte AAGUID, each
+holding its status and its attestation root certificates already converted
+to PEM, ready for ``verify_registration_response``. Identical roots are
+shared between entries. Authenticators identified only by certificate key
+identifiers (U2F) aren't indexed.
+
+The blob may be the JWT downloaded from the MDS or the JSON payload on its
+own. Its signature isn't checked here: the file is trusted as deployed, so
+fetch and verify it before putting it in place.
+
+The file is checked for changes every METADATA_RELOAD_INTERVAL seconds on
+lookup, and a changed file is loaded into a new snapshot that replaces the
+old one in a single assignment, so every worker picks up a new blob without
+a restart and lookups never wait on a load. A blob that fails to load leaves
+the previous snapshot in place.
+
+AUTHENTICATOR_POLICY decides which authenticators may register:
+
+- "any" (the default) accepts every authenticator, validating attestation
+  chains against the metadata roots when its AAGUID is known
+- "known" requires attestation chaining to the roots of an authenticator in
+  the metadata whose latest status isn't revoked or compromised
+
+ALLOWED_AAGUIDS, a comma-separated list, further restricts registration to
+those authenticators. Without the "known" policy the AAGUID it is checked
+against isn't attested.
+"""
+
+import base64
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+import metrics
+from cryptography import x509
+from cryptography.hazmat.primitives.serialization import Encoding
+from webauthn.helpers import parse_attestation_object
+from webauthn.helpers.exceptions import InvalidRegistrationResponse
+from webauthn.helpers.structs import AttestationConveyancePreference, AttestationFormat
+
+logger = logging.getLogger(__name__)
+
+METADATA_PATH = os.getenv("METADATA_PATH")
+METADATA_RELOAD_INTERVAL = float(os.getenv("METADATA_RELOAD_INTERVAL", "60"))
+AUTHENTICATOR_POLICY = os.getenv("AUTHENTICATOR_POLICY", "any").lower()
+ALLOWED_AAGUIDS = frozenset(
+    uuid.UUID(aaguid.strip()).bytes
+    for aaguid in os.getenv("ALLOWED_AAGUIDS", "").split(",") if aaguid.strip()
+)
+
+# Latest statuses that disqualify an authenticator under the "known" policy
+REVOKED_STATUSES = frozenset({
+    "REVOKED",
+    "USER_VERIFICATION_BYPASS",
+    "ATTESTATION_KEY_COMPROMISE",
+    "USER_KEY_REMOTE_COMPROMISE",
+    "USER_KEY_PHYSICAL_COMPROMISE",
+})
+
+# Formats whose statements may carry a certificate chain
+_CHAIN_FORMATS = tuple(fmt for fmt in AttestationFormat if fmt != AttestationFormat.NONE)
+
+METADATA_ENTRIES = metrics.Gauge(
+    "webauthn_metadata_entries", "Authenticators in the loaded metadata snapshot"
+)
+METADATA_LOADS = metrics.Counter(
+    "webauthn_metadata_loads_total", "Metadata blob loads by outcome", ("outcome",)
+)
+METADATA_LOAD_SECONDS = metrics.Histogram(
+    "webauthn_metadata_load_seconds", "Time to parse and index a metadata blob"
+)
+AUTHENTICATOR_REJECTIONS = metrics.Counter(
+    "webauthn_authenticator_rejections_total", "Registrations refused by the authenticator policy", ("reason",)
+)
+
+
+class MetadataEntry:
+    """What registration needs to know about one authenticator"""
+
+    __slots__ = ("description", "status", "roots_by_fmt")
+
+    def __init__(self, description, status, roots_by_fmt):
+        self.description = description
+        self.status = status
+        # {AttestationFormat: [PEM root, ...]} or None without roots
+        self.roots_by_fmt = roots_by_fmt
+
+    @property
+    def revoked(self):
+        return self.status in REVOKED_STATUSES
+
+
+class MetadataSnapshot:
+    """An indexed metadata blob; never modified once built"""
+
+    __slots__ = ("entries", "number", "next_update", "mtime", "size")
+
+    def __init__(self, entries, number=None, next_update=None, mtime=None, size=None):
+        self.entries = entries
+        self.number = number
+        self.next_update = next_update
+        self.mtime = mtime
+        self.size = size
+
+    def get(self, aaguid):
+        return self.entries.get(aaguid)
+
+
+EMPTY = MetadataSnapshot({})
+
+
+def _payload(blob):
+    """The JSON payload of an MDS blob, given as a JWT or plain JSON"""
+    blob = blob.strip()
+    if blob.startswith(b"{"):
+        return json.loads(blob)
+    try:
+        _header, payload, _signature = blob.split(b".")
+    except ValueError:
+        raise ValueError("Metadata blob is neither JSON nor a JWT") from None
+    return json.loads(base64.urlsafe_b64decode(payload + b"=" * (-len(payload) % 4)))
+
+
+def _latest_status(reports):
+    latest = None
+    for report in reports or ():
+        # ISO 8601 dates compare as strings; on a tie the later report wins
+        if latest is None or report.get("effectiveDate", "") >= latest.get("effectiveDate", ""):
+            latest = report
+    return latest.get("status") if latest else None
+
+
+def parse_blob(blob, mtime=None, size=None):
+    """Index the entries of an MDS blob (bytes) into a MetadataSnapshot"""
+    payload = _payload(blob)
+    # Many authenticators of one vendor share roots, so each distinct root is
+    # parsed once and each distinct set of roots is a single mapping
+    pem_by_der = {}
+    roots_by_set = {}
+    entries = {}
+
+    for raw_entry in payload.get("entries", ()):
+        aaguid = raw_entry.get("aaguid")
+        if not aaguid:
+            continue
+        statement = raw_entry.get("metadataStatement") or {}
+
+        pems = []
+        for root in statement.get("attestationRootCertificates", ()):
+            pem = pem_by_der.get(root)
+            if pem is None:
+                try:
+                    pem = x509.load_der_x509_certificate(base64.b64decode(root)).public_bytes(Encoding.PEM)
+                except ValueError as e:
+                    logger.warning("Skipping unreadable root certificate of %s: %s", aaguid, e)
+                    continue
+                pem_by_der[root] = pem
+            pems.append(pem)
+
+        roots_by_fmt = None
+        if pems:
+            key = tuple(pems)
+            roots_by_fmt = roots_by_set.get(key)
+            if roots_by_fmt is None:
+                roots_by_fmt = roots_by_set[key] = {fmt: list(key) for fmt in _CHAIN_FORMATS}
+
+        entries[uuid.UUID(aaguid).bytes] = MetadataEntry(
+            description=statement.get("description"),
+            status=_latest_status(raw_entry.get("statusReports")),
+            roots_by_fmt=roots_by_fmt,
+        )
+
+    return MetadataSnapshot(
+        entries,
+        number=payload.get("no"),
+        next_update=payload.get("nextUpdate"),
+        mtime=mtime,
+        size=size,
+    )
+
+
+class MetadataStore:
+    """The current snapshot of a metadata file, reloaded when it changes"""
+
+    def __init__(self, path, reload_interval=METADATA_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.snapshot = EMPTY
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load the file into a new snapshot; returns whether it was replaced"""
+        start = time.perf_counter()
+        try:
+            stat = os.stat(self.path)
+            with open(self.path, "rb") as f:
+                snapshot = parse_blob(f.read(), stat.st_mtime_ns, stat.st_size)
+        except Exception as e:
+            METADATA_LOADS.labels("error").inc()
+            logger.error("Failed to load metadata from %s: %s", self.path, e)
+            return False
+        finally:
+            METADATA_LOAD_SECONDS.observe(time.perf_counter() - start)
+
+        self.snapshot = snapshot
+        METADATA_LOADS.labels("ok").inc()
+        logger.info("Loaded metadata blob %s with %s authenticators from %s",
+                    snapshot.number, len(snapshot.entries), self.path)
+        return True
+
+    def _changed(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_mtime_ns, stat.st_size) != (self.snapshot.mtime, self.snapshot.size)
+
+    def current(self):
+        """The current snapshot, starting a reload first if it's time to check"""
+        if time.monotonic() >= self._next_check and self._lock.acquire(blocking=False):
+            # Only one thread checks; the others carry on with the old snapshot
+            try:
+                self._next_check = time.monotonic() + self.reload_interval
+                if self._changed():
+                    self.load()
+            finally:
+                self._lock.release()
+        return self.snapshot
+
+    def get(self, aaguid):
+        """The entry for a 16-byte AAGUID, or None"""
+        return self.current().get(aaguid)
+
+
+STORE = MetadataStore(METADATA_PATH) if METADATA_PATH else None
+
+if STORE is not None:
+    # Loaded up front so a bad blob shows at startup, and so a preloading
+    # server shares the snapshot with its workers
+    STORE.current()
+    METADATA_ENTRIES.set_function(lambda: len(STORE.snapshot.entries))
+
+
+def attestation_preference():
+    """The attestation to ask authenticators for"""
+    if AUTHENTICATOR_POLICY == "known" or ALLOWED_AAGUIDS:
+        return AttestationConveyancePreference.DIRECT
+    return AttestationConveyancePreference.NONE
+
+
+def _reject(reason, message):
+    AUTHENTICATOR_REJECTIONS.labels(reason).inc()
+    raise InvalidRegistrationResponse(message)
+
+
+def trust_anchors_for(registration_credential):
+    """
+    Apply the authenticator policy to a registration response before it is
+    verified, raising InvalidRegistrationResponse if its authenticator isn't
+    allowed. Returns the metadata roots to verify its attestation against,
+    as ``pem_root_certs_bytes_by_fmt``, or None.
+
+    The AAGUID and attestation checked here are those the verification then
+    checks the signature of, so a response that passes both is attested.
+    """
+    if STORE is None and AUTHENTICATOR_POLICY == "any" and not ALLOWED_AAGUIDS:
+        return None
+
+    try:
+        attestation = parse_attestation_object(registration_credential.response.attestation_object)
+    except Exception as e:
+        # Untrusted input, refused like any other bad registration
+        logger.info("Unparseable attestation object: %s", e)
+        _reject("malformed", "Attestation object could not be parsed")
+    credential_data = attestation.auth_data.attested_credential_data
+    aaguid = credential_data.aaguid if credential_data else None
+
+    if ALLOWED_AAGUIDS and aaguid not in ALLOWED_AAGUIDS:
+        _reject("not_allowed", "Authenticator is not allowed")
+
+    entry = STORE.get(aaguid) if STORE is not None and aaguid else None
+
+    if AUTHENTICATOR_POLICY == "known":
+        if attestation.fmt == AttestationFormat.NONE:
+            _reject("unattested", "Authenticator attestation is required")
+        if entry is None:
+            _reject("unknown", "Authenticator is not in the metadata")
+        if entry.revoked:
+            _reject("revoked", f"Authenticator status is {entry.status}")
+        if entry.roots_by_fmt is None:
+            _reject("no_roots", "Authenticator has no attestation roots in the metadata")
+        if attestation.fmt == AttestationFormat.PACKED and not attestation.att_stmt.x5c:
+            # Self attestation proves nothing about the authenticator
+            _reject("self_attested", "Authenticator attestation is required")
+
+    return entry.roots_by_fmt if entry is not None else None
@@ -0,0 +1,206 @@
+"""
+Credential payload decoding
+
+The JSON the browser posts for a registration or a login is decoded in one
+pass over a schema of its fields, straight into the webauthn library's
+structs. Nothing is copied or modified in place, and nothing is decoded
+before its size has been checked.
+
+Limits:
+
+- The request body is capped at CREDENTIAL_MAX_PAYLOAD_BYTES. A body that
+  declares a larger Content-Length is refused with 413 before any of it is
+  read, and a streamed body as soon as it exceeds the cap.
+- Each binary field has a bound on its decoded size, checked against the
+  length of its base64url text before it is decoded: 1023 bytes for a
+  credential ID and 64 for a user handle, as the WebAuthn spec allows, and
+  generous bounds for client data, authenticator data and signatures.
+  Attestation objects, which can carry certificate chains, are bounded by
+  CREDENTIAL_MAX_ATTESTATION_BYTES.
+- Strings must be unpadded or correctly padded base64url, the type must be
+  "public-key" and at most 8 transports are accepted. Unknown transports are
+  skipped.
+
+A payload that breaks any of these raises PayloadError, a ValueError whose
+message can be shown to the client.
+"""
+
+import binascii
+import logging
+import os
+import re
+
+import logs
+import metrics
+from werkzeug.exceptions import RequestEntityTooLarge
+from webauthn.helpers.structs import (
+    AuthenticationCredential,
+    AuthenticatorAssertionResponse,
+    AuthenticatorAttachment,
+    AuthenticatorAttestationResponse,
+    AuthenticatorTransport,
+    PublicKeyCredentialType,
+    RegistrationCredential,
+)
+
+logger = logging.getLogger(__name__)
+
+CREDENTIAL_MAX_PAYLOAD_BYTES = int(os.getenv("CREDENTIAL_MAX_PAYLOAD_BYTES", "65536"))
+CREDENTIAL_MAX_ATTESTATION_BYTES = int(os.getenv("CREDENTIAL_MAX_ATTESTATION_BYTES", "32768"))
+
+MAX_CREDENTIAL_ID_BYTES = 1023
+MAX_CLIENT_DATA_BYTES = 4096
+MAX_AUTHENTICATOR_DATA_BYTES = 4096
+MAX_SIGNATURE_BYTES = 1024
+MAX_USER_HANDLE_BYTES = 64
+MAX_TRANSPORTS = 8
+
+PAYLOAD_REJECTIONS = metrics.Counter(
+    "webauthn_payload_rejections_total", "Credential payloads refused by the decoder", ("ceremony", "reason")
+)
+
+# (JSON name, struct attribute, decoded size bound, required)
+ATTESTATION_RESPONSE_FIELDS = (
+    ("clientDataJSON", "client_data_json", MAX_CLIENT_DATA_BYTES, True),
+    ("attestationObject", "attestation_object", CREDENTIAL_MAX_ATTESTATION_BYTES, True),
+)
+ASSERTION_RESPONSE_FIELDS = (
+    ("clientDataJSON", "client_data_json", MAX_CLIENT_DATA_BYTES, True),
+    ("authenticatorData", "authenticator_data", MAX_AUTHENTICATOR_DATA_BYTES, True),
+    ("signature", "signature", MAX_SIGNATURE_BYTES, True),
+    ("userHandle", "user_handle", MAX_USER_HANDLE_BYTES, False),
+)
+
+_is_base64url = re.compile(r"[A-Za-z0-9_-]*={0,2}").fullmatch
+_TO_BASE64 = bytes.maketrans(b"-_", b"+/")
+_TRANSPORTS = {transport.value: transport for transport in AuthenticatorTransport}
+_ATTACHMENTS = {attachment.value: attachment for attachment in AuthenticatorAttachment}
+
+
+class PayloadError(ValueError):
+    """A credential payload that is malformed or over a limit"""
+
+    def __init__(self, message, reason="malformed"):
+        super().__init__(message)
+        self.reason = reason
+
+
+class PayloadTooLarge(PayloadError):
+    """A request body over CREDENTIAL_MAX_PAYLOAD_BYTES, answered with 413"""
+
+    def __init__(self):
+        super().__init__(f"Credential data is larger than {CREDENTIAL_MAX_PAYLOAD_BYTES} bytes", "body_too_large")
+
+
+def _encoded_length(size):
+    """Longest base64 text, padded, of size bytes"""
+    return (size + 2) // 3 * 4
+
+
+def decode_bytes(value, name, limit):
+    """Decode a base64url field of at most limit bytes"""
+    if type(value) is not str:
+        raise PayloadError(f"{name} must be a base64url string")
+    if len(value) > (limit + 2) // 3 * 4:
+        raise PayloadError(f"{name} is larger than {limit} bytes", "too_large")
+    if not _is_base64url(value):
+        raise PayloadError(f"{name} is not base64url")
+    try:
+        # What urlsafe_b64decode does, less its argument juggling
+        return binascii.a2b_base64(value.encode().translate(_TO_BASE64) + b"=="[:-len(value) % 4])
+    except binascii.Error:
+        raise PayloadError(f"{name} is not base64url") from None
+
+
+def _response_fields(response, fields):
+    if not isinstance(response, dict):
+        raise PayloadError("response must be an object")
+    decoded = {}
+    for name, attribute, limit, required in fields:
+        value = response.get(name)
+        if value is None:
+            if required:
+                raise PayloadError(f"Missing required field {name}")
+            continue
+        decoded[attribute] = decode_bytes(value, name, limit)
+    return decoded
+
+
+def _transports(value):
+    if value is None:
+        return None
+    if not isinstance(value, list) or len(value) > MAX_TRANSPORTS:
+        raise PayloadError(f"transports must be a list of at most {MAX_TRANSPORTS} names")
+    return [_TRANSPORTS[name] for name in value if isinstance(name, str) and name in _TRANSPORTS]
+
+
+def _credential_fields(data):
+    """id, raw_id, type and authenticator attachment, common to both ceremonies"""
+    if not isinstance(data, dict):
+        raise PayloadError("Credential data must be an object")
+
+    raw_id = data.get("rawId", data.get("id"))
+    if raw_id is None:
+        raise PayloadError("Missing required field rawId")
+    credential_id = data.get("id", raw_id)
+    if not isinstance(credential_id, str) or len(credential_id) > _encoded_length(MAX_CREDENTIAL_ID_BYTES):
+        raise PayloadError("id must be a base64url string of a credential ID")
+
+    if data.get("type") != PublicKeyCredentialType.PUBLIC_KEY.value:
+        raise PayloadError("type must be public-key")
+
+    attachment = data.get("authenticatorAttachment")
+    if attachment is not None:
+        if not isinstance(attachment, str) or attachment not in _ATTACHMENTS:
+            raise PayloadError("Unexpected authenticatorAttachment")
+        attachment = _ATTACHMENTS[attachment]
+
+    return {
+        "id": credential_id,
+        "raw_id": decode_bytes(raw_id, "rawId", MAX_CREDENTIAL_ID_BYTES),
+        "type": PublicKeyCredentialType.PUBLIC_KEY,
+        "authenticator_attachment": attachment,
+    }
+
+
+def decode_registration(data):
+    """A ``RegistrationCredential`` from the parsed JSON of navigator.credentials.create()"""
+    logs.log_payload(logger, "Registration credential received", data)
+    try:
+        credential = _credential_fields(data)
+        response = data.get("response")
+        fields = _response_fields(response, ATTESTATION_RESPONSE_FIELDS)
+        fields["transports"] = _transports(response.get("transports"))
+        credential["response"] = AuthenticatorAttestationResponse(**fields)
+    except PayloadError as e:
+        PAYLOAD_REJECTIONS.labels("registration", e.reason).inc()
+        raise
+    return RegistrationCredential(**credential)
+
+
+def decode_authentication(data):
+    """An ``AuthenticationCredential`` from the parsed JSON of navigator.credentials.get()"""
+    logs.log_payload(logger, "Authentication credential received", data)
+    try:
+        credential = _credential_fields(data)
+        credential["response"] = AuthenticatorAssertionResponse(
+            **_response_fields(data.get("response"), ASSERTION_RESPONSE_FIELDS)
+        )
+    except PayloadError as e:
+        PAYLOAD_REJECTIONS.labels("authentication", e.reason).inc()
+        raise
+    return AuthenticationCredential(**credential)
+
+
+def read_json(request, ceremony):
+    """
+    The JSON body of a Flask request, or None if it isn't JSON. A body over
+    CREDENTIAL_MAX_PAYLOAD_BYTES raises PayloadTooLarge, without being read
+    if its Content-Length says so.
+    """
+    request.max_content_length = CREDENTIAL_MAX_PAYLOAD_BYTES
+    try:
+        return request.get_json(silent=True)
+    except RequestEntityTooLarge:
+        PAYLOAD_REJECTIONS.labels(ceremony, "body_too_large").inc()
+        raise PayloadTooLarge() from None
@@ -0,0 +1,309 @@
+"""
+Challenge store availability
+
+The Redis client connects lazily, from a bounded pool, with connect and
+socket timeouts, so neither startup nor a request waits long on a Redis that
+is down. A circuit breaker in front of it counts consecutive connection
+failures and timeouts; after REDIS_BREAKER_FAILURES of them it opens, and
+requests stop trying Redis. Once REDIS_BREAKER_RESET seconds have passed a
+single operation is let through as a probe: if it succeeds the breaker
+closes and Redis is used again, otherwise it stays open for another period.
+Errors Redis answers with, such as a script error, are not failures of the
+connection and don't count.
+
+Neither does running out of pooled connections: when all
+REDIS_MAX_CONNECTIONS are busy for longer than the pool timeout, that says
+this process is overloaded, not that Redis is down. The operation is shed
+with StoreBusy, a StoreUnavailable answered with 503 whatever the policy,
+and the breaker is left as it was.
+
+While Redis can't be reached, each kind of operation follows its policy:
+
+- "closed" fails the operation with StoreUnavailable, which the views answer
+  with 503 and Retry-After
+- "open" serves it from an in-process memory store instead
+
+The kinds are ceremony challenges (REDIS_CHALLENGE_POLICY), username and
+email reservations, and used signed challenges (REDIS_RESERVATION_POLICY),
+and sign counters (REDIS_COUNTER_POLICY). REDIS_FAILURE_POLICY sets the
+default for all three, "closed". Failing open keeps a ceremony working only
+if it finishes on the process that started it, leaves concurrent signups to
+the database's unique constraints, and checks sign counts against this
+process's counters and the stored count only.
+"""
+
+import logging
+import os
+import threading
+import time
+
+import metrics
+from redis.exceptions import ConnectionError, TimeoutError
+
+from auth.challenges import CHALLENGE_TTL, ChallengeStore
+
+logger = logging.getLogger(__name__)
+
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "0.5"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.5"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_BREAKER_FAILURES = int(os.getenv("REDIS_BREAKER_FAILURES", "3"))
+REDIS_BREAKER_RESET = float(os.getenv("REDIS_BREAKER_RESET", "5"))
+
+REDIS_FAILURE_POLICY = os.getenv("REDIS_FAILURE_POLICY", "closed").lower()
+POLICIES = {
+    "challenge": os.getenv("REDIS_CHALLENGE_POLICY", REDIS_FAILURE_POLICY).lower(),
+    "reservation": os.getenv("REDIS_RESERVATION_POLICY", REDIS_FAILURE_POLICY).lower(),
+    "counter": os.getenv("REDIS_COUNTER_POLICY", REDIS_FAILURE_POLICY).lower(),
+}
+
+# Errors that say Redis couldn't be reached, as opposed to errors it replied with
+UNAVAILABLE_ERRORS = (ConnectionError, TimeoutError)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+REDIS_BREAKER_STATE = metrics.Gauge(
+    "webauthn_redis_breaker_state", "1 for the Redis circuit breaker's current state", ("state",)
+)
+REDIS_BREAKER_TRANSITIONS = metrics.Counter(
+    "webauthn_redis_breaker_transitions_total", "Redis circuit breaker state changes", ("state",)
+)
+REDIS_POOL_EXHAUSTED = metrics.Counter(
+    "webauthn_redis_pool_exhausted_total",
+    "Challenge store operations shed because no pooled Redis connection freed up in time", ("operation",)
+)
+REDIS_UNAVAILABLE = metrics.Counter(
+    "webauthn_redis_unavailable_total",
+    "Challenge store operations Redis couldn't serve, by operation and whether they failed open or closed",
+    ("operation", "outcome"),
+)
+
+
+class StoreUnavailable(Exception):
+    """The challenge store can't serve an operation whose policy fails closed"""
+
+
+class StoreBusy(StoreUnavailable):
+    """Every pooled Redis connection stayed in use; the operation is shed"""
+
+
+def pool_exhausted(error):
+    """Whether a ConnectionError is a pool checkout timeout rather than a failure to reach Redis"""
+    # What BlockingConnectionPool raises, sync and async, when it times out
+    return isinstance(error, ConnectionError) and str(error) == "No connection available."
+
+
+class CircuitBreaker:
+    """Consecutive failure counting circuit breaker; thread safe"""
+
+    def __init__(self, failure_threshold=REDIS_BREAKER_FAILURES, reset_timeout=REDIS_BREAKER_RESET,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        logger.log(logging.INFO if state == CLOSED else logging.WARNING,
+                   "Redis circuit breaker %s -> %s", self.state, state)
+        self.state = state
+        REDIS_BREAKER_TRANSITIONS.labels(state).inc()
+
+    def allow(self):
+        """Whether to try the backend; True for one probe once it's time to retry"""
+        if self.state == CLOSED:
+            return True
+        with self._lock:
+            if self.state == OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+                self._transition(HALF_OPEN)
+                return True
+            return False
+
+    def success(self):
+        if self.state == CLOSED and not self.failures:
+            return
+        with self._lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self._transition(CLOSED)
+
+    def inconclusive(self):
+        """An operation let through that said nothing about the backend; lets the next one probe"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._opened_at = self.clock() - self.reset_timeout
+                self._transition(OPEN)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self._opened_at = self.clock()
+                self._transition(OPEN)
+
+
+BREAKER = CircuitBreaker()
+
+for _state in (CLOSED, OPEN, HALF_OPEN):
+    REDIS_BREAKER_STATE.labels(_state).set_function(lambda state=_state: int(BREAKER.state == state))
+
+
+def shed(operation, error, breaker=BREAKER):
+    """Shed an operation that found no free pooled connection, leaving breaker as it was"""
+    logger.warning("Redis %s shed, connection pool exhausted", operation)
+    REDIS_POOL_EXHAUSTED.labels(operation).inc()
+    breaker.inconclusive()
+    raise StoreBusy(f"Challenge store busy for {operation}") from error
+
+
+def retry_after(error):
+    """Seconds a client should wait before retrying after a StoreUnavailable"""
+    if isinstance(error, StoreBusy):
+        return 1
+    return int(REDIS_BREAKER_RESET) or 1
+
+
+class _Resilient:
+    """Breaker and policy bookkeeping shared by the sync and async stores"""
+
+    def __init__(self, primary, fallback, breaker=BREAKER, policies=None):
+        self.primary = primary
+        self.fallback = fallback
+        self.breaker = breaker
+        self.policies = dict(POLICIES, **(policies or {}))
+
+    def _unavailable(self, operation, kind, error=None):
+        """Count an operation Redis couldn't serve; raise if its policy fails closed"""
+        if self.policies[kind] == "open":
+            REDIS_UNAVAILABLE.labels(operation, "fail_open").inc()
+            return
+        REDIS_UNAVAILABLE.labels(operation, "fail_closed").inc()
+        raise StoreUnavailable(f"Challenge store unavailable for {operation}") from error
+
+    def _busy(self, operation, error):
+        shed(operation, error, self.breaker)
+
+    def stats(self):
+        return self.fallback.stats()
+
+
+class ResilientChallengeStore(_Resilient, ChallengeStore):
+    """A Redis challenge store behind a circuit breaker, with a memory fallback"""
+
+    def _call(self, operation, kind, *args):
+        """
+        Run operation on Redis, or on the fallback if Redis is unavailable
+        and the policy fails open
+        """
+        if self.breaker.allow():
+            try:
+                result = getattr(self.primary, operation)(*args)
+            except UNAVAILABLE_ERRORS as e:
+                if pool_exhausted(e):
+                    self._busy(operation, e)
+                logger.warning("Redis %s failed: %s", operation, e)
+                self.breaker.failure()
+                self._unavailable(operation, kind, e)
+            except Exception:
+                self.breaker.success()
+                raise
+            else:
+                self.breaker.success()
+                return result
+        else:
+            self._unavailable(operation, kind)
+        return getattr(self.fallback, operation)(*args)
+
+    def put(self, key, challenge, ttl=CHALLENGE_TTL):
+        self._call("put", "challenge", key, challenge, ttl)
+
+    def consume(self, key):
+        challenge = self._call("consume", "challenge", key)
+        if challenge is None and self.policies["challenge"] == "open":
+            # Issued while Redis was unavailable
+            challenge = self.fallback.consume(key)
+        return challenge
+
+    def discard(self, key):
+        self._call("discard", "challenge", key)
+        if self.policies["challenge"] == "open":
+            self.fallback.discard(key)
+
+    def reserve(self, key, owner, ttl=CHALLENGE_TTL):
+        return self._call("reserve", "reservation", key, owner, ttl)
+
+    def release(self, key, owner):
+        self._call("release", "reservation", key, owner)
+        if self.policies["reservation"] == "open":
+            self.fallback.release(key, owner)
+
+    def advance(self, key, value, floor, ttl):
+        return self._call("advance", "counter", key, value, floor, ttl)
+
+
+class AsyncResilientChallengeStore(_Resilient):
+    """``ResilientChallengeStore`` for the async stores, usually sharing its breaker"""
+
+    async def _call(self, operation, kind, *args):
+        if self.breaker.allow():
+            try:
+                result = await getattr(self.primary, operation)(*args)
+            except UNAVAILABLE_ERRORS as e:
+                if pool_exhausted(e):
+                    self._busy(operation, e)
+                logger.warning("Redis %s failed: %s", operation, e)
+                self.breaker.failure()
+                self._unavailable(operation, kind, e)
+            except Exception:
+                self.breaker.success()
+                raise
+            else:
+                self.breaker.success()
+                return result
+        else:
+            self._unavailable(operation, kind)
+        return await getattr(self.fallback, operation)(*args)
+
+    async def put(self, key, challenge, ttl=CHALLENGE_TTL):
+        await self._call("put", "challenge", key, challenge, ttl)
+
+    async def consume(self, key):
+        challenge = await self._call("consume", "challenge", key)
+        if challenge is None and self.policies["challenge"] == "open":
+            challenge = await self.fallback.consume(key)
+        return challenge
+
+    async def discard(self, key):
+        await self._call("discard", "challenge", key)
+        if self.policies["challenge"] == "open":
+            await self.fallback.discard(key)
+
+    async def reserve(self, key, owner, ttl=CHALLENGE_TTL):
+        return await self._call("reserve", "reservation", key, owner, ttl)
+
+    async def release(self, key, owner):
+        await self._call("release", "reservation", key, owner)
+        if self.policies["reservation"] == "open":
+            await self.fallback.release(key, owner)
+
+    async def advance(self, key, value, floor, ttl):
+        return await self._call("advance", "counter", key, value, floor, ttl)
+
+
+def pool_options(host, port, password):
+    """Connection pool arguments for a Redis client, sync or async"""
+    return {
+        "host": host,
+        "port": port,
+        "password": password,
+        "db": 0,
+        "max_connections": REDIS_MAX_CONNECTIONS,
+        # How long to wait for a free connection when the pool is exhausted
+        "timeout": REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": REDIS_CONNECT_TIMEOUT,
+        "socket_timeout": REDIS_SOCKET_TIMEOUT,
+        "decode_responses": False,  # Challenges are stored as raw bytes
+    }
@@ -1,46 +1,95 @@
-import datetime
-import os
 import json
-import base64
+import logging
+import os
+import uuid
 from urllib.parse import urlparse
 
+import metrics
 import webauthn
-from flask import request
-from models import WebAuthnCredential, db
-
-# Redis configuration with error handling
+from flask import current_app, request, session
+from models import User, WebAuthnCredential, db
+from sqlalchemy import delete, select, update
+from webauthn.helpers import base64url_to_bytes, bytes_to_base64url
+from webauthn.helpers.exceptions import InvalidAuthenticationResponse
+from webauthn.helpers.structs import (
+    AuthenticatorSelectionCriteria,
+    PublicKeyCredentialDescriptor,
+    ResidentKeyRequirement,
+    UserVerificationRequirement,
+)
+
+from auth import credential_keys, metadata, resilience, usage, user_credentials, verification
+from auth.challenges import CHALLENGE_TTL, MemoryChallengeStore, RedisChallengeStore, SignedChallengeStore
+from auth.resilience import ResilientChallengeStore, StoreUnavailable
+
+logger = logging.getLogger(__name__)
+
+# "deferred" keeps a signup in the challenge store and only writes the user
+# once their first credential verifies; "immediate" inserts the user up front
+REGISTRATION_MODE = os.getenv("REGISTRATION_MODE", "deferred").lower()
+# How long a pending signup holds its username and email
+REGISTRATION_RESERVATION_TTL = int(os.getenv("REGISTRATION_RESERVATION_TTL", str(CHALLENGE_TTL)))
+# "store" keeps ceremony challenges in the challenge store; "signed" carries
+# them in the session, signed with SECRET_KEY, and the store only records
+# the ones that were used
+CHALLENGE_MODE = os.getenv("CHALLENGE_MODE", "store").lower()
+
+# "redis" or "memory"; Redis when a host is configured
+CHALLENGE_BACKEND = os.getenv("CHALLENGE_BACKEND", "redis" if os.getenv("REDIS_HOST") else "memory").lower()
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", None)
 
-# Initialize Redis with error handling
-REGISTRATION_CHALLENGES = None
-try:
-    from redis import Redis
-    REGISTRATION_CHALLENGES = Redis(
-        host=REDIS_HOST,
-        port=REDIS_PORT,
-        password=REDIS_PASSWORD,
-        db=0,
-        decode_responses=True,  # Keep as True, we'll handle binary data differently
-    )
-    # Test connection
-    REGISTRATION_CHALLENGES.ping()
-    print("Redis connection successful")
-except Exception as e:
-    print(f"Redis connection failed: {e}")
-    print("Falling back to in-memory storage (not recommended for production)")
-    # Fallback to in-memory storage
-    REGISTRATION_CHALLENGES = {}
+# Operations Redis can't serve fall back to this when their policy fails open
+FALLBACK_STORE = MemoryChallengeStore()
+
+if CHALLENGE_BACKEND == "redis":
+    # Nothing connects until the first command, so an unreachable Redis
+    # doesn't hold up startup; the breaker decides what happens from there
+    from redis import BlockingConnectionPool, Redis
+    redis_client = Redis(connection_pool=BlockingConnectionPool(
+        **resilience.pool_options(REDIS_HOST, REDIS_PORT, REDIS_PASSWORD)
+    ))
+    CHALLENGE_STORE = ResilientChallengeStore(RedisChallengeStore(redis_client), FALLBACK_STORE)
+    logger.info("Challenge store: Redis at %s:%s", REDIS_HOST, REDIS_PORT)
+else:
+    redis_client = None
+    CHALLENGE_STORE = FALLBACK_STORE
+    logger.warning("Challenge store: in-memory (not recommended for production)")
+
+# Where ceremonies keep their challenges; reservations and sign counts
+# always go to CHALLENGE_STORE
+if CHALLENGE_MODE == "signed":
+    CEREMONY_STORE = SignedChallengeStore(CHALLENGE_STORE, lambda: session, lambda: current_app.secret_key)
+else:
+    CEREMONY_STORE = CHALLENGE_STORE
+
+CHALLENGE_CACHE = metrics.Gauge(
+    "webauthn_challenge_cache", "In-process challenge cache counters and size", ("stat",)
+)
+for _stat in ("hits", "misses", "evictions", "expirations", "size", "max_size"):
+    CHALLENGE_CACHE.labels(_stat).set_function(lambda stat=_stat: FALLBACK_STORE.stats()[stat])
+
+
+def after_fork():
+    """
+    Drop Redis connections inherited from the parent of a forked server
+    worker, without closing them under the parent, and restart the fallback
+    store's sweeper
+    """
+    if redis_client is not None:
+        redis_client.connection_pool.reset()
+    FALLBACK_STORE.after_fork()
 
 
-def _hostname():
-    return str(urlparse(request.base_url).hostname)
+def rp_id_for(base_url):
+    """The relying party id for requests to base_url"""
+    return str(urlparse(base_url).hostname)
 
 
-def _origin():
+def origin_for(base_url):
     """Get the origin for WebAuthn, handling both HTTP (dev) and HTTPS (prod)"""
-    parsed = urlparse(request.base_url)
+    parsed = urlparse(base_url)
     # For development, allow HTTP. For production, use HTTPS
     if parsed.hostname in ['localhost', '127.0.0.1'] or os.getenv('FLASK_ENV') == 'development':
         return f"{parsed.scheme}://{parsed.netloc}"
@@ -49,86 +98,75 @@ def _origin():
         return f"https://{parsed.netloc}"
 
 
+def _hostname():
+    return rp_id_for(request.base_url)
+
+
+def _origin():
+    return origin_for(request.base_url)
+
+
+def user_handle(user_uid):
+    """
+    The WebAuthn user handle for a user: the 16 bytes of their uid, which is
+    opaque and stable, unlike the row id.
+    """
+    return uuid.UUID(user_uid).bytes
+
+
+def user_handle_filter(handle):
+    """Query condition matching the user a user handle was issued to"""
+    if len(handle) == 16:
+        return User.uid == str(uuid.UUID(bytes=handle))
+    # Credentials registered before user handles were derived from the uid
+    # carry the decimal row id
+    if handle.isdigit():
+        return User.id == int(handle)
+    raise InvalidAuthenticationResponse("Unrecognized user handle")
+
+
 def _store_challenge(user_uid, challenge):
-    """Store challenge with fallback to in-memory storage"""
+    """Store the registration challenge for a user"""
     try:
-        if hasattr(REGISTRATION_CHALLENGES, 'set'):
-            # Redis storage - convert bytes challenge to base64 string
-            if isinstance(challenge, bytes):
-                challenge_str = base64.b64encode(challenge).decode('utf-8')
-            else:
-                challenge_str = str(challenge)
-
-            # Store as JSON to preserve type information
-            challenge_data = {
-                'challenge': challenge_str,
-                'is_bytes': isinstance(challenge, bytes),
-                'timestamp': datetime.datetime.now().isoformat()
-            }
-
-            REGISTRATION_CHALLENGES.set(
-                f"webauthn_challenge:{user_uid}", 
-                json.dumps(challenge_data),
-                ex=600  # 10 minutes expiration
-            )
-            print(f"Challenge stored for user {user_uid}")
-        else:
-            # In-memory fallback
-            REGISTRATION_CHALLENGES[user_uid] = {
-                'challenge': challenge,
-                'expires': datetime.datetime.now() + datetime.timedelta(minutes=10)
-            }
+        CEREMONY_STORE.put(user_uid, challenge)
+        logger.debug("Challenge stored for user %s", user_uid)
     except Exception as e:
-        print(f"Error storing challenge: {e}")
+        logger.warning("Error storing challenge: %s", e)
         raise
 
 
-def _get_challenge(user_uid):
-    """Get challenge with fallback to in-memory storage"""
+def _consume_challenge(user_uid):
+    """Atomically fetch and remove the registration challenge for a user"""
     try:
-        if hasattr(REGISTRATION_CHALLENGES, 'get'):
-            # Redis storage
-            challenge_json = REGISTRATION_CHALLENGES.get(f"webauthn_challenge:{user_uid}")
-            if challenge_json:
-                try:
-                    challenge_data = json.loads(challenge_json)
-                    challenge_str = challenge_data['challenge']
-
-                    # Convert back to bytes if it was originally bytes
-                    if challenge_data.get('is_bytes', False):
-                        return base64.b64decode(challenge_str)
-                    else:
-                        return challenge_str
-                except (json.JSONDecodeError, KeyError) as e:
-                    print(f"Error parsing challenge data: {e}")
-                    return None
-            return None
-        else:
-            # In-memory fallback
-            stored = REGISTRATION_CHALLENGES.get(user_uid)
-            if stored and stored['expires'] > datetime.datetime.now():
-                return stored['challenge']
-            elif stored:
-                # Expired
-                del REGISTRATION_CHALLENGES[user_uid]
-            return None
+        return CEREMONY_STORE.consume(user_uid)
+    except StoreUnavailable:
+        raise
     except Exception as e:
-        print(f"Error retrieving challenge: {e}")
+        logger.warning("Error retrieving challenge: %s", e)
         return None
 
 
-def _delete_challenge(user_uid):
-    """Delete challenge with fallback to in-memory storage"""
-    try:
-        if hasattr(REGISTRATION_CHALLENGES, 'delete'):
-            # Redis storage
-            REGISTRATION_CHALLENGES.delete(f"webauthn_challenge:{user_uid}")
-            print(f"Challenge deleted for user {user_uid}")
-        else:
-            # In-memory fallback
-            REGISTRATION_CHALLENGES.pop(user_uid, None)
-    except Exception as e:
-        print(f"Error deleting challenge: {e}")
+def registration_options(rp_id, user_uid, username, display_name, exclude_credentials=None):
+    """
+    Registration options for a user, asking for a discoverable credential
+    from an authenticator that holds none of exclude_credentials
+    """
+    with metrics.timed("registration_options"):
+        return webauthn.generate_registration_options(
+            rp_id=rp_id,
+            rp_name="Flask WebAuthn Demo",
+            user_id=user_handle(user_uid),
+            user_name=username,
+            user_display_name=display_name or username,  # Ensure display name exists
+            attestation=metadata.attestation_preference(),
+            exclude_credentials=exclude_credentials,
+            # Ask for a discoverable credential so the user can later log in
+            # without typing a username
+            authenticator_selection=AuthenticatorSelectionCriteria(
+                resident_key=ResidentKeyRequirement.PREFERRED,
+                user_verification=UserVerificationRequirement.PREFERRED,
+            ),
+        )
 
 
 def prepare_credential_creation(user):
@@ -137,64 +175,379 @@ def prepare_credential_creation(user):
     WebAuthn credential.
     """
     try:
-        user_id_bytes = str(user.id).encode("utf-8")
-
-        public_credential_creation_options = webauthn.generate_registration_options(
-            rp_id=_hostname(),
-            rp_name="Flask WebAuthn Demo",
-            user_id=user_id_bytes,
-            user_name=user.username,
-            user_display_name=user.name or user.username,  # Ensure display name exists
+        # An authenticator the user already enrolled refuses straight away
+        with metrics.timed("credential_list"):
+            exclude_credentials = user_credentials.descriptors(user.id)
+        public_credential_creation_options = registration_options(
+            _hostname(), user.uid, user.username, user.name, exclude_credentials
         )
 
         # Store challenge
-        _store_challenge(user.uid, public_credential_creation_options.challenge)
-        print(f"Challenge generated and stored for user: {user.username}")
+        with metrics.timed("challenge_store"):
+            _store_challenge(user.uid, public_credential_creation_options.challenge)
+        logger.debug("Challenge generated and stored for user: %s", user.username)
 
         return webauthn.options_to_json(public_credential_creation_options)
 
     except Exception as e:
-        print(f"Error preparing credential creation: {e}")
+        logger.warning("Error preparing credential creation: %s", e)
         raise
 
 
 def verify_and_save_credential(user, registration_credential):
     """Verify that a new credential is valid"""
     try:
-        expected_challenge = _get_challenge(user.uid)
-        print(f"Retrieved challenge for user {user.username}: {expected_challenge is not None}")
+        # Consuming the challenge up front makes it single-use even if
+        # verification fails or two requests race for it
+        with metrics.timed("challenge_consume"):
+            expected_challenge = _consume_challenge(user.uid)
+        logger.debug("Retrieved challenge for user %s: %s", user.username, expected_challenge is not None)
 
         if not expected_challenge:
             raise ValueError("No challenge found for user. Please try registration again.")
 
-        print(f"Verifying credential with challenge for user: {user.username}")
+        logger.debug("Verifying credential with challenge for user: %s", user.username)
 
         # Verify the registration response
-        auth_verification = webauthn.verify_registration_response(
-            credential=registration_credential,
-            expected_challenge=expected_challenge,
-            expected_origin=_origin(),
-            expected_rp_id=_hostname(),
-        )
+        with metrics.timed("registration_verify"):
+            auth_verification = verification.verify_registration_response(
+                credential=registration_credential,
+                expected_challenge=expected_challenge,
+                expected_origin=_origin(),
+                expected_rp_id=_hostname(),
+                pem_root_certs_bytes_by_fmt=metadata.trust_anchors_for(registration_credential),
+            )
 
-        print(f"Credential verification successful for user: {user.username}")
+        logger.debug("Credential verification successful for user: %s", user.username)
 
         # Save the credential
         credential = WebAuthnCredential(
             user=user,
             credential_public_key=auth_verification.credential_public_key,
             credential_id=auth_verification.credential_id,
+            transports=user_credentials.encode_transports(registration_credential.response.transports),
+        )
+        # Only written for a signup's first credential
+        user.signup_pending = False
+
+        with metrics.timed("credential_commit"):
+            db.session.add(credential)
+            db.session.commit()
+        user_credentials.invalidate([user.id])
+        logger.debug("Credential saved to database for user: %s", user.username)
+
+        return auth_verification
+
+    except Exception as e:
+        logger.warning("Error verifying credential: %s", e)
+        raise
+
+
+def cancel_credential_creation(user):
+    """Drop the pending registration challenge for a user"""
+    try:
+        CEREMONY_STORE.discard(user.uid)
+        logger.debug("Challenge deleted for user %s", user.uid)
+    except Exception as e:
+        logger.warning("Error deleting challenge: %s", e)
+
+
+def registration_key(user_uid):
+    """Challenge store key of a pending signup"""
+    return f"registration:{user_uid}"
+
+
+def reservation_keys(username, email):
+    """Challenge store keys holding a pending signup's username and email"""
+    return f"reserve:username:{username}", f"reserve:email:{email}"
+
+
+def reserve_registration(user_uid, username, email):
+    """
+    Hold the username and email for a pending signup so a concurrent signup
+    can't claim them. Returns False, holding nothing, if either is taken.
+    """
+    owner = user_uid.encode()
+    held = []
+    for key in reservation_keys(username, email):
+        if not CHALLENGE_STORE.reserve(key, owner, REGISTRATION_RESERVATION_TTL):
+            for held_key in held:
+                CHALLENGE_STORE.release(held_key, owner)
+            return False
+        held.append(key)
+    return True
+
+
+def release_registration(user_uid, username, email):
+    """Give up the username and email reservations of a pending signup"""
+    owner = user_uid.encode()
+    for key in reservation_keys(username, email):
+        try:
+            CHALLENGE_STORE.release(key, owner)
+        except Exception as e:
+            logger.warning("Error releasing reservation %s: %s", key, e)
+
+
+def pending_registration_record(name, username, email, challenge):
+    """Serialized details and challenge of a pending signup"""
+    return json.dumps({
+        "name": name,
+        "username": username,
+        "email": email,
+        "challenge": bytes_to_base64url(challenge),
+    }).encode()
+
+
+def prepare_pending_registration(user_uid, name, username, email):
+    """
+    Generate registration options for a user who doesn't exist yet. Their
+    details are kept with the challenge until the credential is verified.
+    """
+    try:
+        public_credential_creation_options = registration_options(_hostname(), user_uid, username, name)
+
+        record = pending_registration_record(
+            name, username, email, public_credential_creation_options.challenge
+        )
+        with metrics.timed("challenge_store"):
+            CEREMONY_STORE.put(registration_key(user_uid), record)
+        logger.debug("Pending registration stored for user: %s", username)
+
+        return webauthn.options_to_json(public_credential_creation_options)
+
+    except Exception as e:
+        logger.warning("Error preparing pending registration: %s", e)
+        raise
+
+
+def verify_pending_registration(user_uid, registration_credential):
+    """
+    Verify the first credential of a pending signup, then write the user and
+    the credential in one transaction. Returns the new User.
+    """
+    with metrics.timed("challenge_consume"):
+        record = _consume_challenge(registration_key(user_uid))
+    if not record:
+        raise ValueError("No pending registration found. Please try registration again.")
+
+    pending = json.loads(record)
+    try:
+        with metrics.timed("registration_verify"):
+            auth_verification = verification.verify_registration_response(
+                credential=registration_credential,
+                expected_challenge=base64url_to_bytes(pending["challenge"]),
+                expected_origin=_origin(),
+                expected_rp_id=_hostname(),
+                pem_root_certs_bytes_by_fmt=metadata.trust_anchors_for(registration_credential),
+            )
+
+        user = User(uid=user_uid, name=pending["name"], username=pending["username"], email=pending["email"])
+        credential = WebAuthnCredential(
+            user=user,
+            credential_public_key=auth_verification.credential_public_key,
+            credential_id=auth_verification.credential_id,
+            transports=user_credentials.encode_transports(registration_credential.response.transports),
+        )
+        with metrics.timed("user_insert"):
+            db.session.add(user)
+            db.session.add(credential)
+            db.session.commit()
+        # A deleted user's id may be reused
+        user_credentials.invalidate([user.id])
+        logger.debug("User and credential saved for pending registration: %s", user.username)
+        return user
+
+    except Exception as e:
+        db.session.rollback()
+        logger.warning("Error verifying pending registration: %s", e)
+        raise
+    finally:
+        release_registration(user_uid, pending["username"], pending["email"])
+
+
+def cancel_pending_registration(user_uid):
+    """Drop a pending signup and free its username and email"""
+    record = _consume_challenge(registration_key(user_uid))
+    if record:
+        pending = json.loads(record)
+        release_registration(user_uid, pending["username"], pending["email"])
+        logger.debug("Pending registration cancelled for user: %s", pending["username"])
+
+
+def list_credentials(user):
+    """A user's credentials for display: row id, credential ID, transports and last use"""
+    return db.session.execute(
+        select(
+            WebAuthnCredential.id,
+            WebAuthnCredential.credential_id,
+            WebAuthnCredential.transports,
+            WebAuthnCredential.last_used_at,
         )
+        .where(WebAuthnCredential.user_id == user.id)
+        .order_by(WebAuthnCredential.id)
+    ).all()
+
 
-        db.session.add(credential)
+def revoke_credential(user, credential_id):
+    """
+    Delete one of a user's credentials. Raises ValueError if the user has no
+    such credential, or if it is the only one they could log in with.
+    """
+    try:
+        # Locking the user serializes concurrent revocations, so two of them
+        # can't leave the account without a credential
+        db.session.execute(select(User.id).where(User.id == user.id).with_for_update())
+        remaining = db.session.execute(
+            select(WebAuthnCredential.credential_id).where(WebAuthnCredential.user_id == user.id)
+        ).scalars().all()
+        if credential_id not in remaining:
+            raise ValueError("No such credential")
+        if len(remaining) == 1:
+            raise ValueError("Can't revoke the only credential of an account")
+
+        db.session.execute(
+            delete(WebAuthnCredential).where(
+                WebAuthnCredential.user_id == user.id, WebAuthnCredential.credential_id == credential_id
+            )
+        )
         db.session.commit()
-        print(f"Credential saved to database for user: {user.username}")
+    except Exception:
+        db.session.rollback()
+        raise
 
-        # Clean up the challenge
-        _delete_challenge(user.uid)
+    user_credentials.invalidate([user.id])
+    credential_keys.invalidate([credential_id])
+    logger.info("Credential revoked for user: %s", user.username)
 
-        return auth_verification
+
+def login_key(login_id):
+    """Challenge store key of a login in progress"""
+    return f"login:{login_id}"
+
+
+def prepare_login(user, login_id):
+    """
+    Generate the configuration needed by the client to authenticate with one
+    of the user's registered credentials.
+    """
+    try:
+        with metrics.timed("credential_list"):
+            credential_ids = db.session.execute(
+                select(WebAuthnCredential.credential_id).where(WebAuthnCredential.user_id == user.id)
+            ).scalars().all()
+
+        if not credential_ids:
+            raise ValueError("No credentials registered for user")
+
+        with metrics.timed("authentication_options"):
+            public_credential_request_options = webauthn.generate_authentication_options(
+                rp_id=_hostname(),
+                allow_credentials=[PublicKeyCredentialDescriptor(id=cid) for cid in credential_ids],
+                user_verification=UserVerificationRequirement.PREFERRED,
+            )
+
+        with metrics.timed("challenge_store"):
+            CEREMONY_STORE.put(login_key(login_id), public_credential_request_options.challenge)
+        logger.debug("Authentication challenge generated for user: %s", user.username)
+
+        return webauthn.options_to_json(public_credential_request_options)
+
+    except Exception as e:
+        logger.warning("Error preparing login: %s", e)
+        raise
+
+
+def prepare_discoverable_login(login_id):
+    """
+    Generate authentication options without a credential list, letting the
+    authenticator offer any discoverable credential it holds for this site.
+    """
+    try:
+        with metrics.timed("authentication_options"):
+            public_credential_request_options = webauthn.generate_authentication_options(
+                rp_id=_hostname(),
+                user_verification=UserVerificationRequirement.PREFERRED,
+            )
+
+        with metrics.timed("challenge_store"):
+            CEREMONY_STORE.put(login_key(login_id), public_credential_request_options.challenge)
+
+        return webauthn.options_to_json(public_credential_request_options)
+
+    except Exception as e:
+        logger.warning("Error preparing discoverable login: %s", e)
+        raise
+
+
+def credential_lookup_query(authentication_credential):
+    """
+    Single indexed lookup on credential_id, joined to the owning user.
+    Discoverable credentials also return the user handle, which must belong
+    to the same user.
+    """
+    query = (
+        select(
+            WebAuthnCredential.id,
+            WebAuthnCredential.credential_public_key,
+            WebAuthnCredential.current_sign_count,
+            User.uid,
+            User.username,
+        )
+        .join(User, User.id == WebAuthnCredential.user_id)
+        .where(WebAuthnCredential.credential_id == authentication_credential.raw_id)
+    )
+    handle = authentication_credential.response.user_handle
+    if handle:
+        query = query.where(user_handle_filter(handle))
+    return query
+
+
+def verify_login(login_id, authentication_credential):
+    """
+    Verify an assertion against the stored credential and record the new
+    sign count. Returns the (uid, username) of the authenticated user.
+    """
+    try:
+        with metrics.timed("challenge_consume"):
+            expected_challenge = CEREMONY_STORE.consume(login_key(login_id))
+        if not expected_challenge:
+            raise ValueError("No challenge found for login. Please try again.")
+
+        with metrics.timed("credential_lookup"):
+            stored = db.session.execute(credential_lookup_query(authentication_credential)).first()
+
+        if stored is None:
+            raise InvalidAuthenticationResponse("Unknown credential")
+
+        current_sign_count = stored.current_sign_count or 0
+        with metrics.timed("authentication_verify"):
+            auth_verification = credential_keys.verify_authentication_response(
+                credential=authentication_credential,
+                expected_challenge=expected_challenge,
+                expected_origin=_origin(),
+                expected_rp_id=_hostname(),
+                credential_public_key=stored.credential_public_key,
+                credential_current_sign_count=current_sign_count,
+            )
+
+        # Authenticators without a counter always report zero, leaving
+        # nothing to check
+        new_sign_count = auth_verification.new_sign_count
+        if new_sign_count:
+            with metrics.timed("sign_count_check"):
+                advanced = CHALLENGE_STORE.advance(
+                    usage.sign_count_key(authentication_credential.raw_id),
+                    new_sign_count, current_sign_count, usage.SIGN_COUNT_TTL,
+                )
+            if not advanced:
+                raise InvalidAuthenticationResponse("Sign count was not greater than the stored count")
+
+        usage.record(stored.id, new_sign_count)
+
+        logger.debug("Authentication successful for user: %s", stored.username)
+        return stored.uid, stored.username
 
     except Exception as e:
-        print(f"Error verifying credential: {e}")
+        db.session.rollback()
+        logger.warning("Error verifying login: %s", e)
         raise
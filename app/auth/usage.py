@@ -0,0 +1,259 @@
+"""
+Write-behind of credential usage
+
+A login has to persist the credential's new sign count, and records when it
+was last used. Rather than commit a row update per login, updates are
+coalesced per credential in memory and written every USAGE_FLUSH_INTERVAL
+seconds, or as soon as USAGE_MAX_PENDING credentials are waiting, as bulk
+UPDATEs of at most USAGE_FLUSH_BATCH_SIZE rows. A credential used many times
+between flushes costs one row write, and the database lags by at most one
+interval. Pending updates are flushed when the process exits.
+
+The buffer holds at most USAGE_MAX_PENDING credentials; a login with
+another credential while it is full writes its row itself. Rows of a failed
+flush are put back only as far as there is room, and the rest are dropped
+and counted in webauthn_usage_rows_dropped_total: the challenge store still
+has their sign counts, and the next login with each writes it. Processes that don't run the flusher,
+such as CLI commands, write every row straight away.
+
+Clone detection can't wait for the database, so the sign count is checked
+and advanced atomically in the challenge store first (see
+``ChallengeStore.advance``), falling back to the stored count when the store
+has no counter for the credential.
+
+With USAGE_FLUSH_INTERVAL=0 every login writes its row straight away.
+"""
+
+import atexit
+import datetime
+import logging
+import os
+import threading
+import time
+
+import metrics
+from models import WebAuthnCredential, db
+from sqlalchemy import DateTime, Integer, bindparam, case, column, func, update, values
+from webauthn.helpers import bytes_to_base64url
+
+logger = logging.getLogger(__name__)
+
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))
+USAGE_FLUSH_BATCH_SIZE = int(os.getenv("USAGE_FLUSH_BATCH_SIZE", "1000"))
+USAGE_MAX_PENDING = int(os.getenv("USAGE_MAX_PENDING", "10000"))
+# How long the challenge store keeps a credential's sign count after its
+# last login; far longer than a flush interval
+SIGN_COUNT_TTL = int(os.getenv("SIGN_COUNT_TTL", "86400"))
+
+USAGE_PENDING = metrics.Gauge(
+    "webauthn_usage_pending", "Credentials with usage waiting to be written"
+)
+USAGE_ROWS_WRITTEN = metrics.Counter(
+    "webauthn_usage_rows_written_total", "Credential rows updated by usage flushes"
+)
+USAGE_ROWS_DROPPED = metrics.Counter(
+    "webauthn_usage_rows_dropped_total", "Usage rows of failed flushes with no room left to retry them"
+)
+USAGE_FLUSHES = metrics.Counter(
+    "webauthn_usage_flushes_total", "Usage flushes by outcome", ("outcome",)
+)
+USAGE_FLUSH_SECONDS = metrics.Histogram(
+    "webauthn_usage_flush_seconds", "Duration of one usage flush"
+)
+
+_worker = None
+_app = None
+
+
+def usage_row(row_id, sign_count):
+    """A login's (credential row id, sign count, used at), stamped now"""
+    # Naive UTC, like the column
+    return row_id, sign_count, datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def sign_count_key(credential_id):
+    """Challenge store key of a credential's sign count"""
+    return f"sign_count:{bytes_to_base64url(credential_id)}"
+
+
+def update_statement(dialect_name, rows):
+    """
+    One UPDATE writing rows of (credential row id, sign count, used at) and
+    its parameters. Sign counts never move backwards, whatever order
+    processes flush in.
+    """
+    table = WebAuthnCredential.__table__
+    if dialect_name == "postgresql":
+        # A single UPDATE ... FROM (VALUES ...) for the whole batch
+        usage = values(
+            column("row_id", Integer), column("sign_count", Integer), column("used_at", DateTime),
+            name="usage",
+        ).data(rows)
+        statement = (
+            update(table)
+            .where(table.c.id == usage.c.row_id)
+            .values(
+                current_sign_count=func.greatest(table.c.current_sign_count, usage.c.sign_count),
+                last_used_at=usage.c.used_at,
+            )
+        )
+        return statement, None
+
+    # Elsewhere one statement executed for every row in the batch
+    statement = (
+        update(table)
+        .where(table.c.id == bindparam("b_row_id"))
+        .values(
+            current_sign_count=case(
+                (func.coalesce(table.c.current_sign_count, 0) < bindparam("b_sign_count"),
+                 bindparam("b_sign_count")),
+                else_=table.c.current_sign_count,
+            ),
+            last_used_at=bindparam("b_used_at"),
+        )
+    )
+    return statement, [
+        {"b_row_id": row_id, "b_sign_count": sign_count, "b_used_at": used_at}
+        for row_id, sign_count, used_at in rows
+    ]
+
+
+def write(rows):
+    """Write usage rows now, in batches; needs an app context"""
+    with db.engine.begin() as connection:
+        for start in range(0, len(rows), USAGE_FLUSH_BATCH_SIZE):
+            statement, parameters = update_statement(
+                connection.dialect.name, rows[start:start + USAGE_FLUSH_BATCH_SIZE]
+            )
+            connection.execute(statement, parameters)
+    USAGE_ROWS_WRITTEN.inc(len(rows))
+
+
+class UsageBuffer:
+    """Latest usage per credential, waiting to be written"""
+
+    def __init__(self, max_pending=USAGE_MAX_PENDING):
+        self.max_pending = max_pending
+        # credential row id -> (sign count, used at)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.full = threading.Event()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def record(self, row_id, sign_count, used_at):
+        """
+        Merge a login into the pending updates. Returns False, keeping
+        nothing, for a new credential when max_pending are already waiting.
+        """
+        with self._lock:
+            previous = self._pending.get(row_id)
+            if previous is not None:
+                sign_count = max(sign_count, previous[0])
+                used_at = max(used_at, previous[1])
+            elif len(self._pending) >= self.max_pending:
+                self.full.set()
+                return False
+            self._pending[row_id] = (sign_count, used_at)
+            if len(self._pending) >= self.max_pending:
+                self.full.set()
+            return True
+
+    def drain(self):
+        """Take every pending update"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self.full.clear()
+        return [(row_id, sign_count, used_at) for row_id, (sign_count, used_at) in pending.items()]
+
+    def restore(self, rows):
+        """
+        Put back updates that failed to write, merging them into newer ones
+        and keeping to max_pending; returns the number that didn't fit
+        """
+        dropped = 0
+        for row_id, sign_count, used_at in rows:
+            if not self.record(row_id, sign_count, used_at):
+                dropped += 1
+        return dropped
+
+
+BUFFER = UsageBuffer() if USAGE_FLUSH_INTERVAL > 0 else None
+
+if BUFFER is not None:
+    USAGE_PENDING.set_function(lambda: len(BUFFER))
+
+
+def buffered(row):
+    """
+    Hand a usage row to the flusher. Returns False if the caller has to
+    write it: there is no flusher in this process, or its buffer is full.
+    """
+    if BUFFER is None or _worker is None:
+        return False
+    return BUFFER.record(*row)
+
+
+def record(row_id, sign_count):
+    """Note a login with a credential; needs an app context"""
+    row = usage_row(row_id, sign_count)
+    if buffered(row):
+        return
+    with metrics.timed("usage_write"):
+        write([row])
+
+
+def flush():
+    """Write every pending update; returns the number of rows written"""
+    if BUFFER is None:
+        return 0
+    rows = BUFFER.drain()
+    if not rows:
+        return 0
+
+    start = time.perf_counter()
+    try:
+        with _app.app_context():
+            write(rows)
+    except Exception:
+        dropped = BUFFER.restore(rows)
+        if dropped:
+            USAGE_ROWS_DROPPED.inc(dropped)
+            logger.warning("Usage buffer full, dropped %s rows of a failed flush", dropped)
+        USAGE_FLUSHES.labels("error").inc()
+        raise
+    finally:
+        USAGE_FLUSH_SECONDS.observe(time.perf_counter() - start)
+    USAGE_FLUSHES.labels("ok").inc()
+    return len(rows)
+
+
+def _flush_forever(interval):
+    while True:
+        BUFFER.full.wait(interval)
+        try:
+            flush()
+        except Exception as e:
+            logger.error("Usage flush failed, retrying next interval: %s", e)
+
+
+def _flush_at_exit():
+    try:
+        written = flush()
+        if written:
+            logger.info("Flushed usage of %s credentials at exit", written)
+    except Exception as e:
+        logger.error("Usage flush at exit failed: %s", e)
+
+
+def start_worker(app, interval=USAGE_FLUSH_INTERVAL):
+    """Flush usage every interval seconds in a daemon thread, and at exit"""
+    global _worker, _app
+    if BUFFER is None or _worker is not None:
+        return
+    _app = app
+    _worker = threading.Thread(target=_flush_forever, args=(interval,), name="usage-flusher", daemon=True)
+    _worker.start()
+    atexit.register(_flush_at_exit)
+    logger.info("Usage write-behind started, flushing every %ss", interval)
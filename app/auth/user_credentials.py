@@ -0,0 +1,173 @@
+"""
+Per-user credential ID cache
+
+Registration options list the user's existing credentials in
+excludeCredentials, so an authenticator that is already enrolled refuses up
+front instead of after a full attestation verification. The descriptors come
+from a per-process LRU cache of each user's credential IDs and transports,
+filled by one query on the indexed web_authn_credential.user_id, never
+through the User.credentials relationship.
+
+Adding or revoking a credential drops the user's entry in the process that
+did it. Other processes notice when their entry expires, after
+USER_CREDENTIALS_CACHE_TTL seconds: until then they may leave a new
+credential out of the list, which only costs the round trip the list saves,
+or still list a revoked one, which holds off re-enrolling that authenticator.
+
+USER_CREDENTIALS_CACHE_SIZE bounds the number of users held; 0 disables the
+cache.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from models import WebAuthnCredential, db
+from sqlalchemy import select
+from webauthn.helpers.structs import AuthenticatorTransport, PublicKeyCredentialDescriptor
+
+USER_CREDENTIALS_CACHE_SIZE = int(os.getenv("USER_CREDENTIALS_CACHE_SIZE", "10000"))
+USER_CREDENTIALS_CACHE_TTL = float(os.getenv("USER_CREDENTIALS_CACHE_TTL", "30"))
+
+USER_CREDENTIALS_CACHE = metrics.Gauge(
+    "webauthn_user_credentials_cache", "Per-user credential ID cache counters and size", ("stat",)
+)
+
+_TRANSPORTS = {transport.value: transport for transport in AuthenticatorTransport}
+
+
+def encode_transports(transports):
+    """Column value of a credential's transports: comma separated names, or None"""
+    if not transports:
+        return None
+    return ",".join(getattr(transport, "value", transport) for transport in transports)
+
+
+def decode_transports(value):
+    """The known transports in a column value, as a tuple"""
+    if not value:
+        return ()
+    return tuple(_TRANSPORTS[name] for name in value.split(",") if name in _TRANSPORTS)
+
+
+def load(user_id):
+    """(credential ID, transports) of each of a user's credentials, from the database"""
+    rows = db.session.execute(
+        select(WebAuthnCredential.credential_id, WebAuthnCredential.transports)
+        .where(WebAuthnCredential.user_id == user_id)
+        .order_by(WebAuthnCredential.id)
+    ).all()
+    return tuple((credential_id, decode_transports(transports)) for credential_id, transports in rows)
+
+
+class UserCredentialCache:
+    """Bounded LRU of users' credential IDs, each entry expiring after ttl seconds"""
+
+    def __init__(self, max_entries=USER_CREDENTIALS_CACHE_SIZE, ttl=USER_CREDENTIALS_CACHE_TTL,
+                 clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        # user id -> (expires at, ((credential ID, transports), ...))
+        self._entries = OrderedDict()
+        # user id -> token of the latest load in flight; invalidating a user
+        # drops it, so a load that read the old credentials isn't stored
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id, loader=load):
+        """A user's (credential ID, transports) pairs, loading them on a miss"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            token = self._loading[user_id] = object()
+
+        try:
+            credentials = loader(user_id)
+        except Exception:
+            with self._lock:
+                if self._loading.get(user_id) is token:
+                    del self._loading[user_id]
+            raise
+
+        with self._lock:
+            if self._loading.get(user_id) is not token:
+                # Invalidated, or loaded again, while this load ran
+                return credentials
+            del self._loading[user_id]
+            self._entries[user_id] = (self.clock() + self.ttl, credentials)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return credentials
+
+    def invalidate(self, user_ids):
+        """Drop the entries of users whose credentials changed"""
+        with self._lock:
+            for user_id in user_ids:
+                self._loading.pop(user_id, None)
+                if self._entries.pop(user_id, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._loading.clear()
+
+    def stats(self):
+        """Hit, miss, eviction, invalidation and size counters"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "size": len(self._entries),
+                "max_size": self.max_entries,
+            }
+
+
+CACHE = UserCredentialCache() if USER_CREDENTIALS_CACHE_SIZE > 0 else None
+
+if CACHE is not None:
+    for _stat in ("hits", "misses", "evictions", "invalidations", "size", "max_size"):
+        USER_CREDENTIALS_CACHE.labels(_stat).set_function(lambda stat=_stat: CACHE.stats()[stat])
+
+
+def credentials(user_id):
+    """(credential ID, transports) of each of a user's credentials; needs an app context"""
+    if CACHE is None:
+        return load(user_id)
+    return CACHE.get(user_id)
+
+
+def descriptors(user_id):
+    """A user's credentials as descriptors for excludeCredentials"""
+    return [
+        PublicKeyCredentialDescriptor(id=credential_id, transports=list(transports) or None)
+        for credential_id, transports in credentials(user_id)
+    ]
+
+
+def invalidate(user_ids):
+    """Drop cached credential IDs of users who added or revoked credentials"""
+    if CACHE is not None:
+        CACHE.invalidate(user_ids)
+
+
+def clear():
+    """Drop every cached entry, e.g. after the credential table was replaced"""
+    if CACHE is not None:
+        CACHE.clear()
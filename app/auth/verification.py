@@ -0,0 +1,223 @@
+"""
+Attestation verification executor
+
+``verify_registration_response`` decodes CBOR, checks signatures and, for
+packed and tpm attestation, validates certificate chains, all while holding
+the GIL. With VERIFY_PROCESSES set, that work runs in a pool of worker
+processes instead, so a burst of registrations doesn't stall the other
+requests in the process.
+
+At most VERIFY_QUEUE_SIZE verifications may be queued or running at once;
+beyond that new ones are rejected straight away with VerificationRejected,
+and one that takes longer than VERIFY_TIMEOUT seconds raises
+VerificationTimeout. Both are meant to become a 503 for the client.
+
+With VERIFY_PROCESSES=0 (the default) verification runs inline, or for the
+ASGI endpoints in a thread, so it never runs on the event loop.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+import webauthn
+
+logger = logging.getLogger(__name__)
+
+VERIFY_PROCESSES = int(os.getenv("VERIFY_PROCESSES", "0"))
+VERIFY_QUEUE_SIZE = int(os.getenv("VERIFY_QUEUE_SIZE", str(max(1, VERIFY_PROCESSES) * 8)))
+VERIFY_TIMEOUT = float(os.getenv("VERIFY_TIMEOUT", "5"))
+
+VERIFY_JOBS = metrics.Counter(
+    "webauthn_verify_jobs_total", "Attestation verifications by outcome", ("outcome",)
+)
+VERIFY_JOB_SECONDS = metrics.Histogram(
+    "webauthn_verify_job_seconds", "Attestation verification time including queueing"
+)
+VERIFY_POOL = metrics.Gauge(
+    "webauthn_verify_pool", "Verification pool workers, busy workers and queued jobs", ("stat",)
+)
+
+
+class VerificationRejected(Exception):
+    """The verification queue is full"""
+
+
+class VerificationTimeout(Exception):
+    """A verification didn't finish within the timeout"""
+
+
+def _verify_registration(kwargs):
+    # Runs in a worker process
+    return webauthn.verify_registration_response(**kwargs)
+
+
+class VerificationExecutor:
+    """Bounded process pool for registration verification"""
+
+    def __init__(self, processes=VERIFY_PROCESSES, queue_size=VERIFY_QUEUE_SIZE, timeout=VERIFY_TIMEOUT):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._in_flight = 0
+
+    def _get_pool(self):
+        # Created on first use, so each forked server worker gets its own
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    methods = multiprocessing.get_all_start_methods()
+                    # Forking a process that runs threads isn't safe
+                    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+                    self._pool = concurrent.futures.ProcessPoolExecutor(self.processes, mp_context=context)
+        return self._pool
+
+    def stats(self):
+        """Workers, busy workers and queued jobs"""
+        in_flight = self._in_flight
+        return {
+            "workers": self.processes,
+            "busy": min(in_flight, self.processes),
+            "queued": max(0, in_flight - self.processes),
+        }
+
+    def check_capacity(self):
+        """Raise VerificationRejected if the queue is currently full"""
+        if self._in_flight >= self.queue_size:
+            VERIFY_JOBS.labels("rejected").inc()
+            raise VerificationRejected("Verification queue is full")
+
+    def _submit(self, kwargs):
+        if not self._slots.acquire(blocking=False):
+            VERIFY_JOBS.labels("rejected").inc()
+            raise VerificationRejected("Verification queue is full")
+        with self._lock:
+            self._in_flight += 1
+        try:
+            future = self._get_pool().submit(_verify_registration, kwargs)
+        except BaseException:
+            self._job_done(None)
+            raise
+        # The slot is held until the job really finishes, even after the
+        # caller has given up waiting on it
+        future.add_done_callback(self._job_done)
+        return future
+
+    def _job_done(self, _future):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _reset_broken_pool(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+        logger.error("Verification worker died; the pool will be recreated")
+
+    def verify_registration_response(self, **kwargs):
+        """``webauthn.verify_registration_response`` in a worker process"""
+        start = time.perf_counter()
+        future = self._submit(kwargs)
+        pool = self._pool
+        try:
+            result = future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            VERIFY_JOBS.labels("timeout").inc()
+            raise VerificationTimeout(f"Verification took longer than {self.timeout}s") from None
+        except BrokenProcessPool:
+            self._reset_broken_pool(pool)
+            VERIFY_JOBS.labels("error").inc()
+            raise
+        except Exception:
+            VERIFY_JOBS.labels("error").inc()
+            raise
+        finally:
+            VERIFY_JOB_SECONDS.observe(time.perf_counter() - start)
+        VERIFY_JOBS.labels("ok").inc()
+        return result
+
+    async def verify_registration_response_async(self, **kwargs):
+        """Awaitable ``verify_registration_response``"""
+        start = time.perf_counter()
+        future = self._submit(kwargs)
+        pool = self._pool
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            VERIFY_JOBS.labels("timeout").inc()
+            raise VerificationTimeout(f"Verification took longer than {self.timeout}s") from None
+        except BrokenProcessPool:
+            self._reset_broken_pool(pool)
+            VERIFY_JOBS.labels("error").inc()
+            raise
+        except Exception:
+            VERIFY_JOBS.labels("error").inc()
+            raise
+        finally:
+            VERIFY_JOB_SECONDS.observe(time.perf_counter() - start)
+        VERIFY_JOBS.labels("ok").inc()
+        return result
+
+    def after_fork(self):
+        """
+        Forget the parent's pool and jobs in a forked child; a pool is
+        created again on first use
+        """
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._in_flight = 0
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+EXECUTOR = VerificationExecutor() if VERIFY_PROCESSES > 0 else None
+
+if EXECUTOR is not None:
+    for _stat in ("workers", "busy", "queued"):
+        VERIFY_POOL.labels(_stat).set_function(lambda stat=_stat: EXECUTOR.stats()[stat])
+
+
+def check_capacity():
+    """
+    Reject early, before a ceremony's challenge is consumed, so the client
+    can retry it once the queue drains
+    """
+    if EXECUTOR is not None:
+        EXECUTOR.check_capacity()
+
+
+def verify_registration_response(**kwargs):
+    """Verify a registration response, in the pool if one is configured"""
+    if EXECUTOR is None:
+        return webauthn.verify_registration_response(**kwargs)
+    return EXECUTOR.verify_registration_response(**kwargs)
+
+
+def after_fork():
+    """Reset the pool in a forked server worker"""
+    if EXECUTOR is not None:
+        EXECUTOR.after_fork()
+
+
+async def verify_registration_response_async(**kwargs):
+    """Awaitable ``verify_registration_response`` for the ASGI endpoints"""
+    if EXECUTOR is None:
+        # Off the event loop, which would otherwise stall every connection
+        return await asyncio.to_thread(webauthn.verify_registration_response, **kwargs)
+    return await EXECUTOR.verify_registration_response_async(**kwargs)
@@ -1,16 +1,61 @@
 import datetime
-import traceback
-
-from auth import security
-from flask import Blueprint, abort, make_response, render_template, request, session
+import functools
+import json
+import logging
+import secrets
+import uuid
+
+import metrics
+from auth import audit, limits, payloads, resilience, security, user_credentials, verification
+from auth.resilience import StoreUnavailable
+from flask import Blueprint, abort, make_response, redirect, render_template, request, session, url_for
 from models import User, db
 from sqlalchemy.exc import IntegrityError
-from webauthn.helpers.exceptions import InvalidRegistrationResponse
-from webauthn.helpers.structs import RegistrationCredential
+from webauthn.helpers import bytes_to_base64url
+from webauthn.helpers.exceptions import InvalidAuthenticationResponse, InvalidRegistrationResponse
+
+logger = logging.getLogger(__name__)
 
 auth = Blueprint("auth", __name__, template_folder="templates")
 
 
+def _refused_response(status, retry_after, form=None):
+    if status == 429:
+        error = "Too many attempts. Please wait a moment and try again."
+    else:
+        error = "Server busy. Please try again."
+    if form:
+        res = make_response(render_template(form, error=error), status)
+    else:
+        res = make_response(f'{{"verified": false, "error": "{error}"}}', status)
+    res.headers["Retry-After"] = str(retry_after)
+    return res
+
+
+def _admitted(form=None, identities=None):
+    """
+    Run a view only once admission control lets its request in (see
+    auth.limits); otherwise answer 429 or 503 straight away, with the form
+    partial re-rendered if the view is a form
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            refusal = limits.admit(request.endpoint, request.remote_addr, identities() if identities else ())
+            if refusal is not None:
+                return _refused_response(*refusal, form=form)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                limits.done()
+        return wrapper
+    return decorator
+
+
+def _form_identities():
+    return request.form.get("username", ""), request.form.get("email", "")
+
+
 @auth.route("/register")
 def register():
     """Show the form to register a new user"""
@@ -18,30 +63,30 @@ def register():
 
 
 @auth.route("/create-user", methods=["POST"])
+@_admitted(form="auth/_partials/user_creation_form.html", identities=_form_identities)
 def create_user():
     """Create a new user"""
     try:
-        name = request.form.get("name", "").strip()
-        username = request.form.get("username", "").strip()
-        email = request.form.get("email", "").strip()
+        with metrics.timed("form_validation"):
+            name = request.form.get("name", "").strip()
+            username = request.form.get("username", "").strip()
+            email = request.form.get("email", "").strip()
 
-        # Validation
-        if not username:
-            return render_template(
-                "auth/_partials/user_creation_form.html",
-                error="Username is required."
-            )
+            # Validation
+            error = None
+            if not username:
+                error = "Username is required."
+            elif not email:
+                error = "Email is required."
 
-        if not email:
-            return render_template(
-                "auth/_partials/user_creation_form.html",
-                error="Email is required."
-            )
+        if error:
+            return render_template("auth/_partials/user_creation_form.html", error=error)
 
         # Check if user already exists
-        existing_user = User.query.filter(
-            (User.username == username) | (User.email == email)
-        ).first()
+        with metrics.timed("uniqueness_query"):
+            existing_user = User.query.filter(
+                (User.username == username) | (User.email == email)
+            ).first()
 
         if existing_user:
             return render_template(
@@ -50,16 +95,20 @@ def create_user():
                 "Please enter a different one.",
             )
 
+        if security.REGISTRATION_MODE == "deferred":
+            return _start_pending_registration(name or username, username, email)
+
         # Create user
-        user = User(name=name or username, username=username, email=email)
+        user = User(name=name or username, username=username, email=email, signup_pending=True)
 
         try:
-            db.session.add(user)
-            db.session.commit()
-            print(f"User created successfully: {user.username}")
+            with metrics.timed("user_insert"):
+                db.session.add(user)
+                db.session.commit()
+            logger.debug("User created successfully: %s", user.username)
         except IntegrityError as e:
             db.session.rollback()
-            print(f"IntegrityError creating user: {e}")
+            logger.warning("IntegrityError creating user: %s", e)
             return render_template(
                 "auth/_partials/user_creation_form.html",
                 error="That username or email address is already in use. "
@@ -69,20 +118,21 @@ def create_user():
         # Generate WebAuthn credential creation options
         try:
             pcco_json = security.prepare_credential_creation(user)
-            print(f"WebAuthn options generated for user: {user.username}")
+            logger.debug("WebAuthn options generated for user: %s", user.username)
         except Exception as e:
-            print(f"Error generating WebAuthn options: {e}")
-            print(f"Full traceback: {traceback.format_exc()}")
+            logger.warning("Error generating WebAuthn options: %s", e, exc_info=True)
 
             # Clean up user if WebAuthn setup fails
             try:
                 db.session.delete(user)
                 db.session.commit()
-                print(f"Cleaned up user {user.username} due to WebAuthn setup failure")
+                logger.info("Cleaned up user %s due to WebAuthn setup failure", user.username)
             except Exception as cleanup_error:
-                print(f"Error cleaning up user: {cleanup_error}")
+                logger.error("Error cleaning up user: %s", cleanup_error)
                 db.session.rollback()
 
+            if isinstance(e, StoreUnavailable):
+                raise
             return render_template(
                 "auth/_partials/user_creation_form.html",
                 error="Failed to set up authentication. Please try again."
@@ -100,214 +150,478 @@ def create_user():
 
         return res
 
+    except StoreUnavailable as e:
+        return _store_unavailable_form("auth/_partials/user_creation_form.html", e)
     except Exception as e:
-        print(f"Unexpected error in create_user: {e}")
-        print(f"Full traceback: {traceback.format_exc()}")
+        logger.error("Unexpected error in create_user: %s", e, exc_info=True)
         return render_template(
             "auth/_partials/user_creation_form.html",
             error="An unexpected error occurred. Please try again."
         )
 
 
-def parse_registration_credential(credential_data):
-    """Parse WebAuthn registration credential, handling browser compatibility issues"""
-    try:
-        print(f"Raw credential data received: {credential_data}")
-
-        # Handle different WebAuthn response formats
-        if not isinstance(credential_data, dict):
-            raise ValueError("Credential data must be a dictionary")
-
-        # The browser sends 'rawId' but Python webauthn library expects 'raw_id'
-        # Map rawId to both id and raw_id
-        if 'rawId' in credential_data:
-            if 'id' not in credential_data:
-                credential_data['id'] = credential_data['rawId']
-            # Map rawId to raw_id for the webauthn library - convert base64url to bytes
-            import base64
-            # Add padding if needed for base64url decoding
-            raw_id_str = credential_data['rawId']
-            # Add padding to make length multiple of 4
-            raw_id_str += '=' * (4 - len(raw_id_str) % 4) if len(raw_id_str) % 4 else ''
-            credential_data['raw_id'] = base64.urlsafe_b64decode(raw_id_str)
-            # Remove rawId to avoid conflicts
-            del credential_data['rawId']
-
-        # Ensure required fields are present
-        required_fields = ['id', 'response', 'type']
-        missing_fields = [field for field in required_fields if field not in credential_data]
-        if missing_fields:
-            raise ValueError(f"Missing required fields: {missing_fields}")
-
-        # Ensure raw_id is present
-        if 'raw_id' not in credential_data:
-            raise ValueError("Missing raw_id field after mapping from rawId")
-
-        # Clean up the data - only keep fields the library expects
-        # Based on webauthn library version 2.7.0, RegistrationCredential expects:
-        expected_fields = {
-            'id', 'raw_id', 'response', 'type'
-        }
+def _start_pending_registration(name, username, email):
+    """
+    Hold the username and email and issue registration options without
+    writing anything to the database; the user is created once their
+    credential verifies.
+    """
+    user_uid = str(uuid.uuid4())
+    if not security.reserve_registration(user_uid, username, email):
+        return render_template(
+            "auth/_partials/user_creation_form.html",
+            error="That username or email address is already in use. "
+            "Please enter a different one.",
+        )
 
-        cleaned_data = {k: v for k, v in credential_data.items() if k in expected_fields}
+    try:
+        pcco_json = security.prepare_pending_registration(user_uid, name, username, email)
+    except Exception as e:
+        logger.warning("Error generating WebAuthn options: %s", e, exc_info=True)
+        security.release_registration(user_uid, username, email)
+        if isinstance(e, StoreUnavailable):
+            raise
+        return render_template(
+            "auth/_partials/user_creation_form.html",
+            error="Failed to set up authentication. Please try again."
+        )
 
-        print(f"Cleaned credential data: {cleaned_data}")
+    session["registration_user_uid"] = user_uid
+    session["registration_pending"] = True
 
-        # Create the RegistrationCredential object
-        # The webauthn library expects specific field names and structure
-        if 'response' in cleaned_data and isinstance(cleaned_data['response'], dict):
-            response_dict = cleaned_data['response'].copy()
+    return render_template(
+        "auth/_partials/register_credential.html",
+        public_credential_creation_options=pcco_json,
+    )
 
-            # Create a proper response object structure
-            from webauthn.helpers.structs import AuthenticatorAttestationResponse
-            import base64
 
-            # Map the browser field names to what the library expects and decode base64 data
-            response_data = {}
-            if 'clientDataJSON' in response_dict:
-                # Decode base64 clientDataJSON to bytes
-                client_data_b64 = response_dict['clientDataJSON']
-                # Add padding if needed
-                client_data_b64 += '=' * (4 - len(client_data_b64) % 4) if len(client_data_b64) % 4 else ''
-                response_data['client_data_json'] = base64.urlsafe_b64decode(client_data_b64)
-            if 'attestationObject' in response_dict:
-                # Decode base64 attestationObject to bytes
-                attestation_b64 = response_dict['attestationObject']
-                # Add padding if needed
-                attestation_b64 += '=' * (4 - len(attestation_b64) % 4) if len(attestation_b64) % 4 else ''
-                response_data['attestation_object'] = base64.urlsafe_b64decode(attestation_b64)
+def _registered_response(user):
+    res = make_response('{"verified": true}', 201)
+    res.set_cookie(
+        "user_uid",
+        str(user.uid),
+        httponly=True,
+        secure=request.is_secure,
+        samesite="strict",
+        max_age=int(datetime.timedelta(days=30).total_seconds()),
+    )
+    logger.info("WebAuthn credential successfully registered for user: %s", user.username)
+    audit.record("registration.succeeded", user.uid, user.username)
+    return res
 
-            # Create the AuthenticatorAttestationResponse object
-            cleaned_data['response'] = AuthenticatorAttestationResponse(**response_data)
 
-        print(f"Final credential data structure: {type(cleaned_data['response'])}")
-        registration_credential = RegistrationCredential(**cleaned_data)
+def _add_pending_credential(user_uid):
+    """Verify the first credential of a pending signup and create the user"""
+    try:
+        with metrics.timed("credential_parse"):
+            credential_data = payloads.read_json(request, "registration")
+            if not credential_data:
+                logger.info("No JSON data received")
+                return make_response('{"verified": false, "error": "No credential data received"}', 400)
 
-        return registration_credential
+            registration_credential = payloads.decode_registration(credential_data)
+    except Exception as e:
+        logger.warning("Error parsing credential data: %s", e)
+        audit.record("registration.failed", user_uid, reason="credential parsing failure")
+        security.cancel_pending_registration(user_uid)
+        session.pop("registration_user_uid", None)
+        session.pop("registration_pending", None)
+        return _invalid_credential_response(e)
+
+    # The pending registration is consumed either way, so the browser has
+    # to start over after a failure
+    session.pop("registration_user_uid", None)
+    session.pop("registration_pending", None)
 
+    try:
+        user = security.verify_pending_registration(user_uid, registration_credential)
+    except InvalidRegistrationResponse as e:
+        logger.warning("Registration verification failed: %s", e)
+        audit.record("registration.failed", user_uid, reason="verification failure")
+        return make_response('{"verified": false, "error": "Registration verification failed"}', 400)
+    except ValueError as e:
+        logger.info("Pending registration not found: %s", e)
+        return make_response('{"verified": false, "error": "Registration expired. Please start again."}', 400)
+    except IntegrityError as e:
+        logger.warning("IntegrityError creating user: %s", e)
+        audit.record("registration.failed", user_uid, reason="username or email in use")
+        return make_response('{"verified": false, "error": "Username or email already in use"}', 409)
+    except (verification.VerificationRejected, verification.VerificationTimeout) as e:
+        return _verifier_busy_response(e)
+    except StoreUnavailable as e:
+        return _store_unavailable_response(e)
     except Exception as e:
-        print(f"Error parsing registration credential: {e}")
-        print(f"Full traceback: {traceback.format_exc()}")
-        raise
+        logger.error("Unexpected error during verification: %s", e, exc_info=True)
+        return make_response('{"verified": false, "error": "Verification failed"}', 500)
+
+    return _registered_response(user)
+
+
+def _invalid_credential_response(error):
+    """400 for a credential payload that couldn't be decoded, 413 for one too large to read"""
+    status = 413 if isinstance(error, payloads.PayloadTooLarge) else 400
+    return make_response(json.dumps({"verified": False, "error": f"Invalid credential data: {error}"}), status)
+
+
+def _verifier_busy_response(error):
+    logger.warning("Credential verification unavailable: %s", error)
+    res = make_response('{"verified": false, "error": "Server busy. Please try again."}', 503)
+    res.headers["Retry-After"] = "1"
+    return res
+
+
+def _store_unavailable_response(error):
+    logger.warning("Challenge store unavailable: %s", error)
+    res = make_response('{"verified": false, "error": "Service temporarily unavailable. Please try again."}', 503)
+    res.headers["Retry-After"] = str(resilience.retry_after(error))
+    return res
+
+
+def _store_unavailable_form(template, error):
+    logger.warning("Challenge store unavailable: %s", error)
+    res = make_response(
+        render_template(template, error="Sign-in is temporarily unavailable. Please try again in a moment."), 503
+    )
+    res.headers["Retry-After"] = str(resilience.retry_after(error))
+    return res
+
+
+def _discard_registering_user(user, reason):
+    """Delete a user whose first credential could not be registered"""
+    audit.record("registration.failed", user.uid, user.username, reason=reason)
+    try:
+        logger.info("Cleaning up user %s due to %s", user.username, reason)
+        session.pop("registration_user_uid", None)
+        db.session.delete(user)
+        db.session.commit()
+        logger.debug("Successfully cleaned up user %s", user.username)
+    except Exception as cleanup_error:
+        logger.error("Error cleaning up user: %s", cleanup_error)
+        db.session.rollback()
 
 
 @auth.route("/add-credential", methods=["POST"])
+@_admitted()
 def add_credential():
     """Receive a newly registered credentials to validate and save."""
     try:
         user_uid = session.get("registration_user_uid")
         if not user_uid:
-            print("No user UID found in session")
+            logger.info("No user UID found in session")
             return make_response('{"verified": false, "error": "User not found in session"}', 400)
 
+        try:
+            verification.check_capacity()
+        except verification.VerificationRejected as e:
+            return _verifier_busy_response(e)
+
+        if session.get("registration_pending"):
+            return _add_pending_credential(user_uid)
+
         user = User.query.filter_by(uid=user_uid).first()
         if user is None:
-            print(f"No user found with UID: {user_uid}")
+            logger.info("No user found with UID: %s", user_uid)
             return make_response('{"verified": false, "error": "User not found"}', 400)
 
         try:
-            credential_data = request.get_json()
-            if not credential_data:
-                print("No JSON data received")
-                return make_response('{"verified": false, "error": "No credential data received"}', 400)
+            with metrics.timed("credential_parse"):
+                credential_data = payloads.read_json(request, "registration")
+                if not credential_data:
+                    logger.info("No JSON data received")
+                    return make_response('{"verified": false, "error": "No credential data received"}', 400)
 
-            registration_credential = parse_registration_credential(credential_data)
+                registration_credential = payloads.decode_registration(credential_data)
 
         except Exception as e:
-            print(f"Error parsing credential data: {e}")
-            print(f"Full traceback: {traceback.format_exc()}")
-
-            # Clean up user if credential parsing fails
-            try:
-                print(f"Cleaning up user {user.username} due to credential parsing failure")
-                session.pop("registration_user_uid", None)
-                db.session.delete(user)
-                db.session.commit()
-                print(f"Successfully cleaned up user {user.username}")
-            except Exception as cleanup_error:
-                print(f"Error cleaning up user: {cleanup_error}")
-                db.session.rollback()
+            logger.warning("Error parsing credential data: %s", e)
+            _discard_registering_user(user, "credential parsing failure")
 
-            return make_response(f'{{"verified": false, "error": "Invalid credential data: {str(e)}"}}', 400)
+            return _invalid_credential_response(e)
 
         try:
-            print(f"Attempting to verify and save credential for user: {user.username}")
+            logger.debug("Attempting to verify and save credential for user: %s", user.username)
             security.verify_and_save_credential(user, registration_credential)
 
             # Clear session only after successful verification
             session.pop("registration_user_uid", None)
 
-            res = make_response('{"verified": true}', 201)
-            res.set_cookie(
-                "user_uid",
-                str(user.uid),
-                httponly=True,
-                secure=request.is_secure,
-                samesite="strict",
-                max_age=int(datetime.timedelta(days=30).total_seconds()),
-            )
-            print(f"✅ WebAuthn credential successfully registered for user: {user.username}")
-            return res
+            return _registered_response(user)
 
         except InvalidRegistrationResponse as e:
-            print(f"Registration verification failed: {e}")
-            print(f"Full traceback: {traceback.format_exc()}")
-
-            # Clean up user if verification fails
-            try:
-                print(f"Cleaning up user {user.username} due to verification failure")
-                session.pop("registration_user_uid", None)
-                db.session.delete(user)
-                db.session.commit()
-                print(f"Successfully cleaned up user {user.username}")
-            except Exception as cleanup_error:
-                print(f"Error cleaning up user: {cleanup_error}")
-                db.session.rollback()
+            logger.warning("Registration verification failed: %s", e, exc_info=True)
+            _discard_registering_user(user, "verification failure")
 
             return make_response(f'{{"verified": false, "error": "Registration verification failed"}}', 400)
 
-        except Exception as e:
-            print(f"Unexpected error during verification: {e}")
-            print(f"Full traceback: {traceback.format_exc()}")
+        except (verification.VerificationRejected, verification.VerificationTimeout) as e:
+            # The challenge is gone, so the ceremony has to start over
+            _discard_registering_user(user, "verification overload")
+            return _verifier_busy_response(e)
 
-            # Clean up user if unexpected error occurs
-            try:
-                print(f"Cleaning up user {user.username} due to unexpected error")
-                session.pop("registration_user_uid", None)
-                db.session.delete(user)
-                db.session.commit()
-                print(f"Successfully cleaned up user {user.username}")
-            except Exception as cleanup_error:
-                print(f"Error cleaning up user: {cleanup_error}")
-                db.session.rollback()
+        except StoreUnavailable as e:
+            _discard_registering_user(user, "challenge store outage")
+            return _store_unavailable_response(e)
+
+        except Exception as e:
+            logger.error("Unexpected error during verification: %s", e, exc_info=True)
+            _discard_registering_user(user, "unexpected error")
 
             return make_response(f'{{"verified": false, "error": "Verification failed"}}', 500)
 
     except Exception as e:
-        print(f"Unexpected error in add_credential: {e}")
-        print(f"Full traceback: {traceback.format_exc()}")
+        logger.error("Unexpected error in add_credential: %s", e, exc_info=True)
         return make_response('{"verified": false, "error": "Internal server error"}', 500)
 
 
 @auth.route("/cleanup-failed-registration", methods=["POST"])
+@_admitted()
 def cleanup_failed_registration():
     """Clean up failed registration attempts"""
     try:
         user_uid = session.get("registration_user_uid")
-        if user_uid:
+        if user_uid and session.pop("registration_pending", None):
+            security.cancel_pending_registration(user_uid)
+            session.pop("registration_user_uid", None)
+            logger.info("Cancelled pending registration %s", user_uid)
+            audit.record("registration.cancelled", user_uid)
+        elif user_uid:
             user = User.query.filter_by(uid=user_uid).first()
             if user:
+                security.cancel_credential_creation(user)
                 db.session.delete(user)
                 db.session.commit()
                 session.pop("registration_user_uid", None)
-                print(f"Cleaned up failed registration for user: {user.username}")
+                logger.info("Cleaned up failed registration for user: %s", user.username)
+                audit.record("registration.cancelled", user.uid, user.username)
 
         return make_response('{"cleaned": true}', 200)
     except Exception as e:
-        print(f"Error in cleanup: {e}")
+        logger.warning("Error in cleanup: %s", e)
         return make_response('{"cleaned": false}', 500)
 
 
 @auth.route("/login")
 def login():
-    return "Login user"
+    """Show the form to log in with a registered credential"""
+    return render_template("auth/login.html")
+
+
+@auth.route("/start-login", methods=["POST"])
+def start_login():
+    """Generate authentication options for the user logging in"""
+    username = request.form.get("username", "").strip()
+    if not username:
+        return render_template(
+            "auth/_partials/login_form.html",
+            error="Username is required."
+        )
+
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        return render_template(
+            "auth/_partials/login_form.html",
+            error="No account found with that username."
+        )
+
+    # The challenge is bound to this browser session rather than to the user,
+    # so parallel login attempts for one account don't clobber each other
+    login_id = secrets.token_urlsafe(16)
+    try:
+        pcro_json = security.prepare_login(user, login_id)
+    except StoreUnavailable as e:
+        return _store_unavailable_form("auth/_partials/login_form.html", e)
+    except Exception as e:
+        logger.warning("Error generating WebAuthn login options: %s", e)
+        return render_template(
+            "auth/_partials/login_form.html",
+            error="Unable to start login for that account. Please try again."
+        )
+
+    session["login_id"] = login_id
+
+    return render_template(
+        "auth/_partials/login_credential.html",
+        public_credential_request_options=pcro_json,
+    )
+
+
+@auth.route("/discoverable-login-options", methods=["POST"])
+def discoverable_login_options():
+    """Generate options for a username-less login with a discoverable credential"""
+    login_id = secrets.token_urlsafe(16)
+    try:
+        pcro_json = security.prepare_discoverable_login(login_id)
+    except StoreUnavailable as e:
+        return _store_unavailable_response(e)
+    except Exception as e:
+        logger.warning("Error generating discoverable login options: %s", e)
+        return make_response('{"error": "Unable to start login"}', 500)
+
+    session["login_id"] = login_id
+
+    res = make_response(pcro_json, 200)
+    res.mimetype = "application/json"
+    return res
+
+
+@auth.route("/verify-login", methods=["POST"])
+def verify_login():
+    """Verify an assertion from the browser and log the user in"""
+    login_id = session.pop("login_id", None)
+    if not login_id:
+        return make_response('{"verified": false, "error": "No login in progress"}', 400)
+
+    try:
+        with metrics.timed("credential_parse"):
+            credential_data = payloads.read_json(request, "authentication")
+            if not credential_data:
+                return make_response('{"verified": false, "error": "No credential data received"}', 400)
+
+            authentication_credential = payloads.decode_authentication(credential_data)
+    except Exception as e:
+        logger.warning("Error parsing authentication credential: %s", e)
+        status = 413 if isinstance(e, payloads.PayloadTooLarge) else 400
+        return make_response('{"verified": false, "error": "Invalid credential data"}', status)
+
+    try:
+        user_uid, username = security.verify_login(login_id, authentication_credential)
+    except (InvalidAuthenticationResponse, ValueError) as e:
+        logger.warning("Authentication verification failed: %s", e)
+        audit.record("login.failed", credential_id=authentication_credential.id, reason=str(e))
+        return make_response('{"verified": false, "error": "Authentication failed"}', 400)
+    except StoreUnavailable as e:
+        return _store_unavailable_response(e)
+    except Exception as e:
+        logger.error("Unexpected error during authentication: %s", e, exc_info=True)
+        return make_response('{"verified": false, "error": "Verification failed"}', 500)
+
+    session["user_uid"] = user_uid
+
+    res = make_response('{"verified": true}', 200)
+    res.set_cookie(
+        "user_uid",
+        str(user_uid),
+        httponly=True,
+        secure=request.is_secure,
+        samesite="strict",
+        max_age=int(datetime.timedelta(days=30).total_seconds()),
+    )
+    logger.info("User logged in: %s", username)
+    audit.record("login.succeeded", user_uid, username, credential_id=authentication_credential.id)
+    return res
+
+
+def _session_user():
+    """The logged-in user, or None"""
+    user_uid = session.get("user_uid")
+    if not user_uid:
+        return None
+    return User.query.filter_by(uid=user_uid).first()
+
+
+def _devices(user):
+    """The user's credentials as the device list shows them"""
+    return [
+        {
+            "credential_id": bytes_to_base64url(row.credential_id),
+            # Enough of the ID to tell devices apart
+            "label": bytes_to_base64url(row.credential_id)[:16],
+            "transports": ", ".join(t.value for t in user_credentials.decode_transports(row.transports)),
+            "last_used_at": row.last_used_at,
+        }
+        for row in security.list_credentials(user)
+    ]
+
+
+@auth.route("/devices")
+def devices():
+    """Show the logged-in user's credentials, to add or remove devices"""
+    user = _session_user()
+    if user is None:
+        return redirect(url_for("auth.login"))
+    return render_template("auth/devices.html", user=user, devices=_devices(user))
+
+
+@auth.route("/add-device-options", methods=["POST"])
+def add_device_options():
+    """Registration options for another credential of the logged-in user"""
+    user = _session_user()
+    if user is None:
+        return make_response('{"error": "Not logged in"}', 401)
+
+    try:
+        pcco_json = security.prepare_credential_creation(user)
+    except StoreUnavailable as e:
+        return _store_unavailable_response(e)
+    except Exception as e:
+        logger.warning("Error generating WebAuthn options: %s", e)
+        return make_response('{"error": "Unable to start registration"}', 500)
+
+    res = make_response(pcco_json, 200)
+    res.mimetype = "application/json"
+    return res
+
+
+@auth.route("/add-device", methods=["POST"])
+@_admitted()
+def add_device():
+    """Verify and save another credential of the logged-in user"""
+    user = _session_user()
+    if user is None:
+        return make_response('{"verified": false, "error": "Not logged in"}', 401)
+
+    try:
+        verification.check_capacity()
+    except verification.VerificationRejected as e:
+        return _verifier_busy_response(e)
+
+    try:
+        with metrics.timed("credential_parse"):
+            credential_data = payloads.read_json(request, "registration")
+            if not credential_data:
+                return make_response('{"verified": false, "error": "No credential data received"}', 400)
+            registration_credential = payloads.decode_registration(credential_data)
+    except Exception as e:
+        logger.warning("Error parsing credential data: %s", e)
+        security.cancel_credential_creation(user)
+        return _invalid_credential_response(e)
+
+    try:
+        security.verify_and_save_credential(user, registration_credential)
+    except (InvalidRegistrationResponse, ValueError) as e:
+        logger.warning("Registration verification failed: %s", e)
+        return make_response('{"verified": false, "error": "Registration verification failed"}', 400)
+    except IntegrityError as e:
+        db.session.rollback()
+        logger.info("Credential already registered: %s", e)
+        return make_response('{"verified": false, "error": "This device is already registered"}', 409)
+    except (verification.VerificationRejected, verification.VerificationTimeout) as e:
+        return _verifier_busy_response(e)
+    except StoreUnavailable as e:
+        return _store_unavailable_response(e)
+    except Exception as e:
+        logger.error("Unexpected error during verification: %s", e, exc_info=True)
+        return make_response('{"verified": false, "error": "Verification failed"}', 500)
+
+    audit.record("credential.added", user.uid, user.username, credential_id=registration_credential.id)
+    return make_response('{"verified": true}', 201)
+
+
+@auth.route("/revoke-credential", methods=["POST"])
+def revoke_credential():
+    """Remove one of the logged-in user's credentials; re-renders the device list"""
+    user = _session_user()
+    if user is None:
+        abort(401)
+
+    error = None
+    try:
+        credential_id = payloads.decode_bytes(
+            request.form.get("credential_id", ""), "credential_id", payloads.MAX_CREDENTIAL_ID_BYTES
+        )
+        security.revoke_credential(user, credential_id)
+        audit.record("credential.revoked", user.uid, user.username,
+                     credential_id=bytes_to_base64url(credential_id))
+    except ValueError as e:
+        error = str(e)
+    return render_template("auth/_partials/device_list.html", devices=_devices(user), error=error)
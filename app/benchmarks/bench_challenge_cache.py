@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+In-process challenge cache flood benchmark
+
+Simulates a registration flood in which most ceremonies are abandoned, from
+several threads at once, and reports throughput, the cache counters and the
+memory held by the cache afterwards.
+
+Run from the app directory:
+
+    python -m benchmarks.bench_challenge_cache [ceremonies] [threads]
+"""
+
+import secrets
+import sys
+import threading
+import time
+import tracemalloc
+
+from auth.challenges import MemoryChallengeStore
+
+
+def flood(store, ceremonies, threads, completed_ratio=0.1):
+    """Start ceremonies from several threads, completing only a fraction"""
+    per_thread = ceremonies // threads
+    complete_every = max(1, int(1 / completed_ratio))
+
+    def worker(thread_no):
+        challenge = secrets.token_bytes(64)
+        for i in range(per_thread):
+            key = f"{thread_no}:{i}"
+            store.put(key, challenge)
+            if i % complete_every == 0:
+                store.consume(key)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    ceremonies = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    tracemalloc.start()
+    store = MemoryChallengeStore(max_entries=50000, sweep_interval=0)
+    elapsed = flood(store, ceremonies, threads)
+    current, peak = tracemalloc.get_traced_memory()
+
+    print(f"{ceremonies} ceremonies from {threads} threads in {elapsed:.2f}s "
+          f"({ceremonies / elapsed:,.0f} ops/s)")
+    print(f"cache stats: {store.stats()}")
+    print(f"memory: {current / 1e6:.1f} MB held, {peak / 1e6:.1f} MB peak")
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Challenge store micro-benchmark
+
+Compares the original JSON/base64 challenge envelope with GET + DEL against
+the raw-bytes encoding consumed with a single GETDEL, and both against signed
+challenges carried in the session (CHALLENGE_MODE=signed), which only write
+a replay marker. The CPU cost and the store operations per ceremony are
+always measured; Redis round trips and latency are measured when a server is
+reachable through REDIS_HOST/REDIS_PORT/REDIS_PASSWORD.
+
+Run from the app directory:
+
+    python -m benchmarks.bench_challenge_store [iterations]
+"""
+
+import base64
+import datetime
+import json
+import os
+import secrets
+import sys
+import time
+
+from redis import Redis
+
+from auth.challenges import MemoryChallengeStore, RedisChallengeStore, SignedChallengeStore
+
+SECRET_KEY = "bench-secret-key"
+
+
+def _legacy_encode(challenge):
+    """Challenge envelope as written by the original _store_challenge"""
+    return json.dumps({
+        "challenge": base64.b64encode(challenge).decode("utf-8"),
+        "is_bytes": True,
+        "timestamp": datetime.datetime.now().isoformat(),
+    })
+
+
+def _legacy_decode(challenge_json):
+    challenge_data = json.loads(challenge_json)
+    if challenge_data.get("is_bytes", False):
+        return base64.b64decode(challenge_data["challenge"])
+    return challenge_data["challenge"]
+
+
+class _CountingClient:
+    """Proxy around a Redis client counting commands sent to the server"""
+
+    def __init__(self, client):
+        self._client = client
+        self.commands = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name in ("set", "get", "delete", "getdel", "evalsha", "eval"):
+            def counted(*args, **kwargs):
+                self.commands += 1
+                return attr(*args, **kwargs)
+            return counted
+        return attr
+
+
+class _CountingStore:
+    """Proxy around a challenge store counting the operations it serves"""
+
+    def __init__(self, store):
+        self._store = store
+        self.operations = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if name in ("put", "consume", "discard", "reserve", "release", "advance"):
+            def counted(*args, **kwargs):
+                self.operations += 1
+                return attr(*args, **kwargs)
+            return counted
+        return attr
+
+
+def _login_ceremonies(store, iterations):
+    # Every ceremony gets its own challenge; signed mode refuses repeats
+    challenges = [secrets.token_bytes(64) for _ in range(iterations)]
+    start = time.perf_counter()
+    for i, challenge in enumerate(challenges):
+        key = f"login:{i}"
+        store.put(key, challenge)
+        assert store.consume(key) == challenge
+    return time.perf_counter() - start
+
+
+def _report(label, elapsed, iterations):
+    print(f"  {label:<28} {elapsed / iterations * 1e6:9.2f} us/ceremony")
+
+
+def bench_encoding(iterations):
+    challenge = secrets.token_bytes(64)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        _legacy_decode(_legacy_encode(challenge))
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        bytes(challenge)
+    raw = time.perf_counter() - start
+
+    print("Encoding CPU (encode + decode):")
+    _report("legacy JSON + base64", legacy, iterations)
+    _report("raw bytes", raw, iterations)
+    print(f"  legacy stored size: {len(_legacy_encode(challenge))} bytes, raw: {len(challenge)} bytes")
+
+
+def bench_signed(iterations):
+    stored = _CountingStore(MemoryChallengeStore(sweep_interval=0))
+    store_time = _login_ceremonies(stored, iterations)
+
+    backing = _CountingStore(MemoryChallengeStore(sweep_interval=0))
+    session = {}
+    signed = SignedChallengeStore(backing, lambda: session, lambda: SECRET_KEY)
+    signed_time = _login_ceremonies(signed, iterations)
+
+    print("Challenge modes, in-process store (put, then consume):")
+    _report(f"store ({stored.operations / iterations:.0f} store ops)", store_time, iterations)
+    _report(f"signed ({backing.operations / iterations:.0f} store ops)", signed_time, iterations)
+
+
+def bench_redis(iterations):
+    client = Redis(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", "6379")),
+        password=os.getenv("REDIS_PASSWORD", None),
+        socket_connect_timeout=1,
+    )
+    try:
+        client.ping()
+    except Exception as e:
+        print(f"Redis not reachable ({e}), skipping round-trip benchmark")
+        return
+
+    challenge = secrets.token_bytes(64)
+
+    legacy_client = _CountingClient(Redis(connection_pool=client.connection_pool, decode_responses=True))
+    start = time.perf_counter()
+    for i in range(iterations):
+        key = f"bench_challenge:legacy:{i}"
+        legacy_client.set(key, _legacy_encode(challenge), ex=600)
+        _legacy_decode(legacy_client.get(key))
+        legacy_client.delete(key)
+    legacy = time.perf_counter() - start
+
+    store_client = _CountingClient(client)
+    store = RedisChallengeStore(store_client, prefix="bench_challenge:store:")
+    start = time.perf_counter()
+    for i in range(iterations):
+        store.put(str(i), challenge)
+        store.consume(str(i))
+    current = time.perf_counter() - start
+
+    signed_client = _CountingClient(client)
+    session = {}
+    signed = SignedChallengeStore(
+        RedisChallengeStore(signed_client, prefix="bench_challenge:signed:"), lambda: session, lambda: SECRET_KEY
+    )
+    signed_time = _login_ceremonies(signed, iterations)
+
+    print("Redis ceremony (store, then verify):")
+    _report(f"legacy SET/GET/DEL ({legacy_client.commands / iterations:.0f} RTT)", legacy, iterations)
+    _report(f"SET + GETDEL ({store_client.commands / iterations:.0f} RTT)", current, iterations)
+    _report(f"signed, SET NX ({signed_client.commands / iterations:.0f} RTT)", signed_time, iterations)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bench_encoding(count)
+    bench_signed(count)
+    bench_redis(min(count, 5000))
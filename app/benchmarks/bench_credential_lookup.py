@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Credential lookup benchmark
+
+Fills a database with stored credentials (1M by default) and measures the
+login path's lookup of a credential by its id with and without the unique
+index, and the sign-count write as a single conditional UPDATE versus an
+ORM load-modify-commit.
+
+Run from the app directory:
+
+    python -m benchmarks.bench_credential_lookup [credentials] [database_url]
+
+The database defaults to a temporary SQLite file; pass a Postgres URL to
+benchmark against a local server. Tables are dropped and recreated.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import create_engine, insert, select, update
+from sqlalchemy.orm import Session
+
+from models import User, WebAuthnCredential, db
+
+BATCH_SIZE = 10000
+CREDENTIALS_PER_USER = 2
+
+
+def populate(engine, count):
+    """Insert count credentials spread over count / 2 users"""
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    rng = random.Random(42)
+    credential_ids = []
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        user_count = max(1, count // CREDENTIALS_PER_USER)
+        for offset in range(0, user_count, BATCH_SIZE):
+            conn.execute(insert(User.__table__), [
+                {"id": i + 1, "uid": str(uuid.uuid4()), "username": f"user{i}",
+                 "name": f"User {i}", "email": f"user{i}@example.com"}
+                for i in range(offset, min(offset + BATCH_SIZE, user_count))
+            ])
+        for offset in range(0, count, BATCH_SIZE):
+            rows = []
+            for i in range(offset, min(offset + BATCH_SIZE, count)):
+                credential_id = rng.randbytes(32)
+                credential_ids.append(credential_id)
+                rows.append({"user_id": i // CREDENTIALS_PER_USER + 1, "credential_id": credential_id,
+                             "credential_public_key": rng.randbytes(77), "current_sign_count": 0})
+            conn.execute(insert(WebAuthnCredential.__table__), rows)
+    print(f"Inserted {count:,} credentials in {time.perf_counter() - start:.1f}s")
+    return credential_ids
+
+
+def _lookup_query(credential_id):
+    return (
+        select(WebAuthnCredential.id, WebAuthnCredential.credential_public_key,
+               WebAuthnCredential.current_sign_count, User.uid, User.username)
+        .join(User, User.id == WebAuthnCredential.user_id)
+        .where(WebAuthnCredential.credential_id == credential_id)
+    )
+
+
+def bench_lookup(engine, sample, label):
+    with engine.connect() as conn:
+        start = time.perf_counter()
+        for credential_id in sample:
+            assert conn.execute(_lookup_query(credential_id)).first() is not None
+        elapsed = time.perf_counter() - start
+    print(f"  {label:<34} {elapsed / len(sample) * 1e3:9.3f} ms/lookup ({len(sample)} lookups)")
+
+
+def bench_sign_count(engine, sample):
+    start = time.perf_counter()
+    with Session(engine) as session:
+        for n, credential_id in enumerate(sample, start=1):
+            credential = session.execute(
+                select(WebAuthnCredential).where(WebAuthnCredential.credential_id == credential_id)
+            ).scalar_one()
+            credential.current_sign_count = n
+            session.commit()
+    orm = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with engine.connect() as conn:
+        for n, credential_id in enumerate(sample, start=len(sample) + 1):
+            conn.execute(
+                update(WebAuthnCredential)
+                .where(WebAuthnCredential.credential_id == credential_id,
+                       WebAuthnCredential.current_sign_count < n)
+                .values(current_sign_count=n)
+            )
+            conn.commit()
+    conditional = time.perf_counter() - start
+
+    print("Sign-count update:")
+    print(f"  {'ORM load-modify-commit':<34} {orm / len(sample) * 1e3:9.3f} ms/login")
+    print(f"  {'conditional UPDATE':<34} {conditional / len(sample) * 1e3:9.3f} ms/login")
+
+
+def run(count, url):
+    engine = create_engine(url)
+
+    credential_ids = populate(engine, count)
+    rng = random.Random(7)
+
+    print("Credential lookup by id:")
+    bench_lookup(engine, rng.sample(credential_ids, 10000), "unique index")
+    bench_sign_count(engine, rng.sample(credential_ids, 2000))
+
+    index = next(i for i in WebAuthnCredential.__table__.indexes if "credential_id" in i.columns)
+    index.drop(engine)
+    bench_lookup(engine, rng.sample(credential_ids, 20), "no index (full scan)")
+
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    if len(sys.argv) > 2:
+        run(count, sys.argv[2])
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            run(count, "sqlite:///" + os.path.join(tmp, "bench.db"))
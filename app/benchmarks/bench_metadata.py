@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Authenticator metadata benchmark
+
+Builds a synthetic MDS blob with the given number of authenticators spread
+over a number of vendor roots, then reports how long it takes to load, the
+memory its snapshot holds, the cost of an AAGUID lookup, and the cost of the
+policy check and of a full verification with and without the metadata roots.
+
+Run from the app directory:
+
+    python -m benchmarks.bench_metadata [entries] [vendors]
+"""
+
+import base64
+import datetime
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+import uuid
+
+import webauthn
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509.oid import NameOID
+from webauthn.helpers import parse_registration_credential_json
+
+from auth import metadata
+from benchmarks.soft_authenticator import SoftAuthenticator
+
+RP_ID = "localhost"
+ORIGIN = "http://localhost:5000"
+
+
+def _name(common_name, unit=None):
+    attributes = [
+        x509.NameAttribute(NameOID.COUNTRY_NAME, "US"),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Bench Authenticators"),
+        x509.NameAttribute(NameOID.COMMON_NAME, common_name),
+    ]
+    if unit:
+        attributes.append(x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, unit))
+    return x509.Name(attributes)
+
+
+def _certificate(subject, issuer, public_key, signing_key, ca):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(issuer)
+        .public_key(public_key)
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=365))
+        .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True)
+        .sign(signing_key, hashes.SHA256())
+    )
+
+
+def make_root(name):
+    """A self-signed attestation root; returns (key, certificate)"""
+    key = ec.generate_private_key(ec.SECP256R1())
+    return key, _certificate(_name(name), _name(name), key.public_key(), key, ca=True)
+
+
+def make_attestation(root_key, root_cert):
+    """An attestation key and its DER chain, leaf first, under a root"""
+    key = ec.generate_private_key(ec.SECP256R1())
+    leaf = _certificate(
+        _name("Bench Attestation", "Authenticator Attestation"),
+        root_cert.subject, key.public_key(), root_key, ca=False,
+    )
+    return key, [leaf.public_bytes(Encoding.DER)]
+
+
+def make_blob(entries, roots, revoked_every=50):
+    """A signed-looking MDS JWT with entries spread over roots"""
+    root_b64 = [base64.b64encode(cert.public_bytes(Encoding.DER)).decode() for _key, cert in roots]
+    aaguids = [str(uuid.uuid4()) for _ in range(entries)]
+    payload = {
+        "legalHeader": "Synthetic metadata for benchmarking",
+        "no": 1,
+        "nextUpdate": "2099-01-01",
+        "entries": [
+            {
+                "aaguid": aaguid,
+                "metadataStatement": {
+                    "description": f"Bench authenticator {i}",
+                    "aaguid": aaguid,
+                    "attestationTypes": ["basic_full"],
+                    "attestationRootCertificates": [root_b64[i % len(root_b64)]],
+                },
+                "statusReports": [
+                    {"status": "FIDO_CERTIFIED", "effectiveDate": "2024-01-01"},
+                    {"status": "REVOKED" if i % revoked_every == revoked_every - 1 else "FIDO_CERTIFIED_L1",
+                     "effectiveDate": "2025-01-01"},
+                ],
+                "timeOfLastStatusChange": "2025-01-01",
+            }
+            for i, aaguid in enumerate(aaguids)
+        ],
+    }
+
+    def segment(data):
+        return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+    header = segment(json.dumps({"alg": "ES256", "typ": "JWT"}).encode())
+    body = segment(json.dumps(payload).encode())
+    return b".".join([header, body, segment(b"\0" * 64)]), aaguids
+
+
+def per_op(function, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations
+
+
+def registration(authenticator):
+    """Fresh registration options and the authenticator's parsed response"""
+    options = webauthn.generate_registration_options(rp_id=RP_ID, rp_name="Bench", user_name="bench")
+    response = authenticator.create(json.loads(webauthn.options_to_json(options)), ORIGIN, fmt="packed")
+    return options.challenge, parse_registration_credential_json(response)
+
+
+if __name__ == "__main__":
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    vendors = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    roots = [make_root(f"Bench Root {n}") for n in range(vendors)]
+    blob, aaguids = make_blob(entries, roots)
+    print(f"blob: {entries} authenticators, {vendors} roots, {len(blob) / 1e6:.1f} MB")
+
+    load_times = []
+    for _ in range(5):
+        start = time.perf_counter()
+        metadata.parse_blob(blob)
+        load_times.append(time.perf_counter() - start)
+    print(f"load: median {statistics.median(load_times) * 1000:.1f} ms")
+
+    tracemalloc.start()
+    snapshot = metadata.parse_blob(blob)
+    held, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"memory: {held / 1e6:.1f} MB held by the snapshot")
+
+    store = metadata.MetadataStore(None, reload_interval=3600)
+    store.snapshot = snapshot
+    store._next_check = float("inf")
+    known = uuid.UUID(aaguids[0]).bytes
+    unknown = uuid.uuid4().bytes
+    print(f"lookup: {per_op(lambda: store.get(known), 200000) * 1e9:.0f} ns hit, "
+          f"{per_op(lambda: store.get(unknown), 200000) * 1e9:.0f} ns miss")
+
+    # A full packed attestation from an authenticator in the blob
+    root_key, root_cert = roots[0]
+    attestation_key, chain = make_attestation(root_key, root_cert)
+    authenticator = SoftAuthenticator(aaguid=known, attestation_key=attestation_key, attestation_certs=chain)
+    challenge, credential = registration(authenticator)
+
+    metadata.STORE = store
+    metadata.AUTHENTICATOR_POLICY = "known"
+    print(f"policy check: {per_op(lambda: metadata.trust_anchors_for(credential), 20000) * 1e6:.1f} us")
+
+    def verify(roots_by_fmt):
+        return webauthn.verify_registration_response(
+            credential=credential,
+            expected_challenge=challenge,
+            expected_origin=ORIGIN,
+            expected_rp_id=RP_ID,
+            pem_root_certs_bytes_by_fmt=roots_by_fmt,
+        )
+
+    roots_by_fmt = metadata.trust_anchors_for(credential)
+    print(f"verify: {per_op(lambda: verify(None), 500) * 1e3:.2f} ms without roots, "
+          f"{per_op(lambda: verify(roots_by_fmt), 500) * 1e3:.2f} ms with the chain validated")
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Credential payload decoding benchmark
+
+Compares the schema-driven decoder in auth/payloads.py with the parsers it
+replaced: the hand-rolled registration parser formerly in auth/views.py,
+kept below as it was, and the webauthn library's JSON parser for logins.
+Each is timed on a valid registration and assertion from the software
+authenticator and on hostile payloads: oversized binary fields, a huge
+credential ID, invalid base64url, padding with unknown fields and a wrong
+type. Hostile payloads the old parsers accept are reported as such.
+
+Run from the app directory:
+
+    python -m benchmarks.bench_payload [iterations]
+"""
+
+import logging
+import sys
+import time
+
+import logs
+from webauthn.helpers import parse_authentication_credential_json
+from webauthn.helpers.structs import RegistrationCredential
+
+from auth import payloads
+from benchmarks.soft_authenticator import SoftAuthenticator, b64url_encode
+
+RP_ID = "localhost"
+ORIGIN = "http://localhost:5000"
+
+logger = logging.getLogger(__name__)
+
+
+def legacy_parse_registration(credential_data):
+    """Parse WebAuthn registration credential, handling browser compatibility issues"""
+    try:
+        logs.log_payload(logger, "Raw credential data received", credential_data)
+
+        # Handle different WebAuthn response formats
+        if not isinstance(credential_data, dict):
+            raise ValueError("Credential data must be a dictionary")
+
+        # The browser sends 'rawId' but Python webauthn library expects 'raw_id'
+        # Map rawId to both id and raw_id
+        if 'rawId' in credential_data:
+            if 'id' not in credential_data:
+                credential_data['id'] = credential_data['rawId']
+            # Map rawId to raw_id for the webauthn library - convert base64url to bytes
+            import base64
+            # Add padding if needed for base64url decoding
+            raw_id_str = credential_data['rawId']
+            # Add padding to make length multiple of 4
+            raw_id_str += '=' * (4 - len(raw_id_str) % 4) if len(raw_id_str) % 4 else ''
+            credential_data['raw_id'] = base64.urlsafe_b64decode(raw_id_str)
+            # Remove rawId to avoid conflicts
+            del credential_data['rawId']
+
+        # Ensure required fields are present
+        required_fields = ['id', 'response', 'type']
+        missing_fields = [field for field in required_fields if field not in credential_data]
+        if missing_fields:
+            raise ValueError(f"Missing required fields: {missing_fields}")
+
+        # Ensure raw_id is present
+        if 'raw_id' not in credential_data:
+            raise ValueError("Missing raw_id field after mapping from rawId")
+
+        # Clean up the data - only keep fields the library expects
+        # Based on webauthn library version 2.7.0, RegistrationCredential expects:
+        expected_fields = {
+            'id', 'raw_id', 'response', 'type'
+        }
+
+        cleaned_data = {k: v for k, v in credential_data.items() if k in expected_fields}
+
+        logs.log_payload(logger, "Cleaned credential data", cleaned_data)
+
+        # Create the RegistrationCredential object
+        # The webauthn library expects specific field names and structure
+        if 'response' in cleaned_data and isinstance(cleaned_data['response'], dict):
+            response_dict = cleaned_data['response'].copy()
+
+            # Create a proper response object structure
+            from webauthn.helpers.structs import AuthenticatorAttestationResponse
+            import base64
+
+            # Map the browser field names to what the library expects and decode base64 data
+            response_data = {}
+            if 'clientDataJSON' in response_dict:
+                # Decode base64 clientDataJSON to bytes
+                client_data_b64 = response_dict['clientDataJSON']
+                # Add padding if needed
+                client_data_b64 += '=' * (4 - len(client_data_b64) % 4) if len(client_data_b64) % 4 else ''
+                response_data['client_data_json'] = base64.urlsafe_b64decode(client_data_b64)
+            if 'attestationObject' in response_dict:
+                # Decode base64 attestationObject to bytes
+                attestation_b64 = response_dict['attestationObject']
+                # Add padding if needed
+                attestation_b64 += '=' * (4 - len(attestation_b64) % 4) if len(attestation_b64) % 4 else ''
+                response_data['attestation_object'] = base64.urlsafe_b64decode(attestation_b64)
+
+            # Create the AuthenticatorAttestationResponse object
+            cleaned_data['response'] = AuthenticatorAttestationResponse(**response_data)
+
+        logger.debug("Final credential data structure: %s", type(cleaned_data['response']))
+        registration_credential = RegistrationCredential(**cleaned_data)
+
+        return registration_credential
+
+    except Exception as e:
+        logger.warning("Error parsing registration credential: %s", e)
+        raise
+
+
+def valid_payloads():
+    authenticator = SoftAuthenticator()
+    registration = authenticator.create({
+        "rp": {"id": RP_ID, "name": "Bench"},
+        "user": {"id": b64url_encode(b"\x01" * 16), "name": "bench", "displayName": "bench"},
+        "challenge": b64url_encode(b"\x02" * 32),
+    }, ORIGIN)
+    assertion = authenticator.get({"rpId": RP_ID, "challenge": b64url_encode(b"\x03" * 32)}, ORIGIN)
+    return registration, assertion
+
+
+def hostile_payloads(registration, assertion):
+    """(name, registration payload, assertion payload)"""
+    huge = b64url_encode(b"\x00" * 1024 * 1024)
+
+    def with_response(payload, **fields):
+        return dict(payload, response=dict(payload["response"], **fields))
+
+    return [
+        ("1 MiB binary field",
+         with_response(registration, attestationObject=huge), with_response(assertion, signature=huge)),
+        ("64 KiB credential ID",
+         dict(registration, id=huge[:65536], rawId=huge[:65536]), dict(assertion, id=huge[:65536], rawId=huge[:65536])),
+        ("invalid base64url",
+         with_response(registration, clientDataJSON="!*" * 1000), with_response(assertion, clientDataJSON="!*" * 1000)),
+        ("1000 unknown fields",
+         dict(registration, **{f"x{i}": "y" * 32 for i in range(1000)}),
+         dict(assertion, **{f"x{i}": "y" * 32 for i in range(1000)})),
+        ("wrong type", dict(registration, type="password"), dict(assertion, type="password")),
+        ("list attachment",
+         dict(registration, authenticatorAttachment=["platform"]), dict(assertion, authenticatorAttachment=["platform"])),
+    ]
+
+
+def _time(parse, payload, iterations):
+    """us per call and whether the payload was accepted"""
+    accepted = True
+    start = time.perf_counter()
+    for _ in range(iterations):
+        # The legacy parser rewrites the top level of its argument
+        try:
+            parse(dict(payload))
+        except Exception:
+            accepted = False
+    return (time.perf_counter() - start) / iterations * 1e6, accepted
+
+
+def _report(label, legacy, decoder):
+    (legacy_us, legacy_ok), (decoder_us, decoder_ok) = legacy, decoder
+    print(f"  {label:<24} legacy {legacy_us:9.2f} us ({'accepted' if legacy_ok else 'rejected'})"
+          f"   decoder {decoder_us:9.2f} us ({'accepted' if decoder_ok else 'rejected'})"
+          f"   {legacy_us / decoder_us:6.1f}x")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    registration, assertion = valid_payloads()
+    print("Registration (legacy: parse_registration_credential):")
+    _report("valid", _time(legacy_parse_registration, registration, count),
+            _time(payloads.decode_registration, registration, count))
+    for name, hostile, _ in hostile_payloads(registration, assertion):
+        iterations = max(1, count // 100) if "MiB" in name or "KiB" in name else count
+        _report(name, _time(legacy_parse_registration, hostile, iterations),
+                _time(payloads.decode_registration, hostile, iterations))
+
+    print("Authentication (legacy: parse_authentication_credential_json):")
+    _report("valid", _time(parse_authentication_credential_json, assertion, count),
+            _time(payloads.decode_authentication, assertion, count))
+    for name, _, hostile in hostile_payloads(registration, assertion):
+        iterations = max(1, count // 100) if "MiB" in name or "KiB" in name else count
+        _report(name, _time(parse_authentication_credential_json, hostile, iterations),
+                _time(payloads.decode_authentication, hostile, iterations))
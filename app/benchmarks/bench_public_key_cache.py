@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Decoded public key cache benchmark
+
+Signs a stream of logins from a population of credentials, where a few
+returning users log in far more often than the rest, then verifies every
+assertion with ``webauthn.verify_authentication_response`` and with the
+cached verification in auth.credential_keys, and reports the time per
+verification, the speedup and the cache's hit rate.
+
+Run from the app directory:
+
+    python -m benchmarks.bench_public_key_cache [credentials] [logins] [cache_size]
+"""
+
+import json
+import random
+import sys
+import time
+
+import webauthn
+from webauthn.helpers import bytes_to_base64url, parse_authentication_credential_json
+
+from auth import credential_keys
+from benchmarks.soft_authenticator import SoftAuthenticator
+
+RP_ID = "localhost"
+ORIGIN = "http://localhost:5000"
+
+
+def make_logins(credentials, logins):
+    """(credential, challenge, COSE key, previous count) for each login"""
+    rng = random.Random(42)
+    authenticators = []
+    for n in range(credentials):
+        authenticator = SoftAuthenticator()
+        options = webauthn.generate_registration_options(rp_id=RP_ID, rp_name="Bench", user_name=f"user{n}")
+        authenticator.create(json.loads(webauthn.options_to_json(options)), ORIGIN)
+        authenticators.append(authenticator)
+
+    # Zipf-like popularity: the user at rank r logs in about 1/r as often
+    weights = [1 / rank for rank in range(1, credentials + 1)]
+    stream = []
+    for authenticator in rng.choices(authenticators, weights, k=logins):
+        soft_credential = next(iter(authenticator.credentials.values()))
+        challenge = rng.randbytes(32)
+        response = authenticator.get(
+            {"rpId": RP_ID, "challenge": bytes_to_base64url(challenge), "allowCredentials": []}, ORIGIN
+        )
+        stream.append((
+            parse_authentication_credential_json(response),
+            challenge,
+            soft_credential.cose_public_key(),
+            soft_credential.sign_count - 1,
+        ))
+    return stream
+
+
+def run(verify, stream):
+    start = time.perf_counter()
+    for credential, challenge, public_key, sign_count in stream:
+        verify(
+            credential=credential,
+            expected_challenge=challenge,
+            expected_rp_id=RP_ID,
+            expected_origin=ORIGIN,
+            credential_public_key=public_key,
+            credential_current_sign_count=sign_count,
+        )
+    return (time.perf_counter() - start) / len(stream)
+
+
+if __name__ == "__main__":
+    credentials = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    logins = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    cache_size = int(sys.argv[3]) if len(sys.argv) > 3 else credential_keys.PUBLIC_KEY_CACHE_SIZE
+
+    print(f"signing {logins} logins from {credentials} credentials...")
+    stream = make_logins(credentials, logins)
+
+    library = run(webauthn.verify_authentication_response, stream)
+    credential_keys.CACHE = credential_keys.PublicKeyCache(cache_size)
+    cached = run(credential_keys.verify_authentication_response, stream)
+    warm = run(credential_keys.verify_authentication_response, stream)
+
+    stats = credential_keys.CACHE.stats()
+    print(f"library:      {library * 1e6:7.1f} us/verification")
+    print(f"cached, cold: {cached * 1e6:7.1f} us/verification ({library / cached:.2f}x)")
+    print(f"cached, warm: {warm * 1e6:7.1f} us/verification ({library / warm:.2f}x)")
+    print(f"cache of {cache_size}: {stats['hits'] / (stats['hits'] + stats['misses']):.1%} hits, "
+          f"{stats['evictions']} evictions, {stats['size']} keys held")
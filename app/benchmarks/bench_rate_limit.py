@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Admission control benchmark
+
+Measures what auth.limits adds to each request to a limited endpoint: the
+concurrency cap and the token buckets for the client IP and a username and
+email, admitted and refused, with the in-process buckets single threaded and
+under contention from several threads, and with the Redis script when a
+server is reachable through REDIS_HOST/REDIS_PORT/REDIS_PASSWORD.
+
+Run from the app directory:
+
+    python -m benchmarks.bench_rate_limit [iterations] [threads]
+"""
+
+import os
+import sys
+import threading
+import time
+
+from redis import Redis
+
+from auth import limits
+
+ENDPOINT = "auth.create_user"
+
+
+def _admit_all(limiter, iterations, offset=0):
+    """Admit iterations requests from distinct clients; returns the seconds taken"""
+    start = time.perf_counter()
+    for i in range(iterations):
+        n = offset + i
+        buckets = limits.buckets_for(ENDPOINT, f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}",
+                                     (f"user{n}", f"user{n}@example.com"))
+        if not limits.CONCURRENCY.acquire():
+            raise RuntimeError("concurrency cap reached")
+        try:
+            if limiter.take(buckets):
+                raise RuntimeError("request refused")
+        finally:
+            limits.CONCURRENCY.release()
+    return time.perf_counter() - start
+
+
+def _refuse_all(limiter, iterations):
+    """Requests from one client whose bucket is empty"""
+    buckets = [(f"{ENDPOINT}:ip:bench-refused", 1e-9, 1)]
+    limiter.take(buckets)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        if not limiter.take(buckets):
+            raise RuntimeError("request admitted")
+    return time.perf_counter() - start
+
+
+def _report(label, elapsed, iterations):
+    print(f"  {label:<40} {elapsed / iterations * 1e6:8.2f} us/request")
+
+
+def _buckets_only(iterations):
+    start = time.perf_counter()
+    for n in range(iterations):
+        limits.buckets_for(ENDPOINT, f"10.0.{n >> 8 & 255}.{n & 255}", (f"user{n}", f"user{n}@example.com"))
+    return time.perf_counter() - start
+
+
+def bench_memory(iterations, threads):
+    limiter = limits.RateLimiter(None, limits.MemoryTokenBuckets())
+    print(f"In-process buckets ({limits.RATE_LIMIT_MAX_KEYS} max keys):")
+    _report("buckets_for only", _buckets_only(iterations), iterations)
+    _report("admitted (ip, username, email)", _admit_all(limiter, iterations), iterations)
+    _report("refused", _refuse_all(limiter, iterations), iterations)
+
+    per_thread = iterations // threads
+    workers = [
+        threading.Thread(target=_admit_all, args=(limiter, per_thread, (n + 1) * per_thread))
+        for n in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    _report(f"admitted, {threads} threads (wall / requests)", time.perf_counter() - start, per_thread * threads)
+
+
+def bench_redis(iterations):
+    client = Redis(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", "6379")),
+        password=os.getenv("REDIS_PASSWORD", None),
+        socket_connect_timeout=1,
+    )
+    try:
+        client.ping()
+    except Exception as e:
+        print(f"Redis not reachable ({e}), skipping the Redis benchmark")
+        return
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        client.ping()
+    ping = time.perf_counter() - start
+
+    limiter = limits.RateLimiter(limits.RedisTokenBuckets(client, prefix="bench_rate:"), limits.MemoryTokenBuckets())
+    print("Redis buckets (one EVALSHA per request):")
+    _report("PING, for the round trip", ping, iterations)
+    _report("admitted (ip, username, email)", _admit_all(limiter, iterations), iterations)
+    _report("refused", _refuse_all(limiter, iterations), iterations)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    # Generous limits, so the admitted runs measure admission rather than refusals
+    limits.RATE_LIMIT_IP_BURST = limits.RATE_LIMIT_IDENTITY_BURST = 10
+    limits.CONCURRENCY = limits.ConcurrencyLimit(threads * 2)
+
+    bench_memory(count, threads)
+    bench_redis(min(count, 10000))
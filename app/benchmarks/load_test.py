@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Registration and login load test
+
+Drives complete WebAuthn ceremonies (/create-user -> /add-credential, then
+optionally /start-login -> /verify-login) from concurrent virtual users, each
+with its own cookie jar and software authenticator, and reports latency
+percentiles and throughput per endpoint.
+
+By default the app is started in-process under waitress on a free port, with
+a temporary SQLite database (or DATABASE_URL) and the in-process challenge
+store standing in for Redis. Pass --asgi to serve it with uvicorn and the
+async ceremony endpoints instead, or --url to load an already running
+instance.
+
+Run from the app directory:
+
+    python -m benchmarks.load_test --users 16 --ceremonies 2000 --login
+"""
+
+import argparse
+import http.cookiejar
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.soft_authenticator import SoftAuthenticator
+
+_OPTIONS_RE = re.compile(r"const options = (\{.*?\});\n", re.S)
+
+
+class Stats:
+    """Thread-safe latency samples per endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint, elapsed, ok):
+        with self._lock:
+            self.latencies[endpoint].append(elapsed)
+            if not ok:
+                self.errors[endpoint] += 1
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+class VirtualUser:
+    """One browser: a cookie jar, an authenticator and its registered account"""
+
+    def __init__(self, base_url, stats, fmt):
+        self.base_url = base_url.rstrip("/")
+        self.origin = self.base_url
+        self.stats = stats
+        self.fmt = fmt
+        self.authenticator = SoftAuthenticator()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def _request(self, endpoint, data=None, json_body=None):
+        headers = {}
+        if json_body is not None:
+            data = json.dumps(json_body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        elif data is not None:
+            data = urllib.parse.urlencode(data).encode("utf-8")
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        request = urllib.request.Request(self.base_url + endpoint, data=data, headers=headers)
+
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                body = response.read().decode("utf-8")
+                status = response.status
+        except urllib.error.HTTPError as e:
+            body = e.read().decode("utf-8")
+            status = e.code
+        except OSError:
+            body, status = "", 0
+        self.stats.record(endpoint, time.perf_counter() - start, 200 <= status < 300)
+        return status, body
+
+    def _options(self, body):
+        match = _OPTIONS_RE.search(body)
+        if match is None:
+            raise RuntimeError("No WebAuthn options in response")
+        return match.group(1)
+
+    def register(self):
+        self.username = f"load-{uuid.uuid4().hex[:16]}"
+        _, body = self._request("/create-user", data={
+            "name": self.username, "username": self.username,
+            "email": f"{self.username}@example.com",
+        })
+        credential = self.authenticator.create(self._options(body), self.origin, fmt=self.fmt)
+        status, body = self._request("/add-credential", json_body=credential)
+        if status != 201:
+            raise RuntimeError(f"Registration failed: {body}")
+
+    def login(self):
+        _, body = self._request("/start-login", data={"username": self.username})
+        assertion = self.authenticator.get(self._options(body), self.origin)
+        status, body = self._request("/verify-login", json_body=assertion)
+        if status != 200:
+            raise RuntimeError(f"Login failed: {body}")
+
+
+def start_local_server(threads, asgi=False):
+    """
+    Serve the app in-process with waitress, or with uvicorn and the ASGI
+    entry point; returns the base URL
+    """
+    if "DATABASE_URL" not in os.environ:
+        tmp = tempfile.mkdtemp()
+        os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tmp, "load.db")
+    # In-process stand-in for Redis
+    os.environ["CHALLENGE_BACKEND"] = "memory"
+    # Every virtual user comes from one address
+    os.environ.setdefault("RATE_LIMIT_IP_BURST", "0")
+
+    from waitress.server import create_server
+
+    from app import create_tables_if_needed, serve
+
+    create_tables_if_needed()
+
+    if asgi:
+        return _start_uvicorn()
+
+    server = create_server(serve(), host="127.0.0.1", port=0, threads=threads)
+    threading.Thread(target=server.run, daemon=True).start()
+    return f"http://localhost:{server.effective_port}"
+
+
+def _start_uvicorn():
+    import socket
+
+    import uvicorn
+
+    import asgi
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(
+        asgi.application, host="127.0.0.1", port=port, log_level="warning", backlog=4096
+    ))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://localhost:{port}"
+
+
+def run(base_url, users, ceremonies, logins, fmt):
+    stats = Stats()
+    failures = []
+    counter = iter(range(ceremonies))
+    counter_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with counter_lock:
+                if next(counter, None) is None:
+                    return
+            user = VirtualUser(base_url, stats, fmt)
+            try:
+                user.register()
+                for _ in range(logins):
+                    user.login()
+            except Exception as e:
+                failures.append(str(e))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        for _ in range(users):
+            pool.submit(worker)
+    return stats, failures, time.perf_counter() - start
+
+
+def report(stats, failures, wall):
+    print(f"{'endpoint':<28}{'count':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    summary = {}
+    for endpoint, samples in stats.latencies.items():
+        samples = sorted(samples)
+        row = {
+            "count": len(samples),
+            "errors": stats.errors[endpoint],
+            "rps": len(samples) / wall,
+            "p50": percentile(samples, 50) * 1e3,
+            "p95": percentile(samples, 95) * 1e3,
+            "p99": percentile(samples, 99) * 1e3,
+        }
+        summary[endpoint] = row
+        print(f"{endpoint:<28}{row['count']:>8}{row['errors']:>8}{row['rps']:>10.1f}"
+              f"{row['p50']:>10.1f}{row['p95']:>10.1f}{row['p99']:>10.1f}")
+    print(f"wall time {wall:.1f}s, {len(failures)} failed ceremonies")
+    if failures:
+        print(f"first failure: {failures[0]}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", help="base URL of a running instance (default: start one in-process)")
+    parser.add_argument("--users", type=int, default=8, help="concurrent virtual users")
+    parser.add_argument("--ceremonies", type=int, default=500, help="registrations to perform")
+    parser.add_argument("--login", type=int, default=0, nargs="?", const=1,
+                        help="logins per registered user")
+    parser.add_argument("--fmt", choices=["none", "packed"], default="none", help="attestation format")
+    parser.add_argument("--server-threads", type=int, default=8, help="waitress threads for the local server")
+    parser.add_argument("--asgi", action="store_true",
+                        help="serve the local server with uvicorn and the ASGI entry point")
+    parser.add_argument("--max-p99", type=float, help="fail if any endpoint's p99 exceeds this many ms")
+    parser.add_argument("--json", help="also write the summary to this file")
+    args = parser.parse_args()
+
+    base_url = args.url or start_local_server(args.server_threads, args.asgi)
+    stats, failures, wall = run(base_url, args.users, args.ceremonies, args.login, args.fmt)
+    summary = report(stats, failures, wall)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"wall": wall, "failures": len(failures), "endpoints": summary}, f, indent=2)
+
+    if failures:
+        sys.exit(1)
+    if args.max_p99 is not None and any(row["p99"] > args.max_p99 for row in summary.values()):
+        print(f"p99 above {args.max_p99} ms")
+        sys.exit(1)
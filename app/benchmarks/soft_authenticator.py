@@ -0,0 +1,170 @@
+"""
+Software WebAuthn authenticator
+
+Answers registration and authentication options with the same JSON a browser
+produces through SimpleWebAuthn, backed by P-256 keys held in memory. It
+supports ``none`` attestation and ``packed`` attestation, either
+self-attestation or, given an attestation key and certificate chain, full
+attestation, so the app's real verification code runs unchanged against it.
+"""
+
+import hashlib
+import json
+import os
+import struct
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+import cbor2
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+
+# Authenticator data flags
+FLAG_UP = 0x01
+FLAG_UV = 0x04
+FLAG_AT = 0x40
+
+COSE_ALG_ES256 = -7
+
+
+def b64url_encode(data):
+    return urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def b64url_decode(data):
+    return urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class SoftCredential:
+    """A credential created by the software authenticator"""
+
+    def __init__(self, rp_id, user_handle):
+        self.rp_id = rp_id
+        self.user_handle = user_handle
+        self.credential_id = os.urandom(32)
+        self.private_key = ec.generate_private_key(ec.SECP256R1())
+        self.sign_count = 0
+
+    def cose_public_key(self):
+        numbers = self.private_key.public_key().public_numbers()
+        return cbor2.dumps({
+            1: 2,  # kty: EC2
+            3: COSE_ALG_ES256,
+            -1: 1,  # crv: P-256
+            -2: numbers.x.to_bytes(32, "big"),
+            -3: numbers.y.to_bytes(32, "big"),
+        })
+
+    def sign(self, data):
+        return self.private_key.sign(data, ec.ECDSA(hashes.SHA256()))
+
+
+class SoftAuthenticator:
+    """In-memory authenticator producing registration and assertion responses"""
+
+    def __init__(self, aaguid=b"\x00" * 16, counter=True, attestation_key=None, attestation_certs=None):
+        self.aaguid = aaguid
+        self.counter = counter
+        # Private key and DER certificate chain, leaf first, for full
+        # packed attestation
+        self.attestation_key = attestation_key
+        self.attestation_certs = attestation_certs
+        self.credentials = {}
+
+    def _client_data(self, ceremony, challenge, origin):
+        return json.dumps({
+            "type": ceremony,
+            "challenge": challenge,
+            "origin": origin,
+            "crossOrigin": False,
+        }, separators=(",", ":")).encode("utf-8")
+
+    def create(self, options, origin, fmt="none"):
+        """Answer PublicKeyCredentialCreationOptions (as a dict or JSON string)"""
+        if isinstance(options, str):
+            options = json.loads(options)
+
+        rp_id = options["rp"]["id"]
+        credential = SoftCredential(rp_id, b64url_decode(options["user"]["id"]))
+        self.credentials[credential.credential_id] = credential
+
+        client_data = self._client_data("webauthn.create", options["challenge"], origin)
+        attested_data = (
+            self.aaguid
+            + struct.pack(">H", len(credential.credential_id))
+            + credential.credential_id
+            + credential.cose_public_key()
+        )
+        auth_data = (
+            hashlib.sha256(rp_id.encode("utf-8")).digest()
+            + bytes([FLAG_UP | FLAG_UV | FLAG_AT])
+            + struct.pack(">I", credential.sign_count)
+            + attested_data
+        )
+
+        if fmt == "none":
+            att_stmt = {}
+        elif fmt == "packed" and self.attestation_key is not None:
+            signature = self.attestation_key.sign(
+                auth_data + hashlib.sha256(client_data).digest(), ec.ECDSA(hashes.SHA256())
+            )
+            att_stmt = {"alg": COSE_ALG_ES256, "sig": signature, "x5c": list(self.attestation_certs)}
+        elif fmt == "packed":
+            signature = credential.sign(auth_data + hashlib.sha256(client_data).digest())
+            att_stmt = {"alg": COSE_ALG_ES256, "sig": signature}
+        else:
+            raise ValueError(f"Unsupported attestation format: {fmt}")
+
+        attestation_object = cbor2.dumps({"fmt": fmt, "attStmt": att_stmt, "authData": auth_data})
+
+        return {
+            "id": b64url_encode(credential.credential_id),
+            "rawId": b64url_encode(credential.credential_id),
+            "response": {
+                "clientDataJSON": b64url_encode(client_data),
+                "attestationObject": b64url_encode(attestation_object),
+                "transports": ["internal"],
+            },
+            "type": "public-key",
+            "clientExtensionResults": {},
+            "authenticatorAttachment": "platform",
+        }
+
+    def get(self, options, origin):
+        """Answer PublicKeyCredentialRequestOptions (as a dict or JSON string)"""
+        if isinstance(options, str):
+            options = json.loads(options)
+
+        allowed = [b64url_decode(c["id"]) for c in options.get("allowCredentials") or []]
+        rp_id = options["rpId"]
+        candidates = [
+            c for c in self.credentials.values()
+            if c.rp_id == rp_id and (not allowed or c.credential_id in allowed)
+        ]
+        if not candidates:
+            raise LookupError("No matching credential")
+        credential = candidates[0]
+
+        if self.counter:
+            credential.sign_count += 1
+
+        client_data = self._client_data("webauthn.get", options["challenge"], origin)
+        auth_data = (
+            hashlib.sha256(rp_id.encode("utf-8")).digest()
+            + bytes([FLAG_UP | FLAG_UV])
+            + struct.pack(">I", credential.sign_count)
+        )
+        signature = credential.sign(auth_data + hashlib.sha256(client_data).digest())
+
+        return {
+            "id": b64url_encode(credential.credential_id),
+            "rawId": b64url_encode(credential.credential_id),
+            "response": {
+                "clientDataJSON": b64url_encode(client_data),
+                "authenticatorData": b64url_encode(auth_data),
+                "signature": b64url_encode(signature),
+                "userHandle": b64url_encode(credential.user_handle),
+            },
+            "type": "public-key",
+            "clientExtensionResults": {},
+            "authenticatorAttachment": "platform",
+        }
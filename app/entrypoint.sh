@@ -37,7 +37,13 @@ echo "Starting application server..."
 if [ "$FLASK_ENV" = "development" ]; then
     echo "Running in development mode..."
     python app.py
-else
+elif [ "$SERVER" = "asgi" ]; then
+    echo "Running in production mode with Uvicorn (async ceremony endpoints)..."
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+elif [ "$SERVER" = "waitress" ]; then
     echo "Running in production mode with Waitress..."
-    waitress-serve --host 0.0.0.0 --port 5000 app:app
+    waitress-serve --host 0.0.0.0 --port 5000 --call app:serve
+else
+    echo "Running in production mode with Gunicorn..."
+    exec gunicorn -c gunicorn.conf.py app:app
 fi
\ No newline at end of file
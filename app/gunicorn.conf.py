@@ -0,0 +1,59 @@
+"""
+Gunicorn settings for production
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The app is imported once in the master and its workers are forked from it,
+so startup work such as loading the authenticator metadata is done once and
+its memory shared copy-on-write. Each worker then drops the connections it
+inherited and starts its own background threads (``app.after_fork``).
+
+Verifying a login is CPU bound and holds the GIL, so there is one worker
+process per available CPU, with a few threads each to cover waits on the
+database and Redis. GUNICORN_WORKERS and GUNICORN_THREADS override the sizing.
+Without Redis, challenges only live in the process that issued them, so a
+single worker is started.
+"""
+
+import math
+import multiprocessing
+import os
+
+
+def available_cpus():
+    """CPUs this process may run on, within any cgroup CPU quota"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = multiprocessing.cpu_count()
+    try:
+        # cgroup v2, e.g. docker run --cpus
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(1, cpus)
+
+
+_shared_store = os.getenv("CHALLENGE_BACKEND", "redis" if os.getenv("REDIS_HOST") else "memory") == "redis"
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("GUNICORN_WORKERS", str(available_cpus() if _shared_store else 1)))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+preload_app = True
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+
+# Worker heartbeats on disk can stall under container overlay filesystems
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
+
+
+def post_fork(server, worker):
+    from app import after_fork
+    after_fork()
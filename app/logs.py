@@ -0,0 +1,141 @@
+"""
+Structured, non-blocking logging
+
+Log records are put on a bounded in-memory queue by the request threads and
+written to stdout by a single background listener, so request threads never
+wait on stdout. Records are rendered as JSON lines (or plain text with
+LOG_FORMAT=text); keyword fields passed through ``extra`` become JSON keys.
+
+Use %-style arguments (``logger.debug("saved %s", uid)``) so disabled levels
+cost no formatting on the request thread.
+"""
+
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+import metrics
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Per-logger overrides, e.g. "auth.security=DEBUG,sqlalchemy.engine=INFO"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Fraction of verbose credential payload dumps that are actually logged
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+
+DROPPED_RECORDS = metrics.Counter(
+    "webauthn_log_records_dropped_total", "Log records dropped because the log queue was full"
+)
+
+# Attributes every LogRecord has; anything else came in through ``extra``
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+
+
+class JSONFormatter(logging.Formatter):
+    """Render records as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that never blocks the caller: records are dropped and
+    counted when the queue is full, and formatting is left to the listener
+    thread.
+    """
+
+    def prepare(self, record):
+        # The stdlib handler formats the message here, on the calling
+        # thread; hand over a shallow copy instead and format it later
+        return copy.copy(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED_RECORDS.inc()
+
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """Route the root logger through the background queue listener"""
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if fmt == "text":
+        stream_handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)-7s [%(name)s] %(message)s")
+        )
+    else:
+        stream_handler.setFormatter(JSONFormatter())
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    root.handlers[:] = [_NonBlockingQueueHandler(log_queue)]
+    root.setLevel(level)
+    for override in filter(None, LOG_LEVELS.split(",")):
+        name, _, logger_level = override.partition("=")
+        logging.getLogger(name.strip()).setLevel(logger_level.strip().upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def after_fork():
+    """
+    Give a forked child its own queue and listener; the parent's listener
+    thread doesn't run there, so records queued by the child would pile up
+    """
+    global _listener
+    if _listener is None:
+        return
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, _NonBlockingQueueHandler):
+            handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging():
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log_payload(logger, message, payload):
+    """
+    Log a verbose payload at DEBUG level, for a sample of calls only. Costs a
+    level check when DEBUG is disabled.
+    """
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        # Snapshot it: the listener renders the record after the caller may
+        # have mutated the payload
+        logger.debug(message, extra={"payload": copy.deepcopy(payload)})
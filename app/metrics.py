@@ -0,0 +1,269 @@
+"""
+In-process metrics
+
+Counters, gauges and histograms with a small subset of the prometheus_client
+API, rendered in the Prometheus text exposition format by the /dbm/metrics
+endpoint. Values are per process.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from sub-millisecond cache hits to slow crypto
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+class Registry:
+    """Collection of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Render every metric in the Prometheus text format"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{v}"' for n, v in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._new_child()
+            self._children[()] = self._default
+        registry.register(self)
+
+    def labels(self, *values):
+        """Child metric for one combination of label values"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _items(self):
+        with self._lock:
+            return list(self._children.items())
+
+
+class _Value:
+    __slots__ = ("value", "function", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from function at render time"""
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def samples(self):
+        for values, child in self._items():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {child.get()}"
+
+
+class Gauge(Counter):
+    """Value that can go up and down, or be read from a callback"""
+
+    kind = "gauge"
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+    def samples(self):
+        for values, child in self._items():
+            try:
+                value = child.get()
+            except Exception:
+                continue
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {value}"
+
+
+class _HistogramValue:
+    __slots__ = ("upper_bounds", "counts", "sum", "lock")
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.upper_bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """Observe the duration of the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.upper_bounds)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def samples(self):
+        for values, child in self._items():
+            with child.lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(self.upper_bounds + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labelnames, values, (("le", le),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, values)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+# Metrics shared across the app
+
+REQUEST_SECONDS = Histogram(
+    "webauthn_http_request_seconds", "Request latency by endpoint and status",
+    ("endpoint", "method", "status"),
+)
+PHASE_SECONDS = Histogram(
+    "webauthn_phase_seconds", "Time spent in each phase of the WebAuthn ceremonies", ("phase",)
+)
+DB_POOL_EVENTS = Counter(
+    "webauthn_db_pool_events_total", "Database connection pool events", ("event",)
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "webauthn_db_pool_checked_out", "Database connections currently checked out of the pool"
+)
+REDIS_COMMANDS = Counter(
+    "webauthn_redis_commands_total", "Redis commands by command and outcome", ("command", "outcome")
+)
+REDIS_SECONDS = Histogram(
+    "webauthn_redis_command_seconds", "Redis command latency", ("command",)
+)
+
+
+def timed(phase):
+    """Context manager recording the duration of a ceremony phase"""
+    return PHASE_SECONDS.labels(phase).time()
+
+
+@contextmanager
+def redis_command(command):
+    """Count and time one Redis command"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        REDIS_COMMANDS.labels(command, "error").inc()
+        raise
+    else:
+        REDIS_COMMANDS.labels(command, "ok").inc()
+    finally:
+        REDIS_SECONDS.labels(command).observe(time.perf_counter() - start)
+
+
+def instrument_pool_events():
+    """Count connection pool activity for every SQLAlchemy engine"""
+    from sqlalchemy import event
+    from sqlalchemy.pool import Pool
+
+    for name in ("connect", "checkout", "checkin", "invalidate"):
+        event.listen(Pool, name, _pool_listener(name))
+
+
+def _pool_listener(name):
+    counter = DB_POOL_EVENTS.labels(name)
+
+    def listener(*args):
+        counter.inc()
+        if name == "checkout":
+            DB_POOL_CHECKED_OUT.inc()
+        elif name == "checkin":
+            DB_POOL_CHECKED_OUT.dec()
+
+    return listener
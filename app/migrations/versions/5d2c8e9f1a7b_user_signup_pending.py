@@ -0,0 +1,28 @@
+"""User signup_pending
+
+Revision ID: 5d2c8e9f1a7b
+Revises: 8a337a475f49
+Create Date: 2026-10-18 09:14:52.301846
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2c8e9f1a7b'
+down_revision = '8a337a475f49'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing users can't be told apart from provisioned ones, so none of
+    # them is left for the reaper
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('signup_pending', sa.Boolean(), nullable=False, server_default=sa.false()))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('signup_pending')
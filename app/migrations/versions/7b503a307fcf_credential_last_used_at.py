@@ -0,0 +1,26 @@
+"""Credential last_used_at
+
+Revision ID: 7b503a307fcf
+Revises: c342070dd0a2
+Create Date: 2026-10-17 16:02:44.180356
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b503a307fcf'
+down_revision = 'c342070dd0a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('web_authn_credential', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('last_used_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('web_authn_credential', schema=None) as batch_op:
+        batch_op.drop_column('last_used_at')
@@ -0,0 +1,78 @@
+"""Audit events
+
+Revision ID: 8a337a475f49
+Revises: bf3aeb564246
+Create Date: 2026-10-17 21:12:37.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a337a475f49'
+down_revision = 'bf3aeb564246'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        # Partitioned by month; the writer adds the monthly partitions as it
+        # goes and the default one catches anything outside them. The
+        # partition key has to be part of the primary key.
+        op.execute("""
+            CREATE TABLE audit_event (
+                id BIGINT GENERATED BY DEFAULT AS IDENTITY,
+                occurred_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                event VARCHAR(64) NOT NULL,
+                user_uid VARCHAR(40),
+                username VARCHAR(255),
+                remote_addr VARCHAR(64),
+                detail TEXT,
+                PRIMARY KEY (id, occurred_at)
+            ) PARTITION BY RANGE (occurred_at)
+        """)
+        op.execute("CREATE TABLE audit_event_default PARTITION OF audit_event DEFAULT")
+        op.execute("""
+            CREATE FUNCTION audit_event_append_only() RETURNS trigger AS $$
+            BEGIN
+                RAISE EXCEPTION 'audit_event is append-only';
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        op.execute("""
+            CREATE TRIGGER audit_event_append_only BEFORE UPDATE OR DELETE ON audit_event
+            FOR EACH ROW EXECUTE FUNCTION audit_event_append_only()
+        """)
+    else:
+        op.create_table('audit_event',
+        sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+        sa.Column('occurred_at', sa.DateTime(), nullable=False),
+        sa.Column('event', sa.String(length=64), nullable=False),
+        sa.Column('user_uid', sa.String(length=40), nullable=True),
+        sa.Column('username', sa.String(length=255), nullable=True),
+        sa.Column('remote_addr', sa.String(length=64), nullable=True),
+        sa.Column('detail', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+        if op.get_bind().dialect.name == 'sqlite':
+            for operation in ('UPDATE', 'DELETE'):
+                op.execute(
+                    f"CREATE TRIGGER audit_event_no_{operation.lower()} BEFORE {operation} ON audit_event "
+                    "BEGIN SELECT RAISE(ABORT, 'audit_event is append-only'); END"
+                )
+
+    with op.batch_alter_table('audit_event', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_audit_event_occurred_at'), ['occurred_at'], unique=False)
+        batch_op.create_index('ix_audit_event_user_uid_occurred_at', ['user_uid', 'occurred_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('audit_event', schema=None) as batch_op:
+        batch_op.drop_index('ix_audit_event_user_uid_occurred_at')
+        batch_op.drop_index(batch_op.f('ix_audit_event_occurred_at'))
+
+    op.drop_table('audit_event')
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DROP FUNCTION audit_event_append_only()")
@@ -0,0 +1,26 @@
+"""Credential transports
+
+Revision ID: bf3aeb564246
+Revises: 7b503a307fcf
+Create Date: 2026-10-17 18:41:09.512874
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'bf3aeb564246'
+down_revision = '7b503a307fcf'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('web_authn_credential', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('transports', sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('web_authn_credential', schema=None) as batch_op:
+        batch_op.drop_column('transports')
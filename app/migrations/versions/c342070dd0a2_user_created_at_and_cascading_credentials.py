@@ -0,0 +1,50 @@
+"""User created_at and cascading credential deletes
+
+Revision ID: c342070dd0a2
+Revises: d26bb5db6da1
+Create Date: 2026-10-17 14:21:08.512937
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c342070dd0a2'
+down_revision = 'd26bb5db6da1'
+branch_labels = None
+depends_on = None
+
+# The initial schema left the foreign key unnamed; this matches the name
+# PostgreSQL generated and lets batch mode find it on SQLite
+naming_convention = {"fk": "%(table_name)s_%(column_0_name)s_fkey"}
+
+
+def _utc_now():
+    if op.get_bind().dialect.name == 'postgresql':
+        return sa.text("(now() at time zone 'utc')")
+    return sa.text('CURRENT_TIMESTAMP')
+
+
+def upgrade():
+    # Existing users get the migration time, so the reaper only considers
+    # them once they are older than its age threshold
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('created_at', sa.DateTime(), nullable=True, server_default=_utc_now()))
+        batch_op.create_index(batch_op.f('ix_user_created_at'), ['created_at'], unique=False)
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.alter_column('created_at', server_default=None)
+
+    with op.batch_alter_table('web_authn_credential', schema=None, naming_convention=naming_convention) as batch_op:
+        batch_op.drop_constraint('web_authn_credential_user_id_fkey', type_='foreignkey')
+        batch_op.create_foreign_key('web_authn_credential_user_id_fkey', 'user', ['user_id'], ['id'], ondelete='CASCADE')
+
+
+def downgrade():
+    with op.batch_alter_table('web_authn_credential', schema=None, naming_convention=naming_convention) as batch_op:
+        batch_op.drop_constraint('web_authn_credential_user_id_fkey', type_='foreignkey')
+        batch_op.create_foreign_key('web_authn_credential_user_id_fkey', 'user', ['user_id'], ['id'])
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_created_at'))
+        batch_op.drop_column('created_at')
@@ -0,0 +1,28 @@
+"""Index credential lookups
+
+Revision ID: d26bb5db6da1
+Revises: 33f0b84f9dbf
+Create Date: 2026-10-17 10:03:27.604118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd26bb5db6da1'
+down_revision = '33f0b84f9dbf'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('web_authn_credential', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_web_authn_credential_credential_id'), ['credential_id'], unique=True)
+        batch_op.create_index(batch_op.f('ix_web_authn_credential_user_id'), ['user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('web_authn_credential', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_web_authn_credential_user_id'))
+        batch_op.drop_index(batch_op.f('ix_web_authn_credential_credential_id'))
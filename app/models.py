@@ -1,15 +1,38 @@
+import datetime
 import uuid
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
 from sqlalchemy.orm import backref
 
 db = SQLAlchemy()
 
 
+def enable_foreign_keys(engine):
+    """
+    Have SQLite enforce foreign keys on engine's connections, so deleting a
+    user cascades to their credentials as it does on PostgreSQL; SQLite
+    ignores ON DELETE CASCADE unless asked on every connection.
+    """
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def _foreign_keys_on(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
 def _str_uuid():
     return str(uuid.uuid4())
 
 
+def _utcnow():
+    # Naive UTC, matching how the column is stored on every backend
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
 # pylint: disable=too-few-public-methods
 class User(db.Model):  # type: ignore
     """A user in the database"""
@@ -19,8 +42,16 @@ class User(db.Model):  # type: ignore
     username = db.Column(db.String(255), unique=True, nullable=False)
     name = db.Column(db.String(255), nullable=True)
     email = db.Column(db.String(255), unique=True, nullable=False)
+    # Lets the reaper tell abandoned signups from ones still in progress
+    created_at = db.Column(db.DateTime, default=_utcnow, nullable=True, index=True)
+    # Set by the signup form until the first credential is saved; only these
+    # users are reaped, never provisioned or restored ones
+    signup_pending = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
     credentials = db.relationship(
-        "WebAuthnCredential", backref=backref("user", cascade="all, delete"), lazy=True
+        "WebAuthnCredential",
+        backref=backref("user", cascade="all, delete"),
+        lazy=True,
+        passive_deletes=True,
     )
 
     def __repr__(self):
@@ -31,10 +62,51 @@ class WebAuthnCredential(db.Model):
     """Stored WebAuthn Credentials as a replacement for passwords."""
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    credential_id = db.Column(db.LargeBinary, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False, index=True)
+    # Looked up on every login, so it gets a unique index
+    credential_id = db.Column(db.LargeBinary, nullable=False, unique=True, index=True)
     credential_public_key = db.Column(db.LargeBinary, nullable=False)
     current_sign_count = db.Column(db.Integer, default=0)
+    # Written behind logins by auth.usage, so it may lag by a flush interval
+    last_used_at = db.Column(db.DateTime, nullable=True)
+    # Comma separated transports the authenticator reported at registration,
+    # passed back as hints in credential descriptors
+    transports = db.Column(db.String(255), nullable=True)
 
     def __repr__(self):
         return f"<Credential {self.credential_id}>"
+
+
+class AuditEvent(db.Model):
+    """
+    An audit event, written in batches by the audit module. Append-only:
+    triggers refuse updates and deletes, and on PostgreSQL the table is
+    partitioned by month of occurred_at.
+    """
+
+    __table_args__ = (db.Index("ix_audit_event_user_uid_occurred_at", "user_uid", "occurred_at"),)
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    occurred_at = db.Column(db.DateTime, nullable=False, index=True)
+    event = db.Column(db.String(64), nullable=False)
+    # Not a foreign key: events outlive the users they are about
+    user_uid = db.Column(db.String(40), nullable=True)
+    username = db.Column(db.String(255), nullable=True)
+    remote_addr = db.Column(db.String(64), nullable=True)
+    # JSON object of event specific details
+    detail = db.Column(db.Text, nullable=True)
+
+    def __repr__(self):
+        return f"<AuditEvent {self.event} {self.user_uid}>"
+
+
+# The migrations create these too; this covers create_all on SQLite
+for _operation in ("UPDATE", "DELETE"):
+    event.listen(
+        AuditEvent.__table__,
+        "after_create",
+        DDL(
+            f"CREATE TRIGGER audit_event_no_{_operation.lower()} BEFORE {_operation} ON audit_event "
+            "BEGIN SELECT RAISE(ABORT, 'audit_event is append-only'); END"
+        ).execute_if(dialect="sqlite"),
+    )
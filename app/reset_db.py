@@ -3,9 +3,8 @@
 Reset database utility - useful for development
 """
 
-import os
 from app import app, db
-from flask_migrate import upgrade, init, migrate
+from flask_migrate import upgrade
 
 
 def reset_database():
@@ -17,27 +16,15 @@ def reset_database():
             if "postgresql" in database_url.lower():
                 print("Resetting PostgreSQL database...")
 
-                # Drop all tables
+                # Drop all tables, including Alembic's version table
                 db.drop_all()
+                db.session.execute(db.text("DROP TABLE IF EXISTS alembic_version"))
+                db.session.commit()
                 print("✅ All tables dropped")
 
-                # Remove migration files
-                import shutil
-                if os.path.exists("migrations"):
-                    shutil.rmtree("migrations")
-                    print("✅ Migration files removed")
-
-                # Reinitialize migrations
-                init()
-                print("✅ Migrations reinitialized")
-
-                # Create initial migration
-                migrate(message="Initial migration")
-                print("✅ Initial migration created")
-
-                # Apply migration
+                # Recreate the schema from the versioned migrations
                 upgrade()
-                print("✅ Migration applied")
+                print("✅ Migrations applied")
 
             else:
                 print("Resetting SQLite database...")
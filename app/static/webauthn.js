@@ -0,0 +1,2 @@
+// Ceremony helpers used by the page scripts, from the SimpleWebAuthn bundle
+const { startRegistration, startAuthentication } = SimpleWebAuthnBrowser;
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+# Modules import each other from the app directory, as when the app runs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import db, enable_foreign_keys  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    """A bare app on a fresh SQLite database with the models' tables"""
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp_path / 'test.db'}"
+    db.init_app(app)
+    with app.app_context():
+        enable_foreign_keys(db.engine)
+        db.create_all()
+        yield app
+        db.session.remove()
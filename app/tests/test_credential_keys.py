@@ -0,0 +1,78 @@
+import json
+
+import pytest
+import webauthn
+from webauthn.helpers import base64url_to_bytes, bytes_to_base64url
+from webauthn.helpers.exceptions import InvalidAuthenticationResponse
+
+from auth import credential_keys
+from benchmarks.soft_authenticator import SoftAuthenticator
+
+RP_ID = "localhost"
+ORIGIN = "http://localhost:5000"
+CHALLENGE = b"\x01" * 32
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = credential_keys.PublicKeyCache(max_entries=10)
+    monkeypatch.setattr(credential_keys, "CACHE", cache)
+    return cache
+
+
+@pytest.fixture
+def login():
+    """An assertion, the credential's COSE key and its count before the login"""
+    authenticator = SoftAuthenticator()
+    options = webauthn.generate_registration_options(rp_id=RP_ID, rp_name="Test", user_name="user")
+    authenticator.create(json.loads(webauthn.options_to_json(options)), ORIGIN)
+    soft_credential = next(iter(authenticator.credentials.values()))
+    assertion = authenticator.get(
+        {"rpId": RP_ID, "challenge": bytes_to_base64url(CHALLENGE), "allowCredentials": []}, ORIGIN
+    )
+    return assertion, soft_credential.cose_public_key(), soft_credential.sign_count - 1
+
+
+def _verify(verify, assertion, public_key, sign_count):
+    return verify(
+        credential=assertion,
+        expected_challenge=CHALLENGE,
+        expected_rp_id=RP_ID,
+        expected_origin=ORIGIN,
+        credential_public_key=public_key,
+        credential_current_sign_count=sign_count,
+    )
+
+
+def _rejection(verify, *args):
+    with pytest.raises(InvalidAuthenticationResponse) as raised:
+        _verify(verify, *args)
+    return str(raised.value)
+
+
+def test_cached_key_verifies_as_the_library_does(cache, login):
+    expected = _verify(webauthn.verify_authentication_response, *login)
+    assert _verify(credential_keys.verify_authentication_response, *login) == expected
+    # The second verification uses the cached key
+    assert _verify(credential_keys.verify_authentication_response, *login) == expected
+    assert (cache.misses, cache.hits) == (1, 1)
+
+
+def test_wrong_signature_is_rejected_as_the_library_does(cache, login):
+    assertion, public_key, sign_count = login
+    signature = bytearray(base64url_to_bytes(assertion["response"]["signature"]))
+    signature[-1] ^= 1
+    assertion["response"]["signature"] = bytes_to_base64url(bytes(signature))
+
+    expected = _rejection(webauthn.verify_authentication_response, assertion, public_key, sign_count)
+    assert _rejection(credential_keys.verify_authentication_response, assertion, public_key, sign_count) == expected
+
+
+@pytest.mark.parametrize("ahead", [0, 1])
+def test_sign_count_that_did_not_increase_is_rejected_as_the_library_does(cache, login, ahead):
+    assertion, public_key, sign_count = login
+    stored_count = sign_count + 1 + ahead
+
+    expected = _rejection(webauthn.verify_authentication_response, assertion, public_key, stored_count)
+    assert "was not greater than current count" in expected
+    assert _rejection(credential_keys.verify_authentication_response, assertion, public_key, stored_count) == expected
@@ -0,0 +1,28 @@
+import pytest
+from auth import metadata
+from webauthn.helpers.exceptions import InvalidRegistrationResponse
+from webauthn.helpers.structs import AuthenticatorAttestationResponse, RegistrationCredential
+
+
+def _credential(attestation_object):
+    return RegistrationCredential(
+        id="AQI",
+        raw_id=b"\x01\x02",
+        response=AuthenticatorAttestationResponse(client_data_json=b"{}", attestation_object=attestation_object),
+    )
+
+
+@pytest.mark.parametrize("attestation_object", [b"", b"\xff\x00garbage", b"\xa1\x63fmt\x64none"])
+def test_malformed_attestation_is_rejected_as_invalid_registration(monkeypatch, attestation_object):
+    monkeypatch.setattr(metadata, "AUTHENTICATOR_POLICY", "known")
+
+    with pytest.raises(InvalidRegistrationResponse):
+        metadata.trust_anchors_for(_credential(attestation_object))
+
+
+def test_policy_off_skips_parsing(monkeypatch):
+    monkeypatch.setattr(metadata, "STORE", None)
+    monkeypatch.setattr(metadata, "AUTHENTICATOR_POLICY", "any")
+    monkeypatch.setattr(metadata, "ALLOWED_AAGUIDS", None)
+
+    assert metadata.trust_anchors_for(_credential(b"\xff")) is None
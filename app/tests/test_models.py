@@ -0,0 +1,42 @@
+from models import User, WebAuthnCredential, db
+
+
+def _user_with_credential(username):
+    user = User(username=username, email=f"{username}@example.com")
+    user.credentials.append(WebAuthnCredential(credential_id=username.encode(), credential_public_key=b"key"))
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def _credential_count():
+    return db.session.query(WebAuthnCredential).count()
+
+
+def test_deleting_a_user_deletes_their_credentials(app):
+    user = _user_with_credential("alice")
+    db.session.delete(user)
+    db.session.commit()
+    assert _credential_count() == 0
+
+
+def test_bulk_deleting_users_deletes_their_credentials(app):
+    _user_with_credential("alice")
+    _user_with_credential("bob")
+    User.query.delete()
+    db.session.commit()
+    assert _credential_count() == 0
+
+
+def test_a_new_user_does_not_inherit_a_deleted_users_credentials(app):
+    user = _user_with_credential("alice")
+    user_id = user.id
+    db.session.delete(user)
+    db.session.commit()
+
+    # SQLite hands the freed rowid to the next user
+    mallory = User(username="mallory", email="mallory@example.com")
+    db.session.add(mallory)
+    db.session.commit()
+    assert mallory.id == user_id
+    assert WebAuthnCredential.query.filter_by(user_id=mallory.id).count() == 0
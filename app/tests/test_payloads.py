@@ -0,0 +1,34 @@
+import pytest
+
+from auth import payloads
+from benchmarks.bench_payload import hostile_payloads, valid_payloads
+
+REGISTRATION, ASSERTION = valid_payloads()
+HOSTILE = hostile_payloads(REGISTRATION, ASSERTION)
+
+
+def test_valid_payloads_decode():
+    assert payloads.decode_registration(REGISTRATION).id == REGISTRATION["id"]
+    assert payloads.decode_authentication(ASSERTION).id == ASSERTION["id"]
+
+
+@pytest.mark.parametrize("name, registration, assertion", HOSTILE, ids=[name for name, _, _ in HOSTILE])
+def test_hostile_payloads_decode_or_raise_payload_error(name, registration, assertion):
+    # Anything else escapes the rejection count and the views' 400 handling
+    for decode, payload in (
+        (payloads.decode_registration, registration),
+        (payloads.decode_authentication, assertion),
+    ):
+        try:
+            decode(payload)
+        except payloads.PayloadError:
+            pass
+
+
+@pytest.mark.parametrize("attachment", [["platform"], {"platform": 1}, 5])
+def test_authenticator_attachment_must_be_a_name(attachment):
+    rejections = payloads.PAYLOAD_REJECTIONS.labels("authentication", "malformed")
+    before = rejections.get()
+    with pytest.raises(payloads.PayloadError, match="Unexpected authenticatorAttachment"):
+        payloads.decode_authentication(dict(ASSERTION, authenticatorAttachment=attachment))
+    assert rejections.get() == before + 1
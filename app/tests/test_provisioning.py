@@ -0,0 +1,38 @@
+import io
+
+from admin import provisioning
+from models import User
+
+
+def _provision(text, fmt="ndjson", batch_size=2):
+    return provisioning.provision_users(provisioning.read_rows(io.StringIO(text), fmt), batch_size=batch_size)
+
+
+def test_mixed_ndjson_upload_reports_every_row(app):
+    report = _provision("\n".join([
+        '{"username": "alice", "email": "alice@example.com"}',
+        "[1, 2]",
+        '"abc"',
+        "5",
+        "null",
+        "{not json",
+        '{"username": "bob"}',
+        '{"username": "alice", "email": "other@example.com"}',
+        '{"username": "carol", "email": "carol@example.com", "name": "Carol"}',
+    ]))
+
+    assert [(result["row"], result["status"]) for result in report.results] == [
+        (1, "created"), (2, "invalid"), (3, "invalid"), (4, "invalid"), (5, "invalid"),
+        (6, "invalid"), (7, "invalid"), (8, "conflict"), (9, "created"),
+    ]
+    assert {result["error"] for result in report.results[1:5]} == {"Row is not an object"}
+    assert report.results[5]["error"] == "Malformed JSON line"
+    assert report.results[6]["username"] == "bob"
+    assert sorted(user.username for user in User.query.all()) == ["alice", "carol"]
+
+
+def test_csv_upload(app):
+    report = _provision("username,email,name\ndave,dave@example.com,\n,missing@example.com,\n", fmt="csv")
+
+    assert report.counts == {"created": 1, "conflict": 0, "duplicate": 0, "invalid": 1}
+    assert User.query.one().name == "dave"
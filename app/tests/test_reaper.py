@@ -0,0 +1,43 @@
+import datetime
+
+from admin import reaper
+from models import User, WebAuthnCredential, db
+
+
+def _user(username, age, signup_pending=True, credential=False):
+    created_at = None
+    if age is not None:
+        created_at = (datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+                      - datetime.timedelta(seconds=age))
+    user = User(username=username, email=f"{username}@example.com", signup_pending=signup_pending)
+    if credential:
+        user.credentials.append(WebAuthnCredential(credential_id=username.encode(), credential_public_key=b"key"))
+    db.session.add(user)
+    db.session.commit()
+    # created_at has a default, so set it after the insert
+    db.session.execute(User.__table__.update().where(User.id == user.id).values(created_at=created_at))
+    db.session.commit()
+
+
+def _usernames():
+    return sorted(db.session.execute(db.select(User.username)).scalars())
+
+
+def test_reaps_only_abandoned_signups(app):
+    _user("abandoned", age=7200)
+    _user("in_progress", age=60)
+    _user("finished", age=7200, credential=True)
+    _user("provisioned", age=7200, signup_pending=False)
+    _user("restored", age=None, signup_pending=False)
+    _user("unknown_age", age=None)
+
+    assert reaper.reap(max_age=3600, pause=0) == 1
+    assert _usernames() == ["finished", "in_progress", "provisioned", "restored", "unknown_age"]
+
+
+def test_reaps_in_batches(app):
+    for n in range(5):
+        _user(f"abandoned{n}", age=7200)
+
+    assert reaper.reap(max_age=3600, batch_size=2, pause=0) == 5
+    assert _usernames() == []
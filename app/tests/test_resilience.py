@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+from auth import limits
+from auth.challenges import AsyncMemoryChallengeStore, MemoryChallengeStore
+from auth.resilience import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    AsyncResilientChallengeStore,
+    CircuitBreaker,
+    ResilientChallengeStore,
+    StoreBusy,
+    StoreUnavailable,
+    retry_after,
+)
+from redis.exceptions import ConnectionError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FailingStore:
+    def __init__(self, error):
+        self.error = error
+
+    def put(self, key, challenge, ttl):
+        raise self.error
+
+
+class AsyncFailingStore:
+    def __init__(self, error):
+        self.error = error
+
+    async def put(self, key, challenge, ttl):
+        raise self.error
+
+
+def _exhausted():
+    return ConnectionError("No connection available.")
+
+
+@pytest.mark.parametrize("policy", ["open", "closed"])
+def test_pool_exhaustion_is_shed_without_tripping_the_breaker(policy):
+    breaker = CircuitBreaker(failure_threshold=2)
+    store = ResilientChallengeStore(FailingStore(_exhausted()), MemoryChallengeStore(), breaker,
+                                    {"challenge": policy})
+    for _ in range(5):
+        with pytest.raises(StoreBusy):
+            store.put("key", b"challenge")
+    assert breaker.state == CLOSED
+    assert breaker.failures == 0
+
+
+def test_connection_failures_still_trip_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=2)
+    store = ResilientChallengeStore(FailingStore(ConnectionError("Connection refused")), MemoryChallengeStore(),
+                                    breaker, {"challenge": "closed"})
+    for _ in range(2):
+        with pytest.raises(StoreUnavailable) as raised:
+            store.put("key", b"challenge")
+        assert not isinstance(raised.value, StoreBusy)
+    assert breaker.state == OPEN
+
+
+def test_async_pool_exhaustion_is_shed_without_tripping_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=1)
+    store = AsyncResilientChallengeStore(AsyncFailingStore(_exhausted()), AsyncMemoryChallengeStore(MemoryChallengeStore()), breaker,
+                                         {"challenge": "open"})
+    with pytest.raises(StoreBusy):
+        asyncio.run(store.put("key", b"challenge"))
+    assert breaker.state == CLOSED
+
+
+def test_shed_probe_lets_the_next_operation_probe():
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=5, clock=clock)
+    breaker.failure()
+    clock.now = 5
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+
+    breaker.inconclusive()
+    assert breaker.state == OPEN
+    assert breaker.allow()
+
+
+def test_busy_is_retried_sooner():
+    assert retry_after(StoreBusy()) == 1
+
+
+class ExhaustedBuckets:
+    def take(self, buckets):
+        raise _exhausted()
+
+
+class AsyncExhaustedBuckets:
+    async def take(self, buckets):
+        raise _exhausted()
+
+
+def test_limiter_pool_exhaustion_is_refused_without_tripping_the_breaker(monkeypatch):
+    breaker = CircuitBreaker(failure_threshold=2)
+    monkeypatch.setattr(limits, "LIMITER", limits.RateLimiter(ExhaustedBuckets(), limits.MemoryTokenBuckets(), breaker))
+    monkeypatch.setattr(limits, "CONCURRENCY", limits.ConcurrencyLimit(4))
+
+    for _ in range(5):
+        assert limits.admit("auth.create_user", "10.0.0.1", ("alice", "alice@example.com")) == (503, 1)
+    assert breaker.state == CLOSED
+    assert breaker.failures == 0
+    assert limits.CONCURRENCY.in_progress == 0
+
+
+def test_async_limiter_pool_exhaustion_is_refused_without_tripping_the_breaker(monkeypatch):
+    breaker = CircuitBreaker(failure_threshold=1)
+    limiter = limits.AsyncRateLimiter(AsyncExhaustedBuckets(), limits.MemoryTokenBuckets(), breaker)
+    monkeypatch.setattr(limits, "CONCURRENCY", limits.ConcurrencyLimit(4))
+
+    assert asyncio.run(limits.admit_async(limiter, "auth.create_user", "10.0.0.1")) == (503, 1)
+    assert breaker.state == CLOSED
+    assert limits.CONCURRENCY.in_progress == 0
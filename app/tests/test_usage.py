@@ -0,0 +1,92 @@
+import datetime
+
+import pytest
+from auth import usage
+from models import User, WebAuthnCredential, db
+
+
+@pytest.fixture
+def credential(app):
+    user = User(username="alice", email="alice@example.com")
+    credential = WebAuthnCredential(user=user, credential_id=b"alice", credential_public_key=b"key")
+    db.session.add(credential)
+    db.session.commit()
+    return credential
+
+
+def _stored(credential):
+    db.session.expire_all()
+    return db.session.get(WebAuthnCredential, credential.id)
+
+
+def test_record_writes_straight_away_without_a_flusher(credential, monkeypatch):
+    monkeypatch.setattr(usage, "BUFFER", usage.UsageBuffer())
+    monkeypatch.setattr(usage, "_worker", None)
+
+    usage.record(credential.id, 7)
+
+    assert len(usage.BUFFER) == 0
+    stored = _stored(credential)
+    assert stored.current_sign_count == 7
+    assert stored.last_used_at is not None
+
+
+def test_record_buffers_with_a_flusher(credential, monkeypatch):
+    monkeypatch.setattr(usage, "BUFFER", usage.UsageBuffer())
+    monkeypatch.setattr(usage, "_worker", object())
+
+    usage.record(credential.id, 7)
+
+    assert len(usage.BUFFER) == 1
+    assert _stored(credential).current_sign_count == 0
+
+
+def test_full_buffer_refuses_new_credentials():
+    now = datetime.datetime(2026, 1, 1)
+    buffer = usage.UsageBuffer(max_pending=2)
+    assert buffer.record(1, 1, now)
+    assert buffer.record(2, 1, now)
+    assert buffer.full.is_set()
+    assert not buffer.record(3, 1, now)
+    # Credentials already waiting still merge
+    assert buffer.record(1, 5, now)
+    assert len(buffer) == 2
+    assert sorted(buffer.drain()) == [(1, 5, now), (2, 1, now)]
+
+
+def test_restore_merges_and_keeps_to_the_bound():
+    now = datetime.datetime(2026, 1, 1)
+    later = now + datetime.timedelta(seconds=1)
+    buffer = usage.UsageBuffer(max_pending=3)
+    buffer.record(1, 1, now)
+    buffer.record(2, 1, now)
+    rows = buffer.drain()
+    buffer.record(2, 4, later)
+    buffer.record(3, 1, later)
+
+    assert buffer.restore(rows) == 0
+    assert sorted(buffer.drain()) == [(1, 1, now), (2, 4, later), (3, 1, later)]
+
+
+def test_repeated_failed_flushes_stay_bounded(app, monkeypatch):
+    monkeypatch.setattr(usage, "BUFFER", usage.UsageBuffer(max_pending=100))
+    monkeypatch.setattr(usage, "_app", app)
+    now = datetime.datetime(2026, 1, 1)
+    next_id = iter(range(1000000))
+
+    def failing_write(rows):
+        # Logins keep arriving while the write hangs and fails
+        while usage.BUFFER.record(next(next_id), 1, now):
+            pass
+        raise RuntimeError("database down")
+
+    monkeypatch.setattr(usage, "write", failing_write)
+    dropped_before = usage.USAGE_ROWS_DROPPED._default.get()
+    while usage.BUFFER.record(next(next_id), 1, now):
+        pass
+    for _ in range(5):
+        with pytest.raises(RuntimeError):
+            usage.flush()
+        assert len(usage.BUFFER) == 100
+
+    assert usage.USAGE_ROWS_DROPPED._default.get() - dropped_before == 500
@@ -0,0 +1,75 @@
+from auth.user_credentials import UserCredentialCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_hits_until_the_entry_expires():
+    clock = Clock()
+    cache = UserCredentialCache(max_entries=10, ttl=30, clock=clock)
+    loads = []
+
+    def loader(user_id):
+        loads.append(user_id)
+        return ((b"cred", ()),)
+
+    assert cache.get(1, loader) == cache.get(1, loader)
+    assert loads == [1]
+    clock.now = 31
+    cache.get(1, loader)
+    assert loads == [1, 1]
+
+
+def test_load_racing_an_invalidation_is_not_stored():
+    cache = UserCredentialCache(max_entries=10, ttl=30)
+    current = [((b"old", ()),)]
+
+    def stale_loader(user_id):
+        # Read before a credential is added and the user invalidated
+        credentials = current[0]
+        current[0] = ((b"old", ()), (b"new", ()))
+        cache.invalidate([user_id])
+        return credentials
+
+    assert cache.get(1, stale_loader) == ((b"old", ()),)
+    assert cache.get(1, lambda user_id: current[0]) == ((b"old", ()), (b"new", ()))
+
+
+def test_load_racing_a_clear_is_not_stored():
+    cache = UserCredentialCache(max_entries=10, ttl=30)
+
+    def stale_loader(user_id):
+        cache.clear()
+        return ()
+
+    cache.get(1, stale_loader)
+    assert cache.stats()["size"] == 0
+
+
+def test_failed_load_leaves_nothing_behind():
+    cache = UserCredentialCache(max_entries=10, ttl=30)
+
+    def failing_loader(user_id):
+        raise RuntimeError("database down")
+
+    try:
+        cache.get(1, failing_loader)
+    except RuntimeError:
+        pass
+    assert cache.stats()["size"] == 0
+    assert cache._loading == {}
+
+
+def test_evicts_least_recently_used():
+    cache = UserCredentialCache(max_entries=2, ttl=30)
+    for user_id in (1, 2):
+        cache.get(user_id, lambda user_id: ())
+    cache.get(1, lambda user_id: ())
+    cache.get(3, lambda user_id: ())
+    assert list(cache._entries) == [1, 3]
+    assert cache.stats()["evictions"] == 1